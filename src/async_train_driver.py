@@ -0,0 +1,323 @@
+import asyncio
+import time
+from typing import List
+
+from rx import operators as ops
+from intelino.trainlib_async import TrainScanner, Train
+from intelino.trainlib_async.enums import (
+    MovementDirection,
+    SnapColorValue as C,
+    SteeringDecision,
+    ColorSensor
+)
+from intelino.trainlib_async.messages import (
+    TrainMsgMovement,
+    TrainMsgEventSensorColorChangedBase,
+    TrainMsgEventSplitDecision
+)
+from reporter import Reporter, ConsoleReporter
+from log_pipeline import LogPipeline
+from enums import CommandId, Speed, JunctionMark
+from color_matcher import ColorSequenceMatcher, SnapMatch, new_snap_matcher
+from dispatch import COMMAND_HANDLERS, CommandHandler
+from junctions import JunctionDetector
+from util import ColorCommand, ColorSequence, Program, Command
+
+
+class AsyncTrainDriver:
+    """
+    The asyncio flavour of the TrainDriver.
+
+    It talks to the train through intelino.trainlib_async, so every driver lives on
+    the caller's event loop: no thread per train and no thread hop for the commands.
+    The command surface is the same as the TrainDriver, but awaitable.
+    """
+
+    def __init__(self, reporter: Reporter = ConsoleReporter(), log_pipeline: LogPipeline = None):
+        """
+        Args:
+            reporter: Where the driver reports to
+            log_pipeline: A pipeline shared with other drivers. Its reporters are used instead of the reporter.
+                          If None the driver has its own, that is one more consumer thread per driver
+        """
+        self.train: Train = None
+        self._driving: bool = False
+        self._loop: asyncio.AbstractEventLoop = None
+        self._subscriptions = list()
+        self._disconnect_callback = None
+        if log_pipeline is None:
+            log_pipeline = LogPipeline()
+            log_pipeline.add_reporter(reporter)
+        self._log_pipeline: LogPipeline = log_pipeline
+
+        # Buffered values from the movement notification stream
+        self._odometer_offset: float = 0
+        self._odometer_last: float = 0
+        self._train_direction: MovementDirection = MovementDirection.STOP
+        self._speed_cmps: float = 0
+        self._next_split_decision: SteeringDecision = SteeringDecision.NONE
+
+        # Below is the state of the train
+        self._snap_following: bool = False
+        self._speed_level: Speed = Speed.ZERO
+        self._steering: SteeringDecision = SteeringDecision.STRAIGHT
+        self._direction: MovementDirection = MovementDirection.FORWARD
+        # The colors seen since the last black, packed like the ColorSequence identity
+        self._color_identity: int = ColorSequence.EMPTY_IDENTITY
+        self._matcher: ColorSequenceMatcher = new_snap_matcher()
+        self._junctions = JunctionDetector()
+
+        self._next_steering: SteeringDecision = None
+        self._next_steering_count: int = 0
+        self._programs: dict() = dict()
+        self._handlers: dict() = dict(COMMAND_HANDLERS)
+        # There is no track layout in the async driver
+        del self._handlers[CommandId.ROUTE]
+        del self._handlers[CommandId.METRICS]
+        del self._handlers[CommandId.LAYOUT]
+        del self._handlers[CommandId.RAMP]
+        del self._handlers[CommandId.REVERSE_NOW]
+        del self._handlers[CommandId.SCRIPT]
+
+    async def connect(self, connect_callback=None, disconnect_callback=None, train: Train = None):
+        """
+        Args:
+            connect_callback: callback(success: bool = True, train_id: str, train_name: str)
+                              callback(success: bool = False, error_message)
+            disconnect_callback:  callback(success: bool, train_id: str, train_name: str)
+            train: An already discovered train. If None, the first train found is used.
+        Returns:
+            When the train is connected and initialised.
+        """
+        if self._driving:
+            self.log("The train driver seems to be already connected")
+            return
+
+        self._disconnect_callback = disconnect_callback
+        try:
+            if train is None:
+                train = await TrainScanner().get_train()
+            elif not train.is_connected:
+                await train.connect()
+            self.train = train
+            self._loop = asyncio.get_running_loop()
+            await self._init_train()
+            self._driving = True
+        except Exception as error:
+            if connect_callback is not None:
+                connect_callback(False, str(error), None)
+            return
+
+        self.log("Train Driver Connected")
+        if connect_callback is not None:
+            connect_callback(True, self.train.id, self.train.name)
+
+    async def disconnect(self):
+        if not self._driving:
+            return
+        self._driving = False
+        await self._cleanup_train()
+        await self.train.disconnect()
+
+        self.log("Train Driver Disconnected")
+        if self._disconnect_callback is not None:
+            self._disconnect_callback(True, self.train.id, self.train.name)
+
+    def is_driving(self) -> bool:
+        return self._driving
+
+    def log(self, msg):
+        self._log_pipeline.submit(msg)
+
+    def logn(self, msg):
+        self._log_pipeline.submit(msg, False)
+
+    def add_reporter(self, reporter: Reporter):
+        self._log_pipeline.add_reporter(reporter)
+
+    @property
+    def distance_cm(self) -> int:
+        return int((self._odometer_last - self._odometer_offset) * 100)
+
+    @property
+    def speed_cmps(self) -> float:
+        return self._speed_cmps
+
+    async def _init_train(self):
+        msg = await self.train.get_movement_notification()
+        self._odometer_offset = msg.lifetime_odometer_meters
+        self._sync_movement(msg)
+
+        movement_stream = await self.train.movement_notification_stream()
+        self._subscriptions.append(movement_stream.subscribe(self._sync_movement))
+        self._subscriptions.append(self.train.notifications.pipe(
+            ops.filter(lambda m: isinstance(m, TrainMsgEventSplitDecision))
+        ).subscribe(self.split_decision_callback))
+        self._subscriptions.append(self.train.notifications.pipe(
+            ops.filter(lambda m: isinstance(m, TrainMsgEventSensorColorChangedBase))
+        ).subscribe(self.handle_color_change))
+
+        await self.train.stop_driving()
+        await self.train.set_snap_command_execution(self._snap_following)
+
+    async def _cleanup_train(self):
+        for subscription in self._subscriptions:
+            subscription.dispose()
+        self._subscriptions.clear()
+        await self.train.stop_driving()
+        await self.train.set_snap_command_execution(True)
+        await self.train.movement_notification_stream(False)
+
+    def _sync_movement(self, msg: TrainMsgMovement):
+        self._odometer_last = msg.lifetime_odometer_meters
+        self._train_direction = msg.direction
+        self._speed_cmps = msg.speed_cmps
+        self._next_split_decision = msg.next_split_decision
+
+    def _spawn(self, coroutine):
+        """Runs a train command from a notification callback without blocking it"""
+        self._loop.create_task(coroutine)
+
+    async def execute(self, command: Command):
+        handler = self._handlers.get(command.cmd_id)
+        if handler is None:
+            self.log(f"Command not handled: {command}")
+            return
+        result = handler(self, command)
+        if result is not None:
+            await result
+
+    def register_handler(self, cmd_id: CommandId, handler: CommandHandler):
+        """Adds or replaces the handler of a command for this driver only"""
+        self._handlers[cmd_id] = handler
+
+    async def start(self):
+        self.logn("Starting")
+        self._speed_level = Speed.TWO
+        await self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+
+    async def stop(self):
+        self.log("Stopping")
+        self._speed_level = Speed.ZERO
+        await self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+
+    async def reverse(self):
+        self.log("Reversing")
+        if self._train_direction == MovementDirection.FORWARD:
+            self._direction = MovementDirection.BACKWARD
+        else:
+            self._direction = MovementDirection.FORWARD
+        await self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+
+    async def forward(self):
+        self.log("Forward")
+        self._direction = MovementDirection.FORWARD
+        self._speed_level = Speed.TWO
+        await self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+
+    async def backward(self):
+        self.log("Backwards")
+        self._direction = MovementDirection.BACKWARD
+        self._speed_level = Speed.TWO
+        await self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+
+    async def set_state_steering(self, steering: SteeringDecision):
+        self.log(f"Set base steering {steering.name}")
+        self._steering = steering
+        await self.train.set_next_split_steering_decision(self._steering)
+
+    async def set_snap_following(self, follow: bool):
+        self.log(f"Setting snap following to {follow}")
+        self._snap_following = follow
+        await self.train.set_snap_command_execution(follow)
+
+    async def next_steering(self, steering: SteeringDecision, count: int = 1):
+        if count is None:
+            count = 1
+        self.log(f"Next steering: {steering.name}, count: {count}")
+        self._next_steering_count = count - 1
+        self._next_steering = steering
+        await self.train.set_next_split_steering_decision(steering)
+
+    async def set_speed(self, speed_level: Speed):
+        self.log(f"Setting speed to {speed_level.name}")
+        self._speed_level = speed_level
+        await self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+
+    def split_decision_callback(self, msg: TrainMsgEventSplitDecision):
+        if self._next_steering_count > 0:
+            steering = self._next_steering
+            self._next_steering_count -= 1
+        else:
+            steering = self._steering
+        self.log(f"Split. Last: {msg.decision.name}, Next: {steering.name} ({self._next_steering_count > 0}), Default: {self._next_split_decision.name}")
+        self._spawn(self.train.set_next_split_steering_decision(steering))
+
+    def handle_color_change(self, msg: TrainMsgEventSensorColorChangedBase):
+        if msg.sensor == ColorSensor.FRONT:
+            if msg.color == C.BLACK:
+                seq = ColorSequence.from_identity(self._color_identity)
+                self._color_identity = ColorSequence.EMPTY_IDENTITY
+                match = self._matcher.match()
+                if match is None:
+                    self.handle_color_command(seq, self.distance_cm)
+                elif match[0] == SnapMatch.JUNCTION_MARK:
+                    self.handle_junction_mark(match[1], self.distance_cm)
+                elif match[0] == SnapMatch.MERGE_MARK:
+                    self.handle_merge_mark(match[1], self.distance_cm)
+                else:
+                    self.handle_color_command(seq, self.distance_cm, match[1])
+            else:
+                self._color_identity = (self._color_identity << ColorSequence.BITS) | int(msg.color)
+                self._matcher.advance(msg.color)
+
+    def handle_color_command(self, seq: ColorSequence, distance: int, program: Program = None):
+        command = ColorCommand(seq, distance, time.perf_counter())
+        self._junctions.color_command(command)
+        self.log(f"Color command: {command}")
+        if program is not None:
+            self.log(f"Executing program: {program}")
+            self._spawn(self.execute(program.command))
+        else:
+            self.log("No program found")
+
+    def handle_junction_mark(self, towards: JunctionMark, distance: int):
+        self.log(f"Junction Mark: {towards.name} at {distance}")
+        event = self._junctions.junction_mark(towards, distance)
+        if event is not None:
+            self.log(f"Junction ID: {event}")
+
+    def handle_merge_mark(self, coming: JunctionMark, distance: int):
+        self.log(f"Merging Mark: {coming.name} at {distance}")
+        event = self._junctions.merge_mark(coming, distance)
+        if event is not None:
+            self.log(f"Junction ID: {event}")
+
+    def program_command(self, program: Program):
+        existing = self._matcher.get(program.seq)
+        if existing is not None and existing[0] != SnapMatch.PROGRAM:
+            self.log(f"Cannot program {program.seq}, it is a track mark")
+            return
+        self._programs[program.seq.identity()] = program
+        self._matcher.add(program.seq, (SnapMatch.PROGRAM, program))
+        self.log(f"Program added: {program}")
+
+
+async def connect_drivers(count: int = None, timeout: float = 5.0,
+                          reporter: Reporter = ConsoleReporter()) -> List[AsyncTrainDriver]:
+    """
+    Scans once and connects a driver to every train found, all at the same time.
+
+    Args:
+        count: Number of trains to look for. If None, all trains found until the timeout
+        timeout: The scanning timeout in seconds
+        reporter: The reporter shared by all the drivers
+
+    Returns: The connected drivers
+    """
+    trains = await TrainScanner(timeout=timeout).get_trains(count, connect=False)
+    log_pipeline = LogPipeline()
+    log_pipeline.add_reporter(reporter)
+    drivers = [AsyncTrainDriver(log_pipeline=log_pipeline) for _ in trains]
+    await asyncio.gather(*(d.connect(train=t) for d, t in zip(drivers, trains)))
+    return [d for d in drivers if d.is_driving()]
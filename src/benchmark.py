@@ -0,0 +1,368 @@
+"""
+Small benchmarks for the driver hot paths. They do not need a train.
+
+    $ python3 src/benchmark.py idle --drivers 8 --seconds 5
+    $ python3 src/benchmark.py dispatch
+    $ python3 src/benchmark.py parse
+    $ python3 src/benchmark.py logging
+    $ python3 src/benchmark.py replay --laps 1000
+    $ python3 src/benchmark.py replay --laps 100 --link-latency 0.005 --predictive
+    $ python3 src/benchmark.py startup
+    $ python3 src/benchmark.py server --clients 8 --batch 100
+    $ python3 src/benchmark.py timers --timers 100000
+    $ python3 src/benchmark.py blocks --trains 100
+"""
+import argparse
+import itertools
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from intelino.trainlib.enums import SnapColorValue
+from blocks import BlockManager
+from command_parser import CommandParser
+from control_server import ControlServer
+from enums import CommandId, JunctionMark
+from junctions import JunctionEvent
+from log_pipeline import LogPipeline
+from simulation import SimulatedTrain, ReplayEngine, drive_simulated, synthetic_events
+from reporter import Reporter
+from scheduler import CountWheel, TimerWheel
+from train_driver import TrainDriver
+from util import Command, ColorSequence
+
+
+class _NullReporter(Reporter):
+    def logn(self, message: str):
+        pass
+
+    def log(self, message: str):
+        pass
+
+
+class _SlowReporter(Reporter):
+    """Blocks for a while on every message, like a console or a GUI under load"""
+
+    def __init__(self, delay: float):
+        self._delay = delay
+
+    def logn(self, message: str):
+        time.sleep(self._delay)
+
+    def log(self, message: str):
+        time.sleep(self._delay)
+
+
+def _poll_wait(driver: TrainDriver):
+    """The pre-event driver loop, kept here as the baseline"""
+    while driver._driving:
+        time.sleep(0.01)
+
+
+def _event_wait(driver: TrainDriver):
+    driver._wait_for_disconnect()
+
+
+def _idle_cpu(wait, drivers: int, seconds: float) -> (float, float):
+    """
+    Runs `drivers` idle connected drivers for `seconds` using the given wait strategy
+
+    Returns: (cpu seconds used per driver, worst disconnect acknowledgement in seconds)
+    """
+    instances = [TrainDriver() for _ in range(drivers)]
+    acknowledged = [0.0] * drivers
+
+    def run(i: int, driver: TrainDriver):
+        wait(driver)
+        acknowledged[i] = time.perf_counter()
+
+    threads = []
+    for i, driver in enumerate(instances):
+        driver._driving = True
+        driver._disconnect_event.clear()
+        threads.append(threading.Thread(target=run, args=(i, driver)))
+
+    cpu_start = time.process_time()
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    cpu_used = time.process_time() - cpu_start
+
+    disconnect_time = time.perf_counter()
+    for driver in instances:
+        driver.disconnect()
+    for t in threads:
+        t.join()
+
+    worst_ack = max(a - disconnect_time for a in acknowledged)
+    return cpu_used / drivers, worst_ack
+
+
+def bench_idle(args):
+    for name, wait in (("sleep poll (before)", _poll_wait), ("event wait (after)", _event_wait)):
+        cpu, ack = _idle_cpu(wait, args.drivers, args.seconds)
+        print(f"{name:20}: {cpu * 1000 / args.seconds:8.3f} ms cpu/s per driver, "
+              f"disconnect acknowledged in {ack * 1000:.3f} ms")
+
+
+def bench_dispatch(args):
+    driver = TrainDriver(_NullReporter())
+    driver.train = SimulatedTrain()
+    # The steps only run inside a script
+    skipped = (CommandId.CONNECT, CommandId.SCRIPT, CommandId.WAIT, CommandId.IF, CommandId.EVERY)
+    commands = [Command(cmd_id, 1) for cmd_id in CommandId if cmd_id not in skipped]
+    commands.append(CommandParser().parse("speed 2; next left; speed 3"))
+
+    for command in commands:
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            driver.execute(command)
+        elapsed = time.perf_counter() - start
+        print(f"{command.cmd_id.name:17}: {elapsed * 1e9 / args.iterations:8.0f} ns/command")
+
+
+def bench_parse(args):
+    lines = [
+        "start", "stop", "keep_left", "next right 2", "speed 3", "@train_1 reverse",
+        "program next_left 2 when red,green,blue", "program stop when yellow, magenta",
+    ] * (args.lines // 8)
+    parser = CommandParser()
+
+    start = time.perf_counter()
+    parsed = sum(1 for _ in parser.parse_lines(lines))
+    elapsed = time.perf_counter() - start
+    print(f"Parsed {parsed} lines in {elapsed * 1000:.1f} ms: {elapsed * 1e9 / parsed:.0f} ns/line")
+
+
+def bench_logging(args):
+    reporter = _SlowReporter(args.delay)
+    messages = [f"Split. Last: LEFT, Next: STRAIGHT ({i})" for i in range(args.messages)]
+
+    start = time.perf_counter()
+    for m in messages:
+        reporter.log(m)
+    direct = time.perf_counter() - start
+
+    pipeline = LogPipeline()
+    pipeline.add_reporter(reporter)
+    start = time.perf_counter()
+    for m in messages:
+        pipeline.submit(m)
+    queued = time.perf_counter() - start
+    pipeline.flush()
+
+    print(f"Direct fan-out: {direct * 1e6 / args.messages:10.1f} us/log on the caller's thread")
+    print(f"Log pipeline  : {queued * 1e6 / args.messages:10.1f} us/log on the caller's thread")
+
+
+def _connected_driver(train: SimulatedTrain) -> TrainDriver:
+    return drive_simulated(train, _NullReporter())
+
+
+def bench_replay(args):
+    train = SimulatedTrain(link_latency=args.link_latency)
+    driver = _connected_driver(train)
+    if args.predictive:
+        driver.set_predictive(True)
+    driver.program_command(CommandParser().parse("program next_left when red,green"))
+    driver.program_command(CommandParser().parse("program speed 3 when yellow,magenta,blue"))
+
+    stats = ReplayEngine(train, args.realtime).run(synthetic_events(args.laps))
+    driver.flush()
+    driver.disconnect()
+    print(stats)
+    print(f"Train writes: {train.writes}")
+    print(f"Link latency:\n{driver.link_latency}")
+
+
+# What each main.py frontend imports, and what main.py imported for all of them before
+_STARTUP_IMPORTS = {
+    "eager (before)": "import train_driver, key_controller, gui_key_controller",
+    "gui": "import main; import gui_key_controller, train_driver",
+    "keys": "import main; import key_controller, train_driver",
+    "headless": "import main; import train_driver, command_parser",
+    "replay": "import main; import simulation, train_driver, command_parser",
+}
+
+
+def _startup_seconds(code: str, runs: int) -> float:
+    """The median wall time of a fresh interpreter running the code"""
+    times = list()
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_startup(args):
+    baseline = _startup_seconds("pass", args.runs)
+    print(f"{'interpreter':15}: {baseline * 1000:8.1f} ms")
+    for name, code in _STARTUP_IMPORTS.items():
+        print(f"{name:15}: {(_startup_seconds(code, args.runs) - baseline) * 1000:8.1f} ms on top")
+
+
+def _server_client(port: int, batch: int, requests: int, latencies: list):
+    commands = ["speed 3", "next_left", "keep_right", "speed 2", "next_right 2"] * (batch // 5 + 1)
+    request = json.dumps({"commands": commands[:batch]}).encode() + b"\n"
+    with socket.create_connection(("127.0.0.1", port)) as connection:
+        responses = connection.makefile("rb")
+        for _ in range(requests):
+            start = time.perf_counter()
+            connection.sendall(request)
+            if not json.loads(responses.readline())["ok"]:
+                raise Exception("Request failed")
+            latencies.append(time.perf_counter() - start)
+
+
+def bench_server(args):
+    train = SimulatedTrain(link_latency=args.link_latency)
+    driver = _connected_driver(train)
+    server = ControlServer(driver, port=0)
+    server.start()
+
+    latencies = list()
+    clients = [threading.Thread(target=_server_client, args=(server.port, args.batch, args.requests, latencies))
+               for _ in range(args.clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    driver.flush()
+    server.stop()
+    driver.disconnect()
+
+    latencies.sort()
+    print(f"{server.commands_executed} commands from {args.clients} clients in {elapsed:.2f} s: "
+          f"{server.commands_executed / elapsed:.0f} commands/s")
+    print(f"Request latency: median {statistics.median(latencies) * 1000:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+    print(f"Train writes: {train.writes}")
+
+
+def bench_timers(args):
+    delays = [5 + (i % 1000) / 100 for i in range(args.timers)]
+
+    threads = delays[:args.threads]
+    start = time.perf_counter()
+    timers = [threading.Timer(delay, int) for delay in threads]
+    for timer in timers:
+        timer.start()
+    for timer in timers:
+        timer.cancel()
+    for timer in timers:
+        timer.join()
+    elapsed = time.perf_counter() - start
+    print(f"Thread per timer  : {elapsed * 1e6 / len(threads):8.2f} us to start and cancel a timer "
+          f"({len(threads)} timers)")
+
+    wheel = TimerWheel()
+    start = time.perf_counter()
+    timers = [wheel.schedule(delay, int) for delay in delays]
+    for timer in timers:
+        timer.cancel()
+    elapsed = time.perf_counter() - start
+    print(f"Timer wheel       : {elapsed * 1e6 / len(delays):8.2f} us to schedule and cancel a timer "
+          f"({len(delays)} timers)")
+
+    fired = list()
+    distance = CountWheel(wheel)
+    for i in range(args.timers):
+        distance.schedule(1 + i % 5000, fired.append, i)
+    start = time.perf_counter()
+    for cm in range(1, 5001):
+        distance.advance(cm)
+    elapsed = time.perf_counter() - start
+    wheel.stop()
+    print(f"Distance wheel    : {elapsed * 1e6 / 5000:8.2f} us per cm advanced, {args.timers} timers over 50 m")
+
+
+def bench_blocks(args):
+    blocks = BlockManager()
+    drivers = list()
+    for i in range(args.trains):
+        driver = TrainDriver(_NullReporter())
+        driver.train = SimulatedTrain(f"T{i}")
+        drivers.append(driver)
+    # A loop of twice as many blocks as trains, a block every 100 cm
+    count = 2 * args.trains
+    ids = [ColorSequence(SnapColorValue(code) for code in codes)
+           for codes in itertools.islice(itertools.product(range(1, 7), repeat=5), count)]
+    events = 0
+    start = time.perf_counter()
+    for lap in range(args.laps):
+        for step in range(count):
+            for i, driver in enumerate(drivers):
+                position = lap * count + step + 2 * i
+                driver.train.distance_cm = position * 100
+                blocks.boundary(driver, JunctionEvent(ids[position % count], JunctionMark.LEFT, False,
+                                                      driver.train.distance_cm, 3))
+                events += 1
+    elapsed = time.perf_counter() - start
+    print(f"{events} junction IDs of {args.trains} trains in {elapsed:.2f} s: {elapsed * 1e6 / events:.2f} us/event, "
+          f"{len(blocks.occupancy())} blocks occupied, {blocks.holds} holds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train driver benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    idle = subparsers.add_parser("idle", help="Idle CPU time per connected driver")
+    idle.add_argument("--drivers", type=int, default=8)
+    idle.add_argument("--seconds", type=float, default=5.0)
+    idle.set_defaults(func=bench_idle)
+
+    dispatch = subparsers.add_parser("dispatch", help="TrainDriver.execute latency per CommandId")
+    dispatch.add_argument("--iterations", type=int, default=100000)
+    dispatch.set_defaults(func=bench_dispatch)
+
+    parse = subparsers.add_parser("parse", help="Command parser throughput")
+    parse.add_argument("--lines", type=int, default=100000)
+    parse.set_defaults(func=bench_parse)
+
+    logging = subparsers.add_parser("logging", help="Caller latency of logging to a slow reporter")
+    logging.add_argument("--messages", type=int, default=1000)
+    logging.add_argument("--delay", type=float, default=0.001)
+    logging.set_defaults(func=bench_logging)
+
+    replay = subparsers.add_parser("replay", help="Driver callback throughput and latency on a simulated train")
+    replay.add_argument("--laps", type=int, default=1000)
+    replay.add_argument("--realtime", action="store_true")
+    replay.add_argument("--link-latency", type=float, default=0.0, help="Seconds per train command")
+    replay.add_argument("--predictive", action="store_true", help="Turn predictive steering on")
+    replay.set_defaults(func=bench_replay)
+
+    startup = subparsers.add_parser("startup", help="Import time of every main.py frontend")
+    startup.add_argument("--runs", type=int, default=10)
+    startup.set_defaults(func=bench_startup)
+
+    server = subparsers.add_parser("server", help="Control server throughput, many clients sending batches")
+    server.add_argument("--clients", type=int, default=8)
+    server.add_argument("--batch", type=int, default=100, help="Commands per request")
+    server.add_argument("--requests", type=int, default=200, help="Requests per client")
+    server.add_argument("--link-latency", type=float, default=0.0, help="Seconds per train command")
+    server.set_defaults(func=bench_server)
+
+    timers = subparsers.add_parser("timers", help="Timer wheel against a thread per timer")
+    timers.add_argument("--timers", type=int, default=100000)
+    timers.add_argument("--threads", type=int, default=2000, help="Timers for the thread per timer baseline")
+    timers.set_defaults(func=bench_timers)
+
+    blocks = subparsers.add_parser("blocks", help="Block signalling cost per junction ID, many trains on a loop")
+    blocks.add_argument("--trains", type=int, default=100)
+    blocks.add_argument("--laps", type=int, default=10)
+    blocks.set_defaults(func=bench_blocks)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Block signalling: keeps the trains of a fleet out of the track blocks other trains are in.
+
+A block is the track after a junction (or merge) with an ID, up to the next one, see junctions.py.
+Every driver reports the IDs it passes, so the manager knows the block of every train. It learns from the
+trains which block comes after which (by the first split decision in the block, if any) and how long a block is.
+When a train gets within stop_margin_cm of the end of its block and the next block is occupied, it is stopped,
+and it drives on at its speed when the block is free, the first one waiting first.
+
+Every train event is a few dictionary lookups under one lock, so it scales with the trains. The check at the end
+of a block is a distance timer of the driver, see scheduler.py. The manager only calls the drivers on the timer
+wheel thread: a driver reports to it while holding its own lock, and may not take the lock of another one.
+
+    blocks = BlockManager()
+    driver = TrainDriver(layout=layout, blocks=blocks)
+"""
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Tuple
+
+from intelino.trainlib_async.enums import SteeringDecision
+from enums import Speed
+from junctions import JunctionEvent
+from scheduler import Timer, TimerWheel, shared_wheel
+from util import ColorSequence
+
+
+class _Train:
+    __slots__ = ("driver", "block", "entered_cm", "decision", "learn", "reserved", "held_for", "resume_speed",
+                 "timer", "generation")
+
+    def __init__(self, driver):
+        self.driver = driver
+        # The block the train is in, a junction ID identity. None until it passed one
+        self.block: int = None
+        self.entered_cm: int = 0
+        # The first split decision in the block
+        self.decision: SteeringDecision = None
+        # False after a reverse, the next block is not the one after this one
+        self.learn = True
+        # The block kept for the train after it waited for it
+        self.reserved: int = None
+        self.held_for: int = None
+        self.resume_speed: Speed = None
+        # The check at the end of the block, and its generation, bumped when the check is cancelled
+        self.timer: Timer = None
+        self.generation = 0
+
+
+class BlockManager:
+    """The blocks of one layout, shared by the drivers of the trains on it"""
+
+    def __init__(self, stop_margin_cm: float = 15.0, wheel: TimerWheel = None):
+        """
+        Args:
+            stop_margin_cm: How far before the end of a block a train checks the next one,
+                            that is the braking distance and the odometer error
+            wheel: The timer wheel the drivers are called on, the shared one if None
+        """
+        self.stop_margin_cm = stop_margin_cm
+        self._wheel = wheel if wheel is not None else shared_wheel()
+        self._lock = threading.Lock()
+        self._trains: Dict[str, _Train] = dict()
+        # Block -> the train id in it or that waited for it
+        self._occupants: Dict[int, str] = dict()
+        # Block -> the trains stopped before it, in order
+        self._waiting: Dict[int, Deque[_Train]] = dict()
+        # (block, first split decision or None) -> the next block, and the latest one by block
+        self._next: Dict[Tuple[int, SteeringDecision], int] = dict()
+        self._likely_next: Dict[int, int] = dict()
+        # (block, next block) -> the average length in cm and the observations
+        self._lengths: Dict[Tuple[int, int], Tuple[float, int]] = dict()
+        self.holds = 0
+        self.conflicts = 0
+
+    def occupancy(self) -> Dict[str, str]:
+        """The train id in every occupied block, by block ID"""
+        with self._lock:
+            return {str(ColorSequence.from_identity(block)): train_id
+                    for block, train_id in self._occupants.items()}
+
+    def block_of(self, train_id: str) -> ColorSequence:
+        """The block ID the train is in, None if it has not passed a junction ID yet"""
+        with self._lock:
+            train = self._trains.get(train_id)
+            block = train.block if train is not None else None
+        return ColorSequence.from_identity(block) if block is not None else None
+
+    def boundary(self, driver, event: JunctionEvent):
+        """The train passed a junction ID, so it left its block for the next one. From the driver"""
+        block = event.junction_id.identity()
+        actions: List[Callable] = list()
+        with self._lock:
+            train = self._train(driver)
+            if train.block == block:
+                return
+            self._cancel_check(train)
+            if train.block is not None and train.learn:
+                self._observe(train, block, event.distance_cm)
+            if train.reserved == block:
+                # The block it waited for, it keeps it
+                train.reserved = None
+            self._leave(train, actions)
+            train.block = block
+            train.entered_cm = event.distance_cm
+            train.decision = None
+            train.learn = True
+            occupant = self._occupants.get(block)
+            if occupant is None or occupant == driver.train.id:
+                self._occupants[block] = driver.train.id
+                self._arm(train, actions)
+            else:
+                # A block that was not known to be next, or a train that did not stop in time
+                self.conflicts += 1
+                actions.append(lambda: driver.log(f"Block {event.junction_id} is occupied by {occupant}"))
+                self._hold(train, block, actions)
+        self._run(actions)
+
+    def split(self, driver, decision: SteeringDecision):
+        """The train took a split. The first one in a block tells which block comes next. From the driver"""
+        actions: List[Callable] = list()
+        with self._lock:
+            train = self._train(driver)
+            if train.block is None or train.decision is not None:
+                return
+            train.decision = decision
+            if train.held_for is None:
+                self._cancel_check(train)
+                self._arm(train, actions)
+        self._run(actions)
+
+    def direction_change(self, driver):
+        """The next junction ID is the one the train came from, its block stays occupied"""
+        with self._lock:
+            train = self._train(driver)
+            self._cancel_check(train)
+            train.decision = None
+            train.learn = False
+
+    def remove(self, driver):
+        """Frees the block of a train, e.g. when it disconnects"""
+        actions: List[Callable] = list()
+        with self._lock:
+            train = self._trains.pop(driver.train.id, None)
+            if train is None:
+                return
+            self._cancel_check(train)
+            self._leave(train, actions)
+        self._run(actions)
+
+    def _train(self, driver) -> _Train:
+        train = self._trains.get(driver.train.id)
+        if train is None:
+            train = self._trains[driver.train.id] = _Train(driver)
+        return train
+
+    def _observe(self, train: _Train, block: int, distance_cm: int):
+        self._next[(train.block, train.decision)] = block
+        self._likely_next[train.block] = block
+        key = (train.block, block)
+        length, observations = self._lengths.get(key, (0.0, 0))
+        observations += 1
+        length += (abs(distance_cm - train.entered_cm) - length) / observations
+        self._lengths[key] = (length, observations)
+
+    def _leave(self, train: _Train, actions: List[Callable]):
+        """Frees the block and the reserved block of a train that left them. Under the lock"""
+        if train.held_for is not None:
+            waiting = self._waiting.get(train.held_for)
+            if waiting is not None and train in waiting:
+                waiting.remove(train)
+            train.held_for = None
+        for block in (train.block, train.reserved):
+            if block is not None and self._occupants.get(block) == train.driver.train.id:
+                del self._occupants[block]
+                self._free(block, actions)
+        train.block = None
+        train.reserved = None
+
+    def _free(self, block: int, actions: List[Callable]):
+        """The first train waiting for the block gets it. Under the lock"""
+        waiting = self._waiting.get(block)
+        if not waiting:
+            return
+        train = waiting.popleft()
+        if len(waiting) == 0:
+            del self._waiting[block]
+        train.held_for = None
+        self._occupants[block] = train.driver.train.id
+        if train.block != block:
+            train.reserved = block
+        speed = train.resume_speed
+        driver = train.driver
+        actions.append(lambda: self._resume(driver, speed, block))
+
+    @staticmethod
+    def _resume(driver, speed: Speed, block: int):
+        driver.log(f"Block {ColorSequence.from_identity(block)} is free")
+        # Only if nothing else changed the speed meanwhile
+        if speed is not None and speed != Speed.ZERO:
+            driver.set_speed_if(Speed.ZERO, speed)
+
+    def _arm(self, train: _Train, actions: List[Callable]):
+        """Schedules the check of the next block, at the stop margin before it. Under the lock"""
+        block = train.block
+        following = self._next.get((block, train.decision))
+        if following is None:
+            following = self._likely_next.get(block)
+        if following is None:
+            return
+        length, _ = self._lengths[(block, following)]
+        check_cm = train.entered_cm + length - self.stop_margin_cm
+        if check_cm <= train.driver.train.distance_cm:
+            self._check(train, following, actions)
+        else:
+            generation = train.generation
+            actions.append(lambda: self._schedule_check(train, generation, following, check_cm))
+
+    def _schedule_check(self, train: _Train, generation: int, following: int, check_cm: float):
+        timer = train.driver.at_distance(check_cm, self._on_check, train, generation, following)
+        with self._lock:
+            if train.generation == generation:
+                train.timer = timer
+                return
+        # Cancelled meanwhile, e.g. the train left the block
+        timer.cancel()
+
+    def _on_check(self, train: _Train, generation: int, following: int):
+        actions: List[Callable] = list()
+        with self._lock:
+            if train.generation == generation:
+                train.timer = None
+                self._check(train, following, actions)
+        self._run(actions)
+
+    def _check(self, train: _Train, following: int, actions: List[Callable]):
+        """Stops the train if the next block is occupied. Under the lock"""
+        occupant = self._occupants.get(following)
+        if occupant is None or occupant == train.driver.train.id or train.held_for is not None:
+            return
+        driver = train.driver
+        actions.append(lambda: driver.log(f"Block {ColorSequence.from_identity(following)} ahead is occupied "
+                                          f"by {occupant}"))
+        self._hold(train, following, actions)
+
+    def _hold(self, train: _Train, block: int, actions: List[Callable]):
+        """Stops the train until the block is free. Under the lock"""
+        self.holds += 1
+        self._cancel_check(train)
+        train.held_for = block
+        train.resume_speed = train.driver.state.speed_level
+        self._waiting.setdefault(block, deque()).append(train)
+        actions.append(train.driver.stop)
+
+    def _cancel_check(self, train: _Train):
+        train.generation += 1
+        if train.timer is not None:
+            train.timer.cancel()
+            train.timer = None
+
+    def _run(self, actions: List[Callable]):
+        if len(actions) > 0:
+            self._wheel.call_soon(_run_all, actions)
+
+
+def _run_all(actions: List[Callable]):
+    for action in actions:
+        action()
@@ -0,0 +1,271 @@
+"""
+Per train calibration, fitted from telemetry recordings.
+
+The speed levels, the latency and the snap spacing differ from train to train (motor, battery, wheels),
+and the driver uses them to decide how fast it can go before a split. The fit is done in bulk with NumPy:
+
+  - cm/s per speed level: the slope of distance over time between two speed commands,
+    after the ramp settled, by least squares for every stretch and averaged per level
+  - latency: from a speed command to the train speed changing, halfway between the last event
+    with the old speed and the first one with a new speed
+  - snap gap: the distance between two colours of the same sequence
+
+The table is a JSON file with a calibration per train id, so the driver needs no NumPy to load it:
+
+    $ python3 src/main.py calibrate run.bin --output calibration.json
+    $ python3 src/main.py headless --calibration calibration.json
+"""
+import json
+import os
+from typing import Dict, Iterator
+
+from intelino.trainlib.enums import SnapColorValue as C, ColorSensor
+from enums import Speed
+from telemetry import TelemetryEvent, TelemetryReader
+
+
+class TrainCalibration:
+    __slots__ = ("train_id", "level_cmps", "latency_s", "snap_gap_cm", "snap_gap_p95_cm", "samples")
+
+    def __init__(self, train_id: str, level_cmps: Dict[int, float] = None, latency_s: float = None,
+                 snap_gap_cm: float = None, snap_gap_p95_cm: float = None, samples: Dict[str, int] = None):
+        """
+        Args:
+            train_id: The train the calibration is for
+            level_cmps: The actual cm/s by speed level value. The levels that were not fitted are left out
+            latency_s: The median seconds from a speed command to the train reacting. None if not fitted
+            snap_gap_cm: The median distance between two colours of a sequence. None if not fitted
+            snap_gap_p95_cm: The 95th percentile of the distance between two colours of a sequence
+            samples: How many stretches, commands and gaps the values were fitted from
+        """
+        self.train_id = train_id
+        self.level_cmps: Dict[int, float] = dict(level_cmps) if level_cmps is not None else dict()
+        self.latency_s = latency_s
+        self.snap_gap_cm = snap_gap_cm
+        self.snap_gap_p95_cm = snap_gap_p95_cm
+        self.samples: Dict[str, int] = dict(samples) if samples is not None else dict()
+
+    def speed(self, level: Speed) -> float:
+        """The actual cm/s of a speed level, the nominal one if it was not fitted"""
+        return self.level_cmps.get(level.value, level.speed)
+
+    def level_speeds(self) -> Dict[Speed, float]:
+        """The actual cm/s of every speed level"""
+        return {level: self.speed(level) for level in Speed}
+
+    def to_dict(self) -> dict:
+        return {
+            "level_cmps": {str(level): cmps for level, cmps in sorted(self.level_cmps.items())},
+            "latency_s": self.latency_s,
+            "snap_gap_cm": self.snap_gap_cm,
+            "snap_gap_p95_cm": self.snap_gap_p95_cm,
+            "samples": self.samples,
+        }
+
+    @staticmethod
+    def from_dict(train_id: str, values: dict) -> "TrainCalibration":
+        return TrainCalibration(train_id,
+                                {int(level): cmps for level, cmps in values.get("level_cmps", dict()).items()},
+                                values.get("latency_s"), values.get("snap_gap_cm"), values.get("snap_gap_p95_cm"),
+                                values.get("samples"))
+
+    def __str__(self):
+        speeds = ", ".join(f"{Speed(level).name} {cmps:.1f}" for level, cmps in sorted(self.level_cmps.items()))
+        latency = f"{self.latency_s * 1000:.0f} ms" if self.latency_s is not None else "-"
+        gap = f"{self.snap_gap_cm:.1f} cm" if self.snap_gap_cm is not None else "-"
+        return f"{self.train_id}: cm/s {speeds or '-'}, latency {latency}, snap gap {gap}"
+
+
+class CalibrationTable:
+    """The calibrations by train id, in a JSON file"""
+
+    def __init__(self, path: str = None):
+        """
+        Args:
+            path: The JSON file. Loaded if it exists
+        """
+        self.path = path
+        self._calibrations: Dict[str, TrainCalibration] = dict()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for train_id, values in json.load(f).items():
+                    self._calibrations[train_id] = TrainCalibration.from_dict(train_id, values)
+
+    def get(self, train_id: str) -> TrainCalibration:
+        """The calibration of a train or None"""
+        return self._calibrations.get(train_id)
+
+    def put(self, calibration: TrainCalibration):
+        self._calibrations[calibration.train_id] = calibration
+
+    def __iter__(self) -> Iterator[TrainCalibration]:
+        return iter(self._calibrations.values())
+
+    def __len__(self):
+        return len(self._calibrations)
+
+    def save(self, path: str = None):
+        """Writes the table to a temporary file and renames it, so a driver never loads half a table"""
+        path = path if path is not None else self.path
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({c.train_id: c.to_dict() for c in self._calibrations.values()}, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def _level_changes(records):
+    """The level changes, from the COMMAND records the driver writes on every speed change: (timestamps, levels)"""
+    import numpy as np
+
+    commands = records[records["event"] == TelemetryEvent.COMMAND]
+    levels = commands["level"].astype(np.int64)
+    changed = np.ones(len(levels), dtype=bool)
+    changed[1:] = levels[1:] != levels[:-1]
+    return commands["timestamp"][changed], levels[changed]
+
+
+def _motion(records):
+    """The records that report the distance and the speed as the train moves"""
+    return records[(records["event"] == TelemetryEvent.COLOR) | (records["event"] == TelemetryEvent.SPLIT)]
+
+
+def fit_level_speeds(records, settle_s: float = 1.0, min_points: int = 3) -> (Dict[int, float], int):
+    """
+    Args:
+        records: The telemetry records of one train, by time
+        settle_s: Seconds after a speed command that are left out, while the speed ramps
+        min_points: The fewest events a stretch between two commands is fitted from
+
+    Returns: (cm/s by speed level value, the stretches fitted)
+    """
+    import numpy as np
+
+    starts, levels = _level_changes(records)
+    motion = _motion(records)
+    if len(starts) == 0 or len(motion) == 0:
+        return dict(), 0
+
+    t = motion["timestamp"]
+    stretch = np.searchsorted(starts, t, side="right") - 1
+    keep = (stretch >= 0) & (t >= starts[stretch.clip(0)] + settle_s)
+    stretch = stretch[keep]
+    # Relative to the start of the stretch, the epoch seconds and the odometer would eat the float precision
+    t = t[keep] - starts[stretch]
+    d = motion["distance_cm"][keep].astype(np.float64)
+    if len(d) > 0:
+        stretches, first = np.unique(stretch, return_index=True)
+        origin = np.zeros(len(starts))
+        origin[stretches] = d[first]
+        d -= origin[stretch]
+
+    # Least squares slope of every stretch at once: (n Σtd - Σt Σd) / (n Σt² - (Σt)²)
+    count = len(starts)
+    n = np.bincount(stretch, minlength=count)
+    st = np.bincount(stretch, t, count)
+    sd = np.bincount(stretch, d, count)
+    stt = np.bincount(stretch, t * t, count)
+    std = np.bincount(stretch, t * d, count)
+    denominator = n * stt - st * st
+    fitted = (n >= min_points) & (denominator > 1e-9) & (levels > 0)
+    slopes = np.abs((n * std - st * sd)[fitted] / denominator[fitted])
+    weights = n[fitted]
+    fitted_levels = levels[fitted]
+
+    result = dict()
+    for level in np.unique(fitted_levels):
+        mask = fitted_levels == level
+        result[int(level)] = float(np.average(slopes[mask], weights=weights[mask]))
+    return result, int(fitted.sum())
+
+
+def fit_latency(records, tolerance_cmps: float = 1.0, max_s: float = 2.0) -> (float, int):
+    """
+    Args:
+        records: The telemetry records of one train, by time
+        tolerance_cmps: The speed difference between two events that counts as a change
+        max_s: Longer delays are not reactions to the command, e.g. no event came meanwhile
+
+    Returns: (the median seconds from a speed command to the speed changing or None, the commands measured)
+    """
+    import numpy as np
+
+    starts, _ = _level_changes(records)
+    motion = _motion(records)
+    if len(starts) == 0 or len(motion) < 2:
+        return None, 0
+
+    t = motion["timestamp"]
+    v = motion["speed_cmps"].astype(np.float64)
+    changed = np.zeros(len(v), dtype=bool)
+    changed[1:] = np.abs(np.diff(v)) > tolerance_cmps
+    # The index of the first change at or after every event, len(v) if none
+    indexes = np.where(changed, np.arange(len(v)), len(v))
+    next_change = np.append(np.minimum.accumulate(indexes[::-1])[::-1], len(v))
+
+    first = np.searchsorted(t, starts, side="right")
+    reaction = next_change[first]
+    found = reaction < len(v)
+    reaction = reaction[found]
+    starts = starts[found]
+    # The train reacted between the event before the change (or the command) and the change
+    before = np.maximum(t[np.maximum(reaction - 1, 0)], starts)
+    delays = (before + t[reaction]) / 2 - starts
+    delays = delays[delays <= max_s]
+    if len(delays) == 0:
+        return None, 0
+    return float(np.median(delays)), len(delays)
+
+
+def fit_snap_gap(records, max_gap_cm: float = 20.0) -> (float, float, int):
+    """
+    Args:
+        records: The telemetry records of one train, by time
+        max_gap_cm: Longer gaps are not within a sequence
+
+    Returns: (the median gap or None, the 95th percentile gap or None, the gaps measured)
+    """
+    import numpy as np
+
+    colors = records[(records["event"] == TelemetryEvent.COLOR) & (records["sensor"] == ColorSensor.FRONT)]
+    if len(colors) < 2:
+        return None, None, 0
+    color = colors["color"]
+    gaps = np.abs(np.diff(colors["distance_cm"].astype(np.float64)))
+    # Two colours of the same sequence, the black ends it
+    within = (color[:-1] != int(C.BLACK)) & (color[1:] != int(C.BLACK)) & (gaps <= max_gap_cm)
+    gaps = gaps[within]
+    if len(gaps) == 0:
+        return None, None, 0
+    return float(np.median(gaps)), float(np.percentile(gaps, 95)), len(gaps)
+
+
+def calibrate(records, train_id: str, settle_s: float = 1.0) -> TrainCalibration:
+    """Fits the calibration of a train from its telemetry records"""
+    import numpy as np
+
+    records = records[np.argsort(records["timestamp"], kind="stable")]
+    level_cmps, stretches = fit_level_speeds(records, settle_s)
+    latency_s, commands = fit_latency(records)
+    snap_gap_cm, snap_gap_p95_cm, gaps = fit_snap_gap(records)
+    return TrainCalibration(train_id, level_cmps, latency_s, snap_gap_cm, snap_gap_p95_cm,
+                            {"stretches": stretches, "commands": commands, "gaps": gaps})
+
+
+def calibrate_recording(reader: TelemetryReader, table: CalibrationTable = None,
+                        settle_s: float = 1.0) -> CalibrationTable:
+    """
+    Fits every train of a recording.
+
+    Args:
+        reader: The recording
+        table: The table the calibrations go to, replacing the ones of the same trains. A new one if None
+        settle_s: Seconds after a speed command that are left out of the speed fit
+
+    Returns: The table
+    """
+    table = table if table is not None else CalibrationTable()
+    for index, train_id in enumerate(reader.train_ids):
+        records = reader.records[reader.records["train"] == index]
+        if len(records) > 0:
+            table.put(calibrate(records, train_id, settle_s))
+    return table
@@ -0,0 +1,99 @@
+from enum import Enum
+from typing import Iterable
+
+from intelino.trainlib.enums import SnapColorValue as C
+from enums import JunctionMark
+from util import ColorSequence
+
+
+class SnapMatch(Enum):
+    """What a matched color sequence stands for"""
+    JUNCTION_MARK = 0
+    MERGE_MARK = 1
+    PROGRAM = 2
+
+
+# The marks the track pieces have, (sequence, kind, direction)
+TRACK_MARKS = (
+    ((C.CYAN, C.RED), SnapMatch.JUNCTION_MARK, JunctionMark.LEFT),
+    ((C.CYAN, C.BLUE), SnapMatch.JUNCTION_MARK, JunctionMark.RIGHT),
+    ((C.RED, C.CYAN), SnapMatch.MERGE_MARK, JunctionMark.RIGHT),
+    ((C.BLUE, C.CYAN), SnapMatch.MERGE_MARK, JunctionMark.LEFT),
+)
+
+
+def _codes(seq: Iterable[C]):
+    return seq.codes() if isinstance(seq, ColorSequence) else map(int, seq)
+
+
+class ColorSequenceMatcher:
+    """
+    A trie over the snap colors, compiled into a flat transition table.
+
+    It is advanced one color at a time as the sensor reports them, so when the terminating
+    black arrives the match is already known: no sequence copying, no string building.
+    A prefix that no sequence starts with, drops to a dead state and stays there until reset.
+    """
+
+    _WIDTH = 16  # Colors are 4 bits, including the UNKNOWN
+    _DEAD = -1
+
+    def __init__(self):
+        # States are stored as their offset in the table, the root is at 0
+        self._transitions: list = [ColorSequenceMatcher._DEAD] * ColorSequenceMatcher._WIDTH
+        self._payloads: list = [None]
+        self._state: int = 0
+
+    def add(self, seq: Iterable[C], payload):
+        """Adds a sequence, replacing the payload of the same sequence if there is one"""
+        state = 0
+        for color in _codes(seq):
+            index = state + color
+            next_state = self._transitions[index]
+            if next_state == ColorSequenceMatcher._DEAD:
+                next_state = len(self._transitions)
+                self._transitions.extend([ColorSequenceMatcher._DEAD] * ColorSequenceMatcher._WIDTH)
+                self._payloads.append(None)
+                self._transitions[index] = next_state
+            state = next_state
+        self._payloads[state // ColorSequenceMatcher._WIDTH] = payload
+
+    def get(self, seq: Iterable[C]):
+        """Returns: The payload of the sequence, or None if there is no such sequence"""
+        state = 0
+        for color in _codes(seq):
+            state = self._transitions[state + color]
+            if state == ColorSequenceMatcher._DEAD:
+                return None
+        return self._payloads[state // ColorSequenceMatcher._WIDTH]
+
+    def advance(self, color: C):
+        if self._state != ColorSequenceMatcher._DEAD:
+            self._state = self._transitions[self._state + color]
+
+    def is_dead(self) -> bool:
+        """True when no sequence starts with the colors seen since the last reset"""
+        return self._state == ColorSequenceMatcher._DEAD
+
+    def match(self):
+        """
+        Ends the current sequence and resets the matcher.
+
+        Returns: The payload of the sequence, or None if there is no such sequence
+        """
+        state = self._state
+        self._state = 0
+        if state == ColorSequenceMatcher._DEAD:
+            return None
+        return self._payloads[state // ColorSequenceMatcher._WIDTH]
+
+    def reset(self):
+        self._state = 0
+
+
+def new_snap_matcher() -> ColorSequenceMatcher:
+    """A matcher that already knows the junction and merge marks"""
+    matcher = ColorSequenceMatcher()
+    for seq, kind, direction in TRACK_MARKS:
+        matcher.add(seq, (kind, direction))
+    return matcher
@@ -0,0 +1,296 @@
+"""
+The text command grammar, shared by all the controllers and usable from scripts:
+
+    [@train] COMMAND [N]
+    [@train] route color1,color2,...
+    [@train] layout NAME
+    [@train] program COMMAND [N] when color1,color2,...
+    [@train] STEP; STEP; ...
+    [@train] program STEP; STEP; ... when color1,color2,...
+
+A STEP is a COMMAND [N], or one of the steps that only make sense in a multi-step command:
+
+    wait N s|ms|cm|splits       Time, distance or the splits passed
+    if speed|junctions|runs OP N  Goes on only if true. OP is one of < <= > >= == !=.
+                                junctions counts the junction marks passed, runs the times the program ran
+    if direction forward|backward
+    every N                     Goes on only every Nth time the program runs
+
+COMMAND words can be separated by spaces or underscores, e.g. "keep left" or "keep_left".
+Empty lines and lines starting with # are skipped in scripts.
+"""
+import re
+from typing import Iterable, Iterator, Union
+
+from intelino.trainlib.enums import SnapColorValue
+from enums import CommandId
+from util import Command, CommandFormatException, ColorSequence, Program, Script
+
+# The argument a command takes after its words
+_NO_ARG = 0
+_INT_ARG = 1
+_OPTIONAL_INT_ARG = 2
+_COLORS_ARG = 3
+_WORD_ARG = 4
+
+# Command words -> (command id, argument)
+_TOKENS = {
+    ("connect",): (CommandId.CONNECT, _NO_ARG),
+    ("disconnect",): (CommandId.DISCONNECT, _NO_ARG),
+    ("quit",): (CommandId.EXIT, _NO_ARG),
+    ("exit",): (CommandId.EXIT, _NO_ARG),
+    ("start",): (CommandId.START, _NO_ARG),
+    ("stop",): (CommandId.STOP, _NO_ARG),
+    ("keep", "straight"): (CommandId.KEEP_STRAIGHT, _NO_ARG),
+    ("keep", "left"): (CommandId.KEEP_LEFT, _NO_ARG),
+    ("keep", "right"): (CommandId.KEEP_RIGHT, _NO_ARG),
+    ("next", "straight"): (CommandId.NEXT_STRAIGHT, _OPTIONAL_INT_ARG),
+    ("next", "left"): (CommandId.NEXT_LEFT, _OPTIONAL_INT_ARG),
+    ("next", "right"): (CommandId.NEXT_RIGHT, _OPTIONAL_INT_ARG),
+    ("snaps", "follow"): (CommandId.SNAPS_FOLLOW, _NO_ARG),
+    ("snaps", "ignore"): (CommandId.SNAPS_IGNORE, _NO_ARG),
+    ("speed", "slow"): (CommandId.SPEED_SLOW, _NO_ARG),
+    ("speed", "medium"): (CommandId.SPEED_MEDIUM, _NO_ARG),
+    ("speed", "fast"): (CommandId.SPEED_FAST, _NO_ARG),
+    ("speed",): (CommandId.SPEED_FINE, _INT_ARG),
+    ("reverse",): (CommandId.REVERSE, _NO_ARG),
+    ("reverse", "gently"): (CommandId.REVERSE, _NO_ARG),
+    ("reverse", "now"): (CommandId.REVERSE_NOW, _NO_ARG),
+    ("forward",): (CommandId.FORWARD, _NO_ARG),
+    ("backward",): (CommandId.BACKWARD, _NO_ARG),
+    ("backwards",): (CommandId.BACKWARD, _NO_ARG),
+    ("route",): (CommandId.ROUTE, _COLORS_ARG),
+    ("metrics",): (CommandId.METRICS, _NO_ARG),
+    ("layout",): (CommandId.LAYOUT, _WORD_ARG),
+    ("ramp",): (CommandId.RAMP, _WORD_ARG),
+}
+
+# The words that start a step of a multi-step command
+_STEP_WORDS = ("wait", "if", "every")
+_WAIT_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)(s|sec|secs|second|seconds|ms|cm|split|splits)$")
+_CONDITION_TOKENS = re.compile(r"[a-z]+|\d+|[<>=!]+")
+_OPERATORS = {"<": "<", "<=": "<=", ">": ">", ">=": ">=", "==": "==", "=": "==", "!=": "!="}
+_SUBJECTS = ("speed", "junctions", "runs")
+_DIRECTIONS = ("forward", "backward")
+
+# A snap cannot connect a train, and the connect callbacks cannot be saved in a program store
+_NOT_PROGRAMMABLE = (CommandId.CONNECT, CommandId.DISCONNECT)
+
+_USAGE = {
+    CommandId.SPEED_FINE: "speed 1|2|3|4|5",
+    CommandId.NEXT_STRAIGHT: "next_straight [count]",
+    CommandId.NEXT_LEFT: "next_left [count]",
+    CommandId.NEXT_RIGHT: "next_right [count]",
+    CommandId.WAIT: "wait N s|ms|cm|splits",
+    CommandId.IF: "if speed|junctions|runs <|<=|>|>=|==|!= N, or if direction forward|backward",
+    CommandId.EVERY: "every N",
+}
+
+
+def _normalise(words: list) -> list:
+    """Splits the command words on underscores, "keep_left" is "keep left", but not the name a command takes"""
+    result = list()
+    keep_next = False
+    # Whether the word starts a command: the first one, after "program" or after a ";"
+    start = True
+    for word in words:
+        if keep_next:
+            result.append(word)
+            keep_next = False
+            start = word.endswith(";")
+            continue
+        parts = word.replace("_", " ").split()
+        if len(parts) == 0:
+            continue
+        result.extend(parts)
+        entry = _TOKENS.get((parts[0],))
+        keep_next = start and len(parts) == 1 and entry is not None and entry[1] == _WORD_ARG
+        start = parts[-1] == "program" or word.endswith(";")
+    return result
+
+
+class CommandParser:
+    """
+    Parses text into Command and Program objects.
+
+    Args:
+        callback_target: An object with connect_callback and disconnect_callback methods.
+                         They become the arguments of the "connect" command.
+    """
+
+    def __init__(self, callback_target=None):
+        self._callback_target = callback_target
+
+    def parse(self, text: str) -> Union[Command, Program]:
+        """
+        Parses a command or a program in a single pass over the words
+
+        Raises: CommandFormatException
+        """
+        words = text.lower().split()
+        if len(words) == 0:
+            raise CommandFormatException("Empty command")
+
+        target = None
+        if words[0].startswith("@"):
+            target = words[0][1:]
+            words = words[1:]
+            if len(words) == 0 or target == "":
+                raise CommandFormatException(f"Malformed train target: {text}")
+        if "_" in text:
+            words = _normalise(words)
+
+        has_steps = ";" in text
+        if words[0] != "program":
+            return self._to_command_or_script(words, target, has_steps)
+
+        if "when" not in words:
+            raise CommandFormatException("Malformed program. Usage: program COMMAND when color1,color2,...")
+        when = words.index("when")
+        if when == 1:
+            raise CommandFormatException("Malformed program. Usage: program COMMAND when color1,color2,...")
+        command = self._to_command_or_script(words[1:when], target, has_steps)
+        steps = command.args[0].steps if command.cmd_id == CommandId.SCRIPT else (command, )
+        if any(step.cmd_id in _NOT_PROGRAMMABLE for step in steps):
+            raise CommandFormatException("A program cannot connect or disconnect the train")
+        seq_text = "".join(words[when + 1:])
+        seq = ColorSequence.from_string_csv(seq_text)
+        if len(seq) == 0:
+            raise CommandFormatException("A program needs at least one color")
+        if SnapColorValue.BLACK in seq:
+            # The black ends a sequence, it is never part of one
+            raise CommandFormatException("A program cannot have black in its colors")
+        return Program(seq, command)
+
+    def parse_command(self, text: str) -> Command:
+        """Same as parse, but programs are not allowed"""
+        parsed = self.parse(text)
+        if isinstance(parsed, Program):
+            raise CommandFormatException(f"Expected a command, not a program: {text}")
+        return parsed
+
+    def parse_lines(self, lines: Iterable[str]) -> Iterator[Union[Command, Program]]:
+        """Parses a script line by line, skipping empty lines and # comments"""
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            try:
+                yield self.parse(line)
+            except CommandFormatException as e:
+                raise CommandFormatException(f"Line {number}: {e}")
+
+    def parse_file(self, path: str) -> Iterator[Union[Command, Program]]:
+        with open(path) as f:
+            yield from self.parse_lines(f)
+
+    def _to_command_or_script(self, words: list, target: str, has_steps: bool) -> Command:
+        """A command, or a SCRIPT command if there are steps (separated by ;)"""
+        if not has_steps and words[0] not in _STEP_WORDS:
+            return self._to_command(words, target)
+
+        text = " ".join(words)
+        steps = list()
+        sources = list()
+        for part in text.split(";"):
+            step_words = part.split()
+            if len(step_words) == 0:
+                continue
+            steps.append(self._to_step(step_words))
+            sources.append(" ".join(step_words))
+        if len(steps) == 0:
+            raise CommandFormatException("Empty command")
+        if len(steps) == 1 and steps[0].cmd_id not in (CommandId.WAIT, CommandId.IF, CommandId.EVERY):
+            # "speed 2;" is just a command
+            return Command(steps[0].cmd_id, *steps[0].args, target=target)
+        return Command(CommandId.SCRIPT, Script(steps, "; ".join(sources)), target=target)
+
+    def _to_step(self, words: list) -> Command:
+        if words[0] == "wait":
+            match = _WAIT_PATTERN.match("".join(words[1:]))
+            if match is None:
+                raise CommandFormatException(f"Malformed step. Usage: {_USAGE[CommandId.WAIT]}")
+            amount, unit = float(match.group(1)), match.group(2)
+            if unit == "ms":
+                return Command(CommandId.WAIT, amount / 1000, "s")
+            if unit.startswith("split"):
+                if not amount.is_integer() or amount == 0:
+                    raise CommandFormatException(f"Malformed step. Usage: {_USAGE[CommandId.WAIT]}")
+                return Command(CommandId.WAIT, int(amount), "splits")
+            return Command(CommandId.WAIT, amount, "cm" if unit == "cm" else "s")
+        if words[0] == "if":
+            return Command(CommandId.IF, *self._to_condition(words[1:]))
+        if words[0] == "every":
+            if len(words) != 2 or not words[1].isdecimal() or int(words[1]) == 0:
+                raise CommandFormatException(f"Malformed step. Usage: {_USAGE[CommandId.EVERY]}")
+            return Command(CommandId.EVERY, int(words[1]))
+        if words[0] == "program":
+            raise CommandFormatException("A program step cannot add a program")
+        return self._to_command(words, None)
+
+    @staticmethod
+    def _to_condition(words: list) -> tuple:
+        """Returns: (subject, operator, value)"""
+        tokens = _CONDITION_TOKENS.findall(" ".join(words))
+        if len(tokens) == 2 and tokens[0] == "direction" and tokens[1] in _DIRECTIONS:
+            return "direction", "==", tokens[1]
+        if len(tokens) == 3 and tokens[0] == "direction" and tokens[1] in ("==", "=", "!=") \
+                and tokens[2] in _DIRECTIONS:
+            return "direction", _OPERATORS[tokens[1]], tokens[2]
+        if len(tokens) == 3 and tokens[0] in _SUBJECTS and tokens[1] in _OPERATORS and tokens[2].isdecimal():
+            return tokens[0], _OPERATORS[tokens[1]], int(tokens[2])
+        raise CommandFormatException(f"Malformed condition. Usage: {_USAGE[CommandId.IF]}")
+
+    def _to_command(self, words: list, target: str) -> Command:
+        first = _TOKENS.get(tuple(words[:1]))
+        if first is not None and first[1] == _COLORS_ARG:
+            if len(words) < 2:
+                raise CommandFormatException(f"Malformed command. Usage: {words[0]} color1,color2,...")
+            return Command(first[0], ColorSequence.from_string_csv("".join(words[1:])), target=target)
+        if first is not None and first[1] == _WORD_ARG:
+            if len(words) != 2:
+                raise CommandFormatException(f"Malformed command. Usage: {words[0]} NAME")
+            return Command(first[0], words[1], target=target)
+
+        key = tuple(words)
+        entry = _TOKENS.get(key)
+        arg = None
+        if entry is None and len(key) > 1:
+            entry = _TOKENS.get(key[:-1])
+            arg = key[-1]
+            if entry is not None and entry[1] == _NO_ARG:
+                entry = None
+        if entry is None:
+            raise CommandFormatException(f"Command not recognised: {' '.join(words)}")
+
+        cmd_id, arg_kind = entry
+        if arg is None:
+            if arg_kind == _INT_ARG:
+                raise CommandFormatException(f"Malformed command. Usage: {_USAGE[cmd_id]}")
+            if cmd_id == CommandId.CONNECT and self._callback_target is not None:
+                return Command(cmd_id, self._callback_target.connect_callback,
+                               self._callback_target.disconnect_callback, target=target)
+            return Command(cmd_id, target=target)
+
+        if not arg.isdecimal():
+            raise CommandFormatException(f"Malformed command. Usage: {_USAGE[cmd_id]}")
+        return Command(cmd_id, int(arg), target=target)
+
+
+def run_script(driver, lines: Iterable[str], parser: CommandParser = None) -> bool:
+    """
+    Parses and runs a script of commands and programs on a driver (or a fleet).
+    It stops at the first quit/exit.
+
+    Returns: True if it stopped at a quit/exit
+    """
+    if parser is None:
+        parser = CommandParser()
+    for parsed in parser.parse_lines(lines):
+        if isinstance(parsed, Program):
+            driver.program_command(parsed)
+        elif parsed.cmd_id == CommandId.EXIT:
+            return True
+        else:
+            driver.execute(parsed)
+    return False
@@ -0,0 +1,111 @@
+"""
+The per train command queue. All the writes to a train go through a single writer thread.
+
+A train only has one speed, one next steering decision and one snap setting, so the queue keeps
+one pending write per command type and a newer write replaces the pending one: when an operator
+mashes keys or a program fires in a loop, only the latest value goes over BLE. That is also the
+back-pressure: producers never block and the queue never holds more than one write per type, while
+the writer goes at the pace of the link. A priority write (STOP) goes before the other pending ones.
+"""
+import threading
+from threading import Thread
+from typing import Callable, Dict, Tuple
+
+WriteFunction = Callable[[str, Callable, tuple], None]
+
+
+class TrainCommandQueue:
+    def __init__(self, write: WriteFunction, on_error: Callable[[Exception], None] = None,
+                 name: str = "train-writer"):
+        """
+        Args:
+            write: write(command_type, call, args) does the actual write, e.g. calls call(*args)
+            on_error: Called with the exception when a write fails. The writer carries on
+            name: The writer thread name
+        """
+        self._write = write
+        self._on_error = on_error
+        self._name = name
+        self._cond = threading.Condition()
+        # command type -> (call, args), in the order they were first queued
+        self._pending: Dict[str, Tuple[Callable, tuple]] = dict()
+        self._priority: str = None
+        self._busy = False
+        self._running = False
+        self._writer: Thread = None
+        self.coalesced: int = 0
+        self.written: int = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._writer = Thread(target=self._run, name=self._name, daemon=True)
+        self._writer.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Writes what is pending, then stops the writer. What it could not write in time is dropped"""
+        self.flush(timeout)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._writer is not None:
+            self._writer.join(timeout)
+            self._writer = None
+        with self._cond:
+            # The writes are bound to the train, that may be gone when the queue starts again
+            self._pending.clear()
+            self._priority = None
+
+    def put(self, command_type: str, call: Callable, *args, priority: bool = False):
+        """
+        Queues call(*args), replacing the pending write of the same type if there is one.
+        It is dropped while the queue is stopped
+        """
+        with self._cond:
+            if not self._running:
+                return
+            if command_type in self._pending:
+                self.coalesced += 1
+            self._pending[command_type] = (call, args)
+            if priority:
+                self._priority = command_type
+            self._cond.notify()
+
+    def is_pending(self, command_type: str) -> bool:
+        return command_type in self._pending
+
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until all the queued writes are done
+
+        Returns: False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: (len(self._pending) == 0 and not self._busy) or not self._running,
+                                       timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) > 0 or not self._running)
+                if len(self._pending) == 0:
+                    return
+                command_type = self._priority if self._priority in self._pending else next(iter(self._pending))
+                self._priority = None
+                call, args = self._pending.pop(command_type)
+                self._busy = True
+            try:
+                self._write(command_type, call, args)
+            except Exception as error:
+                if self._on_error is not None:
+                    self._on_error(error)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self.written += 1
+                    self._cond.notify_all()
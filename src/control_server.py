@@ -0,0 +1,237 @@
+"""
+A local control server, so other programs can drive the trains without a user interface.
+
+It is an asyncio server on TCP or a Unix socket, in its own thread, speaking newline delimited JSON.
+A request is one line, with any of:
+
+    {"id": 1, "commands": ["start", "@train_1 speed 3", "program next_left when red,green"]}
+    {"id": 2, "subscribe": true}
+    {"id": 3, "state": true}
+
+The commands are the text commands of the GUI (see command_parser.py), run in order.
+Every request gets one response line:
+
+    {"id": 1, "ok": true, "executed": 3}
+    {"id": 1, "ok": false, "executed": 2, "errors": [{"index": 1, "error": "Command not recognised: ..."}]}
+    {"id": 3, "ok": true, "executed": 0, "state": {"train_1": {"version": 12, "speed_level": "THREE", ...}}}
+
+The state is read after the commands of the request, from the driver state snapshots (see driver_state.py),
+so polling it is cheap and never waits for the trains.
+
+A subscribed connection also gets the driver logs as events:
+
+    {"event": "log", "time": 1700000000.0, "message": "Split. Last: LEFT ...", "repeat": 0}
+    {"event": "dropped", "count": 12}
+
+Back-pressure: a connection is not read while its responses are not written, so a client that sends
+faster than it reads slows down only itself. Events go through a bounded queue per subscriber, and
+a subscriber that does not keep up loses the oldest events (reported with a "dropped" event).
+"""
+import asyncio
+import json
+import threading
+import time
+from threading import Thread
+from typing import Dict, List, Set
+
+from command_parser import CommandParser
+from enums import CommandId
+from reporter import Reporter, LogRecord
+from util import CommandFormatException, Program
+
+
+class _Subscriber:
+    def __init__(self, writer: asyncio.StreamWriter, queue_size: int):
+        self.writer = writer
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+
+    def offer(self, chunk: bytes):
+        """On the loop thread. Drops the oldest event chunk when the queue is full"""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(chunk)
+
+    async def run(self):
+        while True:
+            chunk = await self.queue.get()
+            if self.dropped > 0:
+                self.writer.write(json.dumps({"event": "dropped", "count": self.dropped}).encode() + b"\n")
+                self.dropped = 0
+            self.writer.write(chunk)
+            await self.writer.drain()
+
+
+class ControlServer(Reporter):
+    def __init__(self, driver, host: str = "127.0.0.1", port: int = 7878, unix_path: str = None,
+                 queue_size: int = 1024, max_batch: int = 4096):
+        """
+        Args:
+            driver: A TrainDriver or a Fleet. The server adds itself as its reporter
+            host: The TCP address, local only by default
+            port: The TCP port. 0 picks a free one, see the port attribute after start()
+            unix_path: A Unix socket path to listen on instead of TCP
+            queue_size: The events queued per subscriber before the oldest are dropped
+            max_batch: The most commands in a request
+        """
+        self.driver = driver
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self._queue_size = queue_size
+        self._max_batch = max_batch
+        self._parser = CommandParser()
+        self._loop: asyncio.AbstractEventLoop = None
+        self._server: asyncio.AbstractServer = None
+        self._thread: Thread = None
+        self._started = threading.Event()
+        self._subscribers: Set[_Subscriber] = set()
+        # The connection handler tasks and their writers
+        self._handlers: Dict[asyncio.Task, asyncio.StreamWriter] = dict()
+        self.commands_executed = 0
+        self.connections = 0
+        driver.add_reporter(self)
+
+    def start(self):
+        """Starts serving in a thread. Returns when the server is listening"""
+        self._thread = Thread(target=self._run, name="control-server", daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self):
+        """Closes the server and all the connections"""
+        if self._loop is not None and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._thread.join()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._loop.close()
+
+    async def _serve(self):
+        if self.unix_path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, self.unix_path)
+        else:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        # The handlers read the end of the stream and finish
+        for writer in self._handlers.values():
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        handler = asyncio.current_task()
+        self._handlers[handler] = writer
+        subscriber: _Subscriber = None
+        subscriber_task: asyncio.Task = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response, subscribe, close = self._handle_request(line)
+                if subscribe is True and subscriber is None:
+                    subscriber = _Subscriber(writer, self._queue_size)
+                    subscriber_task = asyncio.get_running_loop().create_task(subscriber.run())
+                    self._subscribers.add(subscriber)
+                elif subscribe is False and subscriber is not None:
+                    self._subscribers.discard(subscriber)
+                    subscriber_task.cancel()
+                    subscriber = None
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, ValueError):
+            # ValueError: a line longer than the stream limit
+            pass
+        finally:
+            if subscriber is not None:
+                self._subscribers.discard(subscriber)
+                subscriber_task.cancel()
+            self._handlers.pop(handler, None)
+            writer.close()
+
+    def _handle_request(self, line: bytes) -> (dict, bool, bool):
+        """
+        Returns: (the response, True/False to (un)subscribe or None, True to close the connection)
+        """
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {"ok": False, "error": f"Malformed JSON: {e}"}, None, False
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "A request is a JSON object"}, None, False
+
+        response = {"id": request.get("id"), "ok": True}
+        subscribe = request.get("subscribe")
+        commands = request.get("commands", [])
+        if isinstance(commands, str):
+            commands = [commands]
+        if not isinstance(commands, list) or len(commands) > self._max_batch:
+            return {"id": request.get("id"), "ok": False,
+                    "error": f"commands must be a list of at most {self._max_batch} strings"}, subscribe, False
+
+        executed, errors, close = self._execute(commands)
+        response["executed"] = executed
+        if request.get("state"):
+            response["state"] = {train_id: state.as_dict() for train_id, state in self.driver.states().items()}
+        if len(errors) > 0:
+            response["ok"] = False
+            response["errors"] = errors
+        return response, subscribe, close
+
+    def _execute(self, commands: List[str]) -> (int, List[dict], bool):
+        executed = 0
+        errors = list()
+        for index, text in enumerate(commands):
+            try:
+                parsed = self._parser.parse(str(text))
+                if isinstance(parsed, Program):
+                    self.driver.program_command(parsed)
+                elif parsed.cmd_id == CommandId.EXIT:
+                    # Closes this connection, the driver keeps going
+                    return executed, errors, True
+                else:
+                    self.driver.execute(parsed)
+                executed += 1
+            except CommandFormatException as e:
+                errors.append({"index": index, "error": str(e)})
+            except Exception as e:
+                errors.append({"index": index, "error": f"{type(e).__name__}: {e}"})
+        self.commands_executed += executed
+        return executed, errors, False
+
+    # Reporter, called by the log pipeline thread
+
+    def log(self, message: str):
+        self.report([LogRecord(time.time(), message)])
+
+    def logn(self, message: str):
+        self.report([LogRecord(time.time(), message, False)])
+
+    def report(self, records: List[LogRecord]):
+        if self._loop is None or len(self._subscribers) == 0:
+            return
+        # Encoded once for all the subscribers
+        chunk = b"".join(json.dumps({"event": "log", "time": r.timestamp, "message": str(r.message),
+                                     "repeat": r.repeat}).encode() + b"\n" for r in records)
+        try:
+            self._loop.call_soon_threadsafe(self._publish, chunk)
+        except RuntimeError:
+            # The loop is closed
+            pass
+
+    def _publish(self, chunk: bytes):
+        for subscriber in self._subscribers:
+            subscriber.offer(chunk)
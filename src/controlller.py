@@ -1,4 +1,9 @@
+from typing import Union
+
 from train_driver import TrainDriver
+from command_parser import CommandParser
+from enums import CommandId
+from util import Command, Program
 from abc import ABC, abstractmethod
 
 
@@ -6,10 +11,34 @@ class Controller(ABC):
     def __init__(self, driver: TrainDriver = None):
         self.driver: TrainDriver = driver
         self._connected: bool = False
+        self._parser = CommandParser(self)
 
     def set_train_driver(self, driver: TrainDriver):
         self.driver = driver
 
+    def execute_text(self, text: str) -> Union[Command, Program]:
+        """
+        Parses a text command and passes it to the driver.
+        The exit command is not passed, the controller handles it.
+
+        Returns: The parsed command or program
+        Raises: CommandFormatException
+        """
+        parsed = self._parser.parse(text)
+        if isinstance(parsed, Program):
+            self.driver.program_command(parsed)
+        elif parsed.cmd_id != CommandId.EXIT:
+            self.driver.execute(parsed)
+        return parsed
+
+    @abstractmethod
+    def connect_callback(self, connected: bool, train_id_or_msg: str = "", train_name: str = None):
+        pass
+
+    @abstractmethod
+    def disconnect_callback(self, connected: bool, train_id_or_msg: str = "", train_name: str = None):
+        pass
+
     @abstractmethod
     def control(self):
         pass
@@ -0,0 +1,159 @@
+"""
+The command dispatch table shared by the TrainDriver and the AsyncTrainDriver.
+
+A handler is a callable handler(driver, command). It calls the driver method for the command
+and returns what it returns, so for the AsyncTrainDriver that is an awaitable.
+New commands plug in with the decorator, or per driver with driver.register_handler:
+
+    @command_handler(CommandId.NEXT_SNAP_FOLLOW)
+    def _next_snap_follow(driver, command):
+        ...
+"""
+from typing import Callable, Dict
+
+from intelino.trainlib_async.enums import SteeringDecision
+from enums import CommandId, Speed
+from util import Command
+
+CommandHandler = Callable[[object, Command], object]
+
+COMMAND_HANDLERS: Dict[CommandId, CommandHandler] = dict()
+
+
+def command_handler(cmd_id: CommandId):
+    """Decorator that registers the function as the default handler of the command"""
+    def register(handler: CommandHandler) -> CommandHandler:
+        COMMAND_HANDLERS[cmd_id] = handler
+        return handler
+    return register
+
+
+def _arg(command: Command, index: int, default=None):
+    return command.args[index] if len(command.args) > index else default
+
+
+@command_handler(CommandId.CONNECT)
+def _connect(driver, command: Command):
+    return driver.connect(_arg(command, 0), _arg(command, 1))
+
+
+@command_handler(CommandId.DISCONNECT)
+def _disconnect(driver, command: Command):
+    return driver.disconnect()
+
+
+@command_handler(CommandId.START)
+def _start(driver, command: Command):
+    return driver.start()
+
+
+@command_handler(CommandId.STOP)
+def _stop(driver, command: Command):
+    return driver.stop()
+
+
+@command_handler(CommandId.KEEP_LEFT)
+def _keep_left(driver, command: Command):
+    return driver.set_state_steering(SteeringDecision.LEFT)
+
+
+@command_handler(CommandId.KEEP_RIGHT)
+def _keep_right(driver, command: Command):
+    return driver.set_state_steering(SteeringDecision.RIGHT)
+
+
+@command_handler(CommandId.KEEP_STRAIGHT)
+def _keep_straight(driver, command: Command):
+    return driver.set_state_steering(SteeringDecision.STRAIGHT)
+
+
+@command_handler(CommandId.NEXT_LEFT)
+def _next_left(driver, command: Command):
+    return driver.next_steering(SteeringDecision.LEFT, _arg(command, 0))
+
+
+@command_handler(CommandId.NEXT_RIGHT)
+def _next_right(driver, command: Command):
+    return driver.next_steering(SteeringDecision.RIGHT, _arg(command, 0))
+
+
+@command_handler(CommandId.NEXT_STRAIGHT)
+def _next_straight(driver, command: Command):
+    return driver.next_steering(SteeringDecision.STRAIGHT, _arg(command, 0))
+
+
+@command_handler(CommandId.SNAPS_FOLLOW)
+def _snaps_follow(driver, command: Command):
+    return driver.set_snap_following(True)
+
+
+@command_handler(CommandId.SNAPS_IGNORE)
+def _snaps_ignore(driver, command: Command):
+    return driver.set_snap_following(False)
+
+
+@command_handler(CommandId.SPEED_FAST)
+def _speed_fast(driver, command: Command):
+    return driver.set_speed(Speed.FOUR)
+
+
+@command_handler(CommandId.SPEED_MEDIUM)
+def _speed_medium(driver, command: Command):
+    return driver.set_speed(Speed.THREE)
+
+
+@command_handler(CommandId.SPEED_SLOW)
+def _speed_slow(driver, command: Command):
+    return driver.set_speed(Speed.TWO)
+
+
+@command_handler(CommandId.SPEED_FINE)
+def _speed_fine(driver, command: Command):
+    if Speed.MIN.value <= command.args[0] <= Speed.MAX.value:
+        return driver.set_speed(Speed(command.args[0]))
+    driver.log(f"Invalid speed file value {command.args[0]}. Must be between {Speed.MIN} and {Speed.MAX}")
+
+
+@command_handler(CommandId.REVERSE)
+def _reverse(driver, command: Command):
+    return driver.reverse()
+
+
+@command_handler(CommandId.REVERSE_NOW)
+def _reverse_now(driver, command: Command):
+    return driver.reverse(gently=False)
+
+
+@command_handler(CommandId.FORWARD)
+def _forward(driver, command: Command):
+    return driver.forward()
+
+
+@command_handler(CommandId.BACKWARD)
+def _backward(driver, command: Command):
+    return driver.backward()
+
+
+@command_handler(CommandId.ROUTE)
+def _route(driver, command: Command):
+    return driver.route_to(command.args[0])
+
+
+@command_handler(CommandId.METRICS)
+def _metrics(driver, command: Command):
+    return driver.log_metrics()
+
+
+@command_handler(CommandId.LAYOUT)
+def _layout(driver, command: Command):
+    return driver.switch_layout(command.args[0])
+
+
+@command_handler(CommandId.RAMP)
+def _ramp(driver, command: Command):
+    return driver.set_ramp_profile(command.args[0])
+
+
+@command_handler(CommandId.SCRIPT)
+def _script(driver, command: Command):
+    return driver.run_script(command.args[0])
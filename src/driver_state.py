@@ -0,0 +1,82 @@
+"""
+The state of a TrainDriver as an immutable snapshot.
+
+The driver never changes a snapshot, it publishes a new one (copy-on-write) with a single attribute
+assignment, so readers (the GUI, telemetry, the control server) read driver.state at any rate and from
+any thread without a lock, and always see a consistent state. The writes are serialised by the driver.
+"""
+from typing import Tuple
+
+from intelino.trainlib.enums import MovementDirection
+from intelino.trainlib_async.enums import SteeringDecision
+from enums import Speed
+
+
+class DriverState:
+    __slots__ = ("version", "speed_level", "direction", "steering", "next_steering", "next_steering_count",
+                 "steering_plan", "snap_following", "restore_speed", "slowed_speed", "restore_after_splits")
+
+    def __init__(self, version: int = 0, speed_level: Speed = Speed.ZERO,
+                 direction: MovementDirection = MovementDirection.FORWARD,
+                 steering: SteeringDecision = SteeringDecision.STRAIGHT, next_steering: SteeringDecision = None,
+                 next_steering_count: int = 0, steering_plan: Tuple[SteeringDecision, ...] = (),
+                 snap_following: bool = False, restore_speed: Speed = None, slowed_speed: Speed = None,
+                 restore_after_splits: int = 0):
+        """
+        Args:
+            version: Bumped on every change, so a poller can tell whether anything changed
+            speed_level: The speed level the driver drives at, not the ramped train speed
+            direction: The direction the driver drives in
+            steering: The base steering, for the splits without an override
+            next_steering: The steering override for the next splits
+            next_steering_count: The splits the override is still used for, after the one it was set for
+            steering_plan: The decisions of a planned route, for the splits ahead
+            snap_following: Whether the train executes the snap commands itself
+            restore_speed: The speed to go back to after a predictive slowdown
+            slowed_speed: The speed of the predictive slowdown
+            restore_after_splits: The splits until the speed is restored
+        """
+        setter = object.__setattr__
+        setter(self, "version", version)
+        setter(self, "speed_level", speed_level)
+        setter(self, "direction", direction)
+        setter(self, "steering", steering)
+        setter(self, "next_steering", next_steering)
+        setter(self, "next_steering_count", next_steering_count)
+        setter(self, "steering_plan", tuple(steering_plan))
+        setter(self, "snap_following", snap_following)
+        setter(self, "restore_speed", restore_speed)
+        setter(self, "slowed_speed", slowed_speed)
+        setter(self, "restore_after_splits", restore_after_splits)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DriverState is immutable, use replace()")
+
+    def replace(self, **changes) -> "DriverState":
+        """A copy with the changes and the next version"""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        values["version"] = self.version + 1
+        return DriverState(**values)
+
+    def as_dict(self) -> dict:
+        """JSON friendly, the enums by name"""
+        def plain(value):
+            return value.name if hasattr(value, "name") else value
+
+        return {
+            "version": self.version,
+            "speed_level": plain(self.speed_level),
+            "direction": plain(self.direction),
+            "steering": plain(self.steering),
+            "next_steering": plain(self.next_steering),
+            "next_steering_count": self.next_steering_count,
+            "steering_plan": [plain(d) for d in self.steering_plan],
+            "snap_following": self.snap_following,
+        }
+
+    def __str__(self):
+        return (f"v{self.version} {self.speed_level.name} {self.direction.name}, steering {self.steering.name}"
+                + (f", next {self.next_steering.name} ({self.next_steering_count} more)"
+                   if self.next_steering is not None else "")
+                + (f", route {len(self.steering_plan)} split(s)" if len(self.steering_plan) > 0 else ""))
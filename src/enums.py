@@ -21,6 +21,16 @@ class CommandId(IntEnum):
     NEXT_SNAP_FOLLOW = 16
     NEXT_SNAP_IGNORE = 17
     SPEED_FINE = 18
+    ROUTE = 19
+    METRICS = 20
+    LAYOUT = 21
+    RAMP = 22
+    REVERSE_NOW = 23
+    # A multi-step command and its steps, see program_engine.py
+    SCRIPT = 24
+    WAIT = 25
+    IF = 26
+    EVERY = 27
     DISCONNECT = 98
     CONNECT = 99
     EXIT = 100
@@ -0,0 +1,186 @@
+import asyncio
+from threading import Thread
+from typing import Dict, List
+
+from intelino.trainlib import Train
+from intelino.trainlib_async import TrainScanner, Train as AsyncTrain
+from reporter import Reporter, ConsoleReporter
+from log_pipeline import LogPipeline
+from enums import CommandId
+from blocks import BlockManager
+from calibration import CalibrationTable
+from driver_state import DriverState
+from layout import TrackLayout
+from metrics import prometheus_text, write_prometheus
+from program_store import ProgramStore
+from telemetry import TelemetryRecorder
+from train_driver import TrainDriver
+from util import Command, Program
+
+
+class _DiscoveredTrain:
+    """
+    Connects an already discovered train when entered, the way the TrainScanner does.
+    This lets every driver do its own (slow) BLE connection in its own thread.
+    """
+
+    def __init__(self, async_train: AsyncTrain):
+        self._async_train = async_train
+        self.train: Train = None
+
+    def __enter__(self) -> Train:
+        self.train = Train(self._async_train)
+        return self.train
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.train.disconnect()
+
+
+class Fleet:
+    """
+    Drives several trains at once. It scans once and gives every train found its own TrainDriver,
+    so speed, steering, programs and color sequences are per train.
+
+    Commands are routed by their target (train id or name). Commands without a target go to all trains.
+    The fleet has the same surface as the TrainDriver, so the controllers can drive either.
+    """
+
+    def __init__(self, reporter: Reporter = ConsoleReporter(), count: int = None, timeout: float = 5.0,
+                 program_store: ProgramStore = None, layout_name: str = "default",
+                 calibration: CalibrationTable = None):
+        """
+        Args:
+            reporter: The reporter shared by the fleet and all the drivers, through one log pipeline
+            count: Number of trains to look for. If None, all trains found until the timeout
+            timeout: The scanning timeout in seconds
+            program_store: The program store shared by all the drivers
+            layout_name: The layout the drivers load the programs of
+            calibration: The calibration table, every driver uses the calibration of its train
+        """
+        self._count = count
+        self._timeout = timeout
+        self._scanner_thread: Thread = None
+        self._log_pipeline = LogPipeline()
+        self._log_pipeline.add_reporter(reporter)
+        self.drivers: Dict[str, TrainDriver] = dict()
+        # Lowercased train name -> lowercased train id, for the targets
+        self._names: Dict[str, str] = dict()
+        self._telemetry: TelemetryRecorder = None
+        # All the trains are on the same track
+        self.layout = TrackLayout()
+        # So they keep out of the blocks the others are in
+        self.blocks = BlockManager()
+        self._program_store = program_store
+        self._layout_name = layout_name
+        self._calibration = calibration
+
+    def connect(self, connect_callback=None, disconnect_callback=None):
+        """
+        Scans for the trains and connects all of them in parallel.
+        The callbacks are called once per train, same as the TrainDriver.connect
+
+        Returns:
+            Immediately.
+        """
+        if self._scanner_thread is not None and self._scanner_thread.is_alive():
+            self.log("The fleet is still scanning")
+            return
+
+        self._scanner_thread = Thread(target=self._do_connect, args=(connect_callback, disconnect_callback, ))
+        self._scanner_thread.start()
+
+    def _do_connect(self, connect_callback, disconnect_callback):
+        self.log("Scanning for trains")
+        try:
+            trains = asyncio.run(TrainScanner(timeout=self._timeout).get_trains(self._count, connect=False))
+        except Exception as error:
+            if connect_callback is not None:
+                connect_callback(False, str(error), None)
+            return
+
+        self.log(f"Found {len(trains)} train(s)")
+        for async_train in trains:
+            if async_train.id in self.drivers and self.drivers[async_train.id].is_driving():
+                continue
+            driver = TrainDriver(log_pipeline=self._log_pipeline, layout=self.layout,
+                                 program_store=self._program_store, layout_name=self._layout_name,
+                                 calibration=self._calibration, blocks=self.blocks)
+            driver.set_telemetry(self._telemetry)
+            self.drivers[async_train.id] = driver
+            self._names[async_train.name.lower()] = async_train.id.lower()
+            driver.connect(connect_callback, disconnect_callback, _DiscoveredTrain(async_train))
+
+    def disconnect(self):
+        for driver in self.drivers.values():
+            driver.disconnect()
+
+    def is_driving(self) -> bool:
+        return any(d.is_driving() for d in self.drivers.values())
+
+    def log(self, msg):
+        self._log_pipeline.submit(msg)
+
+    def logn(self, msg):
+        self._log_pipeline.submit(msg, False)
+
+    def add_reporter(self, reporter: Reporter):
+        self._log_pipeline.add_reporter(reporter)
+
+    def set_telemetry(self, recorder: TelemetryRecorder):
+        """Records all the trains to the same recorder. None to stop recording"""
+        self._telemetry = recorder
+        for driver in self.drivers.values():
+            driver.set_telemetry(recorder)
+
+    def metrics_text(self) -> str:
+        """The metrics of all the drivers in the Prometheus text format, labelled by train"""
+        return prometheus_text(d.metrics for d in self.drivers.values())
+
+    def write_metrics(self, path: str):
+        write_prometheus([d.metrics for d in self.drivers.values()], path)
+
+    def states(self) -> Dict[str, DriverState]:
+        """The latest state snapshot of every train by id, without locking"""
+        return {train_id: driver.state for train_id, driver in list(self.drivers.items())}
+
+    def driver(self, target: str) -> TrainDriver:
+        """
+        Args:
+            target: The train id or name, case insensitive
+
+        Returns: The driver of the train or None
+        """
+        target = target.lower()
+        train_id = self._names.get(target, target)
+        for driver_id, driver in self.drivers.items():
+            if driver_id.lower() == train_id:
+                return driver
+        return None
+
+    def _targets(self, target: str) -> List[TrainDriver]:
+        if target is None:
+            return list(self.drivers.values())
+        driver = self.driver(target)
+        if driver is None:
+            self.log(f"No train found with id or name {target}")
+            return []
+        return [driver]
+
+    def execute(self, command: Command):
+        if command.cmd_id == CommandId.CONNECT:
+            # The callbacks, if any, e.g. none from the control server
+            self.connect(*command.args[:2])
+        elif command.cmd_id == CommandId.DISCONNECT and command.target is None:
+            self.disconnect()
+        elif command.cmd_id == CommandId.LAYOUT and command.target is None:
+            # The trains found later load this layout too
+            self._layout_name = command.args[0]
+            for driver in self.drivers.values():
+                driver.execute(command)
+        else:
+            for driver in self._targets(command.target):
+                driver.execute(command)
+
+    def program_command(self, program: Program):
+        for driver in self._targets(program.command.target):
+            driver.program_command(program)
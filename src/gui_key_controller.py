@@ -1,17 +1,25 @@
 from controlller import Controller
-from reporter import Reporter
+from reporter import Reporter, LogRecord
 from enums import CommandId
 import tkinter as tk
 import queue as q
 from queue import Queue
+from typing import List
 
-from src.util import Command, CommandFormatException, Program, ColorSequence
+from util import Command, CommandFormatException
 
 
 class GuiKeyController(Controller, Reporter):
     _QUIT_SEQUENCE = "jfjehorupowqif[psdjlhweoieuro3ifjnlc"
+    # The log polling backs off from the min to the max while there is nothing to show
+    _MIN_POLL_MS = 10
+    _MAX_POLL_MS = 500
 
-    def __init__(self):
+    def __init__(self, max_lines: int = 5000):
+        """
+        Args:
+            max_lines: The status reports keep only the last max_lines lines
+        """
         print("Starting GUI Keyboard Controller Thread")
         self.root = tk.Tk()
         self.root.title("GUI Train Controller")
@@ -31,7 +39,9 @@ class GuiKeyController(Controller, Reporter):
 
         self.root.protocol("WM_DELETE_WINDOW", self._quit)
         self._log_queue = Queue()
-        self.root.after(100, self._process_log_queue())
+        self._max_lines = max_lines
+        self._poll_ms = GuiKeyController._MIN_POLL_MS
+        self.root.after(100, self._process_log_queue)
 
         self._connected = False
         super().__init__()
@@ -42,6 +52,9 @@ class GuiKeyController(Controller, Reporter):
     def logn(self, message: str):
         self._log_queue.put(message)
 
+    def report(self, records: List[LogRecord]):
+        self._log_queue.put(''.join(map(LogRecord.text, records)))
+
     def control(self):
         self.driver.execute(Command(CommandId.CONNECT, self.connect_callback, self.disconnect_callback))
         self.root.mainloop()
@@ -54,83 +67,13 @@ class GuiKeyController(Controller, Reporter):
         source.delete(0, tk.END)
         self.log(f"*** Command: {text}")
 
-        cmd: Command = None
-        str_cmd: str = text.lower()
         try:
-            if str_cmd == "quit":
-                self.driver.execute(Command(CommandId.DISCONNECT))
+            parsed = self.execute_text(text)
+            if isinstance(parsed, Command) and parsed.cmd_id == CommandId.EXIT:
                 self._quit()
-            elif str_cmd.startswith("program "):
-                prog_text = str_cmd.removeprefix("program ")
-                parts = prog_text.split(" when ")
-                cmd_text = parts[0]
-                seq_text = parts[1]
-                cmd = self._text_to_command(cmd_text, self)
-                seq = ColorSequence().from_string_csv(seq_text)
-                prog = Program(seq, cmd)
-                self.driver.program_command(prog)
-            else:
-                cmd = self._text_to_command(str_cmd, self)
-                self.driver.execute(cmd)
         except CommandFormatException as e:
             self.log(e)
 
-    @staticmethod
-    def _text_to_command(text, callback_target) -> Command:
-        """
-        Converts a text to a command. It does not work with "program"
-        Args:
-            text: The text
-
-        Returns: A command including the arguments
-        """
-        str_cmd = text.lower()
-        cmd = None
-
-        if str_cmd == "connect":
-            cmd = Command(CommandId.CONNECT, callback_target.connect_callback, callback_target.disconnect_callback)
-        elif str_cmd == "disconnect":
-            cmd = Command(CommandId.DISCONNECT)
-        elif str_cmd == "start":
-            cmd = Command(CommandId.START)
-        elif str_cmd == "stop":
-            cmd = Command(CommandId.STOP)
-        elif str_cmd == "keep_straight":
-            cmd = Command(CommandId.KEEP_STRAIGHT)
-        elif str_cmd == "keep_left":
-            cmd = Command(CommandId.KEEP_LEFT)
-        elif str_cmd == "keep_right":
-            cmd = Command(CommandId.KEEP_RIGHT)
-        elif str_cmd == "next_straight":
-            cmd = Command(CommandId.NEXT_STRAIGHT)
-        elif str_cmd == "next_left":
-            cmd = Command(CommandId.NEXT_LEFT)
-        elif str_cmd == "next_right":
-            cmd = Command(CommandId.NEXT_RIGHT)
-        elif str_cmd == "speed_slow":
-            cmd = Command(CommandId.SPEED_SLOW)
-        elif str_cmd == "speed_medium":
-            cmd = Command(CommandId.SPEED_MEDIUM)
-        elif str_cmd == "speed_fast":
-            cmd = Command(CommandId.SPEED_FAST)
-        elif str_cmd.startswith("speed "):
-            val_str = str_cmd.removeprefix("speed ")
-            if val_str.isnumeric():
-                val = int(val_str)
-                cmd = Command(CommandId.SPEED_FINE, val)
-            else:
-                raise CommandFormatException("Malformed command. Usage: speed 1|2|3|4|5")
-        elif str_cmd == "reverse":
-            cmd = Command(CommandId.REVERSE)
-        elif str_cmd == "forward":
-            cmd = Command(CommandId.FORWARD)
-        elif str_cmd == "backwards":
-            cmd = Command(CommandId.BACKWARD)
-        else:
-            raise CommandFormatException(f"Command not recognised: {str_cmd}")
-
-        return cmd
-
     def _write_to_output(self, text: str):
         self.text_output.insert(tk.END, f"{text}\n")
         self.text_output.see(tk.END)
@@ -143,16 +86,35 @@ class GuiKeyController(Controller, Reporter):
         self.text_output.see(tk.END)
 
     def _process_log_queue(self):
+        pending = list()
+        quit_received = False
         try:
             while True:
                 msg = self._log_queue.get_nowait()
                 if msg == GuiKeyController._QUIT_SEQUENCE:
-                    self.root.quit()
+                    quit_received = True
                 else:
-                    self.text_output.insert(tk.END, msg)
-                    self.text_output.see(tk.END)
+                    pending.append(msg)
         except q.Empty:
-            self.root.after(10, self._process_log_queue)
+            pass
+
+        if len(pending) > 0:
+            self.text_output.insert(tk.END, ''.join(pending))
+            self._trim_output()
+            self.text_output.see(tk.END)
+            self._poll_ms = GuiKeyController._MIN_POLL_MS
+        else:
+            self._poll_ms = min(self._poll_ms * 2, GuiKeyController._MAX_POLL_MS)
+
+        if quit_received:
+            self.root.quit()
+        self.root.after(self._poll_ms, self._process_log_queue)
+
+    def _trim_output(self):
+        """Keeps the status reports to the last max_lines lines"""
+        lines = int(self.text_output.index("end-1c").split(".")[0])
+        if lines > self._max_lines:
+            self.text_output.delete("1.0", f"{lines - self._max_lines + 1}.0")
 
     def connect_callback(self, connected: bool, train_id_or_msg: str = "", train_name: str = None):
         if connected:
@@ -0,0 +1,88 @@
+"""
+Junction ID detection: a colour sequence right before a junction (or merge) mark names the junction.
+
+The detector keeps the last few colour commands in a fixed size ring, in the order the train saw them,
+so by distance. When a mark comes, the newest command that is no further back than max_gap_cm is its ID.
+The distances are the train odometer at the black of every sequence, so the gap does not depend on the
+speed or on how late the callbacks ran. Adding a command and correlating a mark are constant time.
+"""
+from typing import List
+
+from enums import JunctionMark
+from util import ColorCommand, ColorSequence
+
+
+class JunctionEvent:
+    __slots__ = ("junction_id", "mark", "merge", "distance_cm", "gap_cm")
+
+    def __init__(self, junction_id: ColorSequence, mark: JunctionMark, merge: bool, distance_cm: int, gap_cm: int):
+        """
+        Args:
+            junction_id: The colour sequence before the mark
+            mark: The junction (or merge) side
+            merge: True for a merge mark
+            distance_cm: The distance of the mark
+            gap_cm: The distance between the ID and the mark
+        """
+        self.junction_id = junction_id
+        self.mark = mark
+        self.merge = merge
+        self.distance_cm = distance_cm
+        self.gap_cm = gap_cm
+
+    def __str__(self):
+        return f"{'Merge' if self.merge else 'Junction'} {self.junction_id} {self.mark} at {self.distance_cm} cm " \
+               f"({self.gap_cm} cm before the mark)"
+
+
+class JunctionDetector:
+    def __init__(self, max_gap_cm: float = 9.0, capacity: int = 8):
+        """
+        Args:
+            max_gap_cm: The longest distance between the black of an ID and the black of its mark,
+                        that is the mark length. See mark_length_cm
+            capacity: The colour commands kept
+        """
+        self.max_gap_cm = max_gap_cm
+        self._ring: List[ColorCommand] = [None] * capacity
+        # The slot of the next command
+        self._head = 0
+
+    @staticmethod
+    def mark_length_cm(snap_gap_cm: float) -> float:
+        """The longest gap between an ID and its mark: the two colours and the black of the mark"""
+        return 3 * snap_gap_cm
+
+    def color_command(self, command: ColorCommand):
+        self._ring[self._head] = command
+        self._head = (self._head + 1) % len(self._ring)
+
+    def junction_mark(self, towards: JunctionMark, distance_cm: int) -> JunctionEvent:
+        """Returns: The junction ID event, None if no colour command is close enough before the mark"""
+        return self._correlate(towards, False, distance_cm)
+
+    def merge_mark(self, coming: JunctionMark, distance_cm: int) -> JunctionEvent:
+        """Returns: The merge ID event, None if no colour command is close enough before the mark"""
+        return self._correlate(coming, True, distance_cm)
+
+    def reset(self):
+        """Forgets the commands, e.g. when the direction changes and the IDs come after the marks"""
+        self._ring = [None] * len(self._ring)
+        self._head = 0
+
+    def _correlate(self, mark: JunctionMark, merge: bool, distance_cm: int) -> JunctionEvent:
+        size = len(self._ring)
+        # From the newest. A callback that ran late can leave a command further than the mark
+        for i in range(1, size + 1):
+            command = self._ring[(self._head - i) % size]
+            if command is None:
+                return None
+            gap = abs(distance_cm - command.distance)
+            if command.distance <= distance_cm and gap <= self.max_gap_cm:
+                if len(command.seq) == 0:
+                    return None
+                return JunctionEvent(command.seq, mark, merge, distance_cm, gap)
+            if gap > self.max_gap_cm and command.distance < distance_cm:
+                # The older ones are even further back
+                return None
+        return None
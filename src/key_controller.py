@@ -1,10 +1,11 @@
 from controlller import Controller
 from enums import CommandId
-from src.util import Command
+from util import Command, CommandFormatException
 
 
 class KeyController(Controller):
     def __init__(self):
+        super().__init__()
         self._running = True
 
     def stop_control(self):
@@ -15,35 +16,12 @@ class KeyController(Controller):
         self._connect()
         while self._running:
             try:
-                str_cmd = input("Next command (start, stop, quit):").lower()
-                if str_cmd == "quit":
+                str_cmd = input("Next command ([@train] start, stop, quit):")
+                parsed = self.execute_text(str_cmd)
+                if isinstance(parsed, Command) and parsed.cmd_id == CommandId.EXIT:
                     raise EOFError
-                elif str_cmd == "connect":
-                    self._connect()
-                elif str_cmd == "disconnect":
-                    self.driver.disconnect()
-                elif str_cmd == "start":
-                    self.driver.execute(Command(CommandId.START))
-                elif str_cmd == "stop":
-                    self.driver.execute(Command(CommandId.STOP))
-                elif str_cmd == "keep_straight":
-                    self.driver.execute(Command(CommandId.KEEP_STRAIGHT))
-                elif str_cmd == "keep_left":
-                    self.driver.execute(Command(CommandId.KEEP_LEFT))
-                elif str_cmd == "keep_right":
-                    self.driver.execute(Command(CommandId.KEEP_RIGHT))
-                elif str_cmd == "next_straight":
-                    self.driver.execute(Command(CommandId.NEXT_STRAIGHT))
-                elif str_cmd == "next_left":
-                    self.driver.execute(Command(CommandId.NEXT_LEFT))
-                elif str_cmd == "next_right":
-                    self.driver.execute(Command(CommandId.NEXT_RIGHT))
-                elif str_cmd == "speed_slow":
-                    self.driver.execute(Command(CommandId.SPEED_SLOW))
-                elif str_cmd == "speed_medium":
-                    self.driver.execute(Command(CommandId.SPEED_MEDIUM))
-                elif str_cmd == "speed_fast":
-                    self.driver.execute(Command(CommandId.SPEED_FAST))
+            except CommandFormatException as e:
+                print(e)
             except EOFError:
                 print("Quiting key controller")
                 self._running = False
@@ -52,8 +30,12 @@ class KeyController(Controller):
         self.driver.disconnect()
 
     def _connect(self):
-        self.driver.connect(self._connect_callback)
+        self.driver.connect(self.connect_callback, self.disconnect_callback)
 
-    def _connect_callback(self, connected: bool, message: str = ""):
-        self.driver.log(f"Connected: {connected}, Message: {message}")
+    def connect_callback(self, connected: bool, train_id_or_msg: str = "", train_name: str = None):
+        self.driver.log(f"Connected: {connected}, Message: {train_id_or_msg}")
         self._connected = connected
+
+    def disconnect_callback(self, connected: bool, train_id_or_msg: str = "", train_name: str = None):
+        self.driver.log(f"Disconnected: {connected}. Train id: {train_id_or_msg}, name: {train_name}")
+        self._connected = False
@@ -0,0 +1,241 @@
+"""
+The track layout, learnt from what the trains see, and a route planner on top of it.
+
+The landmarks of the layout are the color IDs (programmed or not, any color command sequence).
+Driving from one landmark to the next gives an edge with the distance, the junction and merge marks
+passed and the steering decisions taken at the splits. The planner uses the decisions to drive a route.
+"""
+import threading
+from typing import Dict, List, Tuple
+
+from intelino.trainlib_async.enums import SteeringDecision
+from enums import JunctionMark
+from util import ColorSequence
+
+_INFINITY = float("inf")
+
+
+class TrackEdge:
+    __slots__ = ("source", "destination", "decisions", "distance_cm", "split_offsets", "junctions", "merges",
+                 "observations")
+
+    def __init__(self, source: int, destination: int, decisions: Tuple[SteeringDecision, ...]):
+        self.source = source
+        self.destination = destination
+        self.decisions = decisions
+        self.distance_cm: float = 0.0
+        # The distance of every split from the source landmark
+        self.split_offsets: List[float] = [0.0] * len(decisions)
+        self.junctions: int = 0
+        self.merges: int = 0
+        self.observations: int = 0
+
+    def observe(self, distance_cm: float, split_offsets: List[float], junctions: int, merges: int):
+        """Averages the distances over the observations"""
+        self.observations += 1
+        self.distance_cm += (distance_cm - self.distance_cm) / self.observations
+        for i, offset in enumerate(split_offsets):
+            self.split_offsets[i] += (offset - self.split_offsets[i]) / self.observations
+        self.junctions = junctions
+        self.merges = merges
+
+    def __str__(self):
+        decisions = ", ".join(d.name for d in self.decisions)
+        return (f"{ColorSequence.from_identity(self.source)} -> {ColorSequence.from_identity(self.destination)}: "
+                f"{self.distance_cm:.0f} cm [{decisions}]")
+
+
+class TrackLayout:
+    """
+    The graph of landmarks. It can be shared by all the trains on the same layout.
+
+    The all pairs shortest paths are computed (Floyd-Warshall) on the first query after the graph changed,
+    and the routes are cached, so planning a route is a lookup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Landmark identity -> node index
+        self._nodes: Dict[int, int] = dict()
+        self._landmarks: List[int] = list()
+        # (source, destination) -> {decisions: edge}
+        self._edges: Dict[Tuple[int, int], Dict[tuple, TrackEdge]] = dict()
+        # source identity -> edges
+        self._outgoing: Dict[int, List[TrackEdge]] = dict()
+        self._dirty = False
+        self._distances: List[List[float]] = list()
+        self._next_hop: List[List[int]] = list()
+        self._routes: Dict[Tuple[int, int], List[TrackEdge]] = dict()
+
+    def landmarks(self) -> List[ColorSequence]:
+        return [ColorSequence.from_identity(identity) for identity in self._landmarks]
+
+    def edges(self) -> List[TrackEdge]:
+        with self._lock:
+            return [edge for variants in self._edges.values() for edge in variants.values()]
+
+    def add_edge(self, source: ColorSequence, destination: ColorSequence, distance_cm: float,
+                 decisions: Tuple[SteeringDecision, ...] = (), split_offsets: List[float] = (),
+                 junctions: int = 0, merges: int = 0):
+        with self._lock:
+            a = self._node(source.identity())
+            b = self._node(destination.identity())
+            variants = self._edges.setdefault((a, b), dict())
+            edge = variants.get(decisions)
+            if edge is None:
+                edge = TrackEdge(source.identity(), destination.identity(), decisions)
+                variants[decisions] = edge
+                self._outgoing.setdefault(source.identity(), list()).append(edge)
+            edge.observe(distance_cm, split_offsets, junctions, merges)
+            self._dirty = True
+
+    def likely_edge(self, source: ColorSequence, decisions: Tuple[SteeringDecision, ...]) -> TrackEdge:
+        """
+        The edge a train is most likely on, after leaving the source and taking the decisions so far
+
+        Returns: The most observed edge that starts with the decisions, or None
+        """
+        with self._lock:
+            best = None
+            n = len(decisions)
+            for edge in self._outgoing.get(source.identity(), ()):
+                if edge.decisions[:n] == decisions and (best is None or edge.observations > best.observations):
+                    best = edge
+            return best
+
+    def _node(self, identity: int) -> int:
+        index = self._nodes.get(identity)
+        if index is None:
+            index = len(self._landmarks)
+            self._nodes[identity] = index
+            self._landmarks.append(identity)
+        return index
+
+    def _best_edge(self, a: int, b: int) -> TrackEdge:
+        return min(self._edges[(a, b)].values(), key=lambda e: e.distance_cm)
+
+    def _compute(self):
+        """Floyd-Warshall over the landmarks, keeping the next hop to rebuild the paths"""
+        n = len(self._landmarks)
+        distances = [[_INFINITY] * n for _ in range(n)]
+        next_hop = [[-1] * n for _ in range(n)]
+        for i in range(n):
+            distances[i][i] = 0.0
+            next_hop[i][i] = i
+        for (a, b) in self._edges:
+            if a != b:
+                distances[a][b] = self._best_edge(a, b).distance_cm
+                next_hop[a][b] = b
+
+        for k in range(n):
+            dk = distances[k]
+            for i in range(n):
+                di = distances[i]
+                dik = di[k]
+                if dik == _INFINITY:
+                    continue
+                hi = next_hop[i]
+                hik = hi[k]
+                for j in range(n):
+                    through_k = dik + dk[j]
+                    if through_k < di[j]:
+                        di[j] = through_k
+                        hi[j] = hik
+
+        self._distances = distances
+        self._next_hop = next_hop
+        self._routes.clear()
+        self._dirty = False
+
+    def route(self, source: ColorSequence, destination: ColorSequence) -> List[TrackEdge]:
+        """
+        Returns: The edges of the shortest route, or None if the destination cannot be reached
+        """
+        with self._lock:
+            a = self._nodes.get(source.identity())
+            b = self._nodes.get(destination.identity())
+            if a is None or b is None:
+                return None
+            if self._dirty:
+                self._compute()
+            route = self._routes.get((a, b))
+            if route is None:
+                if self._next_hop[a][b] == -1:
+                    return None
+                route = list()
+                node = a
+                while node != b:
+                    hop = self._next_hop[node][b]
+                    route.append(self._best_edge(node, hop))
+                    node = hop
+                self._routes[(a, b)] = route
+            return route
+
+    def distance(self, source: ColorSequence, destination: ColorSequence) -> float:
+        """The shortest distance in cm, infinite if the destination cannot be reached"""
+        with self._lock:
+            a = self._nodes.get(source.identity())
+            b = self._nodes.get(destination.identity())
+            if a is None or b is None:
+                return _INFINITY
+            if self._dirty:
+                self._compute()
+            return self._distances[a][b]
+
+    def steering_plan(self, source: ColorSequence, destination: ColorSequence) -> List[SteeringDecision]:
+        """The steering decisions for every split on the way, in order. None if there is no route"""
+        route = self.route(source, destination)
+        if route is None:
+            return None
+        return [decision for edge in route for decision in edge.decisions]
+
+
+class LayoutObserver:
+    """
+    What one train has seen since its last landmark. It turns the landmarks the train passes into edges.
+    """
+
+    def __init__(self, layout: TrackLayout):
+        self.layout = layout
+        self.last_landmark: ColorSequence = None
+        self._last_distance: int = 0
+        self._decisions: List[SteeringDecision] = list()
+        self._split_offsets: List[float] = list()
+        self._junctions = 0
+        self._merges = 0
+
+    def decisions(self) -> Tuple[SteeringDecision, ...]:
+        """The split decisions since the last landmark"""
+        return tuple(self._decisions)
+
+    def distance_since_landmark(self, distance_cm: int) -> int:
+        return abs(distance_cm - self._last_distance)
+
+    def landmark(self, seq: ColorSequence, distance_cm: int):
+        if self.last_landmark is not None and seq != self.last_landmark:
+            self.layout.add_edge(self.last_landmark, seq, abs(distance_cm - self._last_distance),
+                                 tuple(self._decisions), self._split_offsets, self._junctions, self._merges)
+        self.last_landmark = seq
+        self._last_distance = distance_cm
+        self._decisions.clear()
+        self._split_offsets = list()
+        self._junctions = 0
+        self._merges = 0
+
+    def split(self, decision: SteeringDecision, distance_cm: int):
+        self._decisions.append(decision)
+        self._split_offsets.append(self.distance_since_landmark(distance_cm))
+
+    def junction_mark(self, towards: JunctionMark):
+        self._junctions += 1
+
+    def merge_mark(self, coming: JunctionMark):
+        self._merges += 1
+
+    def reset(self):
+        """Forgets the last landmark, e.g. after a reverse, when the next edge would be wrong"""
+        self.last_landmark = None
+        self._decisions.clear()
+        self._split_offsets = list()
+        self._junctions = 0
+        self._merges = 0
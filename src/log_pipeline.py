@@ -0,0 +1,124 @@
+import atexit
+import threading
+import time
+from collections import deque
+from enum import Enum
+from threading import Thread
+from typing import List
+
+from reporter import Reporter, LogRecord
+
+
+class OverloadPolicy(Enum):
+    """What the pipeline does with a new record when the buffer is full"""
+    # Drop the oldest record in the buffer
+    DROP_OLDEST = 0
+    # Drop the new record
+    DROP_NEWEST = 1
+    # Count the new record as a repeat of the newest one if it is the same message, otherwise drop the oldest
+    COALESCE = 2
+
+
+class LogPipeline:
+    """
+    Moves the reporting off the caller's thread.
+
+    The drivers log from the BLE callback threads, so submit() only appends a record to a bounded
+    ring buffer (a deque, which needs no lock to append). A single consumer thread drains it in
+    batches and hands the batches to the reporters, so a slow reporter never delays a steering decision.
+    Every pipeline has its own consumer thread, share one between the drivers of a fleet.
+    """
+
+    def __init__(self, capacity: int = 4096, batch_size: int = 256,
+                 policy: OverloadPolicy = OverloadPolicy.COALESCE):
+        self._capacity = capacity
+        self._batch_size = batch_size
+        self._policy = policy
+        self._records: deque = deque(maxlen=capacity)
+        # Taken by the consumer while it pops a batch, and by a submit to a full buffer,
+        # so a repeat is never added to a record that is being reported
+        self._pop_lock = threading.Lock()
+        # Notified when a batch has been reported
+        self._reported = threading.Condition(self._pop_lock)
+        # The records popped and not reported yet. Under the pop lock
+        self._in_flight = 0
+        self._reporters: List[Reporter] = list()
+        self._wakeup = threading.Event()
+        self._running = True
+        # Under the pop lock
+        self.dropped: int = 0
+
+        self._consumer = Thread(target=self._consume, name="log-pipeline", daemon=True)
+        self._consumer.start()
+        atexit.register(self.close)
+
+    def add_reporter(self, reporter: Reporter):
+        self._reporters.append(reporter)
+
+    def depth(self) -> int:
+        """The records waiting for the consumer"""
+        return len(self._records)
+
+    def submit(self, message: str, newline: bool = True):
+        records = self._records
+        if len(records) >= self._capacity:
+            with self._pop_lock:
+                self.dropped += 1
+                if self._policy == OverloadPolicy.DROP_NEWEST:
+                    return
+                if self._policy == OverloadPolicy.COALESCE:
+                    try:
+                        newest = records[-1]
+                        if newest.message == message and newest.newline == newline:
+                            newest.repeat += 1
+                            return
+                    except IndexError:
+                        pass
+        records.append(LogRecord(time.time(), message, newline))
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until everything submitted so far has been reported.
+
+        Returns: False if it timed out
+        """
+        if not self._consumer.is_alive():
+            return len(self._records) == 0
+        with self._reported:
+            return self._reported.wait_for(lambda: len(self._records) == 0 and self._in_flight == 0, timeout)
+
+    def close(self, timeout: float = 1.0):
+        """Reports what is pending and stops the consumer"""
+        if not self._running:
+            return
+        self.flush(timeout)
+        self._running = False
+        self._wakeup.set()
+        self._consumer.join(timeout)
+        # Or the hook would keep every pipeline ever made
+        atexit.unregister(self.close)
+
+    def _consume(self):
+        records = self._records
+        while self._running:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while records:
+                batch = list()
+                with self._pop_lock:
+                    try:
+                        while len(batch) < self._batch_size:
+                            batch.append(records.popleft())
+                    except IndexError:
+                        pass
+                    self._in_flight = len(batch)
+                for reporter in self._reporters:
+                    try:
+                        reporter.report(batch)
+                    except Exception as e:
+                        print(f"Reporter {reporter} failed: {e}")
+                with self._reported:
+                    self._in_flight = 0
+                    self._reported.notify_all()
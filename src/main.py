@@ -1,26 +1,201 @@
-from train_driver import TrainDriver
-from key_controller import KeyController
-from gui_key_controller import GuiKeyController
-from reporter import Reporter, ConsoleReporter
+"""
+The entry point. Only the frontend that is picked is imported, so a headless driver never loads tkinter.
 
+    $ python3 src/main.py                       # the GUI, same as "gui"
+    $ python3 src/main.py keys --fleet
+    $ python3 src/main.py headless --script lap.txt --programs programs.db --layout kitchen
+    $ python3 src/main.py headless --fleet --listen 127.0.0.1:7878
+    $ python3 src/main.py replay run.bin --realtime
+    $ python3 src/main.py calibrate run.bin --output calibration.json
+"""
+import argparse
+import sys
+import threading
 
-def main():
-    driver = TrainDriver()
 
-    # driver.connect(lambda s, i, n: print(f"connected = {s}, msg/id: {i}, name: {n}"), lambda s, i, n: print(f"disconnected = {s}, msg/id: {i}, name: {n}"))
-    # input("Press any key")
-    # driver.disconnect()
+def _make_driver(args):
+    """A TrainDriver, or a Fleet with --fleet, set up from the common options"""
+    program_store = None
+    if args.programs is not None:
+        from program_store import ProgramStore
+        program_store = ProgramStore(args.programs)
 
-    # key_controller = KeyController()
-    # key_controller.set_train_driver(driver)
-    # key_controller.control()
+    calibration = None
+    if args.calibration is not None:
+        from calibration import CalibrationTable
+        calibration = CalibrationTable(args.calibration)
+
+    kwargs = dict(program_store=program_store, layout_name=args.layout, calibration=calibration)
+    if args.fleet:
+        from fleet import Fleet
+        driver = Fleet(**kwargs)
+    else:
+        from train_driver import TrainDriver
+        driver = TrainDriver(**kwargs)
+
+    if args.telemetry is not None:
+        from telemetry import TelemetryRecorder
+        driver.set_telemetry(TelemetryRecorder(args.telemetry))
+    return driver
+
+
+def run_gui(args):
+    from gui_key_controller import GuiKeyController
 
     gui_controller = GuiKeyController()
+    # The console too, the GUI is one more reporter
+    driver = _make_driver(args)
     driver.add_reporter(gui_controller)
     gui_controller.set_train_driver(driver)
     gui_controller.control()
 
 
-# Press the green button in the gutter to run the script.
+def run_keys(args):
+    from key_controller import KeyController
+
+    driver = _make_driver(args)
+    key_controller = KeyController()
+    key_controller.set_train_driver(driver)
+    key_controller.control()
+
+
+def _start_server(driver, listen: str):
+    """Starts a control server on HOST:PORT, :PORT or unix:PATH"""
+    from control_server import ControlServer
+
+    if listen.startswith("unix:"):
+        server = ControlServer(driver, unix_path=listen[len("unix:"):])
+    else:
+        host, _, port = listen.rpartition(":")
+        server = ControlServer(driver, host=host or "127.0.0.1", port=int(port))
+    server.start()
+    return server
+
+
+def run_headless(args):
+    from command_parser import CommandParser, run_script
+
+    driver = _make_driver(args)
+    server = _start_server(driver, args.listen) if args.listen is not None else None
+    connected = threading.Event()
+    result = dict()
+
+    def connect_callback(success: bool, train_id_or_msg: str = "", train_name: str = None):
+        result.setdefault("success", success)
+        result.setdefault("message", train_id_or_msg)
+        connected.set()
+
+    driver.connect(connect_callback, None)
+    if not connected.wait(args.timeout) or not result["success"]:
+        print(f"Could not connect: {result.get('message', 'timeout')}", file=sys.stderr)
+        if server is not None:
+            server.stop()
+        driver.disconnect()
+        return 1
+
+    parser = CommandParser()
+    try:
+        if args.script is not None:
+            lines = sys.stdin if args.script == "-" else open(args.script)
+            with lines:
+                if run_script(driver, lines, parser):
+                    return 0
+        # Keep driving until interrupted
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.stop()
+        driver.disconnect()
+    return 0
+
+
+def run_replay(args):
+    from command_parser import CommandParser
+    from simulation import SimulatedTrain, ReplayEngine, drive_simulated, events_from_telemetry, synthetic_events
+
+    program_store = None
+    if args.programs is not None:
+        from program_store import ProgramStore
+        program_store = ProgramStore(args.programs)
+    train = SimulatedTrain(link_latency=args.link_latency)
+    driver = drive_simulated(train, program_store=program_store, layout_name=args.layout)
+
+    if args.file is not None:
+        from telemetry import TelemetryReader
+        events = list(events_from_telemetry(TelemetryReader(args.file), args.train))
+    else:
+        parser = CommandParser()
+        driver.program_command(parser.parse("program next_left when red,green"))
+        events = list(synthetic_events(args.laps))
+
+    stats = ReplayEngine(train, args.realtime).run(events)
+    driver.flush()
+    driver.disconnect()
+    print(stats)
+    print(f"Train writes: {train.writes}")
+    return 0
+
+
+def run_calibrate(args):
+    from calibration import CalibrationTable, calibrate_recording
+    from telemetry import TelemetryReader
+
+    table = CalibrationTable(args.output)
+    calibrate_recording(TelemetryReader(args.file), table, args.settle)
+    for calibration in table:
+        print(calibration)
+    table.save()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive intelino trains")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--fleet", action="store_true", help="Connect all the trains found")
+    common.add_argument("--programs", help="The program store file (SQLite)")
+    common.add_argument("--layout", default="default", help="The layout to load the programs of")
+    common.add_argument("--telemetry", help="Record telemetry to this file")
+    common.add_argument("--calibration", help="The calibration table (JSON), see calibrate")
+
+    subparsers = parser.add_subparsers(dest="frontend")
+    gui = subparsers.add_parser("gui", parents=[common], help="The tkinter GUI (default)")
+    gui.set_defaults(func=run_gui)
+
+    keys = subparsers.add_parser("keys", parents=[common], help="Commands typed in the terminal")
+    keys.set_defaults(func=run_keys)
+
+    headless = subparsers.add_parser("headless", parents=[common], help="No user interface")
+    headless.add_argument("--script", help="A command script to run after connecting, - for stdin")
+    headless.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for a train")
+    headless.add_argument("--listen", help="Serve the control API on HOST:PORT or unix:PATH")
+    headless.set_defaults(func=run_headless)
+
+    replay = subparsers.add_parser("replay", help="Replay a telemetry recording on a simulated train")
+    replay.add_argument("file", nargs="?", help="The telemetry file. Synthetic laps if not given")
+    replay.add_argument("--train", help="The train id in the recording. The first train if not given")
+    replay.add_argument("--laps", type=int, default=100, help="Synthetic laps, without a file")
+    replay.add_argument("--realtime", action="store_true")
+    replay.add_argument("--link-latency", type=float, default=0.0, help="Seconds per train command")
+    replay.add_argument("--programs", help="The program store file (SQLite)")
+    replay.add_argument("--layout", default="default", help="The layout to load the programs of")
+    replay.set_defaults(func=run_replay)
+
+    calibrate = subparsers.add_parser("calibrate", help="Fit the train calibration from a telemetry recording")
+    calibrate.add_argument("file", help="The telemetry file")
+    calibrate.add_argument("--output", default="calibration.json",
+                           help="The calibration table. The trains in the recording are replaced")
+    calibrate.add_argument("--settle", type=float, default=1.0,
+                           help="Seconds after a speed command left out of the speed fit")
+    calibrate.set_defaults(func=run_calibrate)
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if len(argv) == 0 or (argv[0] not in subparsers.choices and argv[0] not in ("-h", "--help")):
+        argv = ["gui"] + argv
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
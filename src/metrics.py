@@ -0,0 +1,222 @@
+"""
+Hot path instrumentation: latency histograms, event counters and gauges (e.g. queue depths).
+
+The histograms are log-linear, like HdrHistogram: every power of two is split into 16 buckets,
+so a value is recorded with a ~6% precision from nanoseconds to hours, in a fixed list of counts.
+Recording is a bit_length, a shift and an increment, no allocation and no lock. Under concurrent
+recording from many threads a count may be lost now and then, which is fine for statistics.
+
+    metrics = driver.metrics
+    metrics.histogram("command_latency_seconds", command="STOP").percentile(99)
+    print(metrics.report())
+    metrics.write_prometheus("driver.prom")
+"""
+import os
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Every power of two is split in 2 ** (_SUB_BITS - 1) buckets
+_SUB_BITS = 5
+_HALF = 1 << (_SUB_BITS - 1)
+# Up to 2 ** 44 ns, about 4.9 hours
+_MAX_MAGNITUDE = 44 - _SUB_BITS + 1
+_BUCKETS = (_MAX_MAGNITUDE + 2) * _HALF
+
+_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _bucket_index(value_ns: int) -> int:
+    magnitude = value_ns.bit_length() - _SUB_BITS
+    if magnitude <= 0:
+        return value_ns
+    return magnitude * _HALF + (value_ns >> magnitude)
+
+
+def _bucket_highest(index: int) -> int:
+    """The highest value recorded in the bucket"""
+    if index < 2 * _HALF:
+        return index
+    magnitude = index // _HALF - 1
+    return ((index - magnitude * _HALF + 1) << magnitude) - 1
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "count", "total_ns", "min_ns", "max_ns")
+
+    def __init__(self):
+        self.counts: List[int] = [0] * _BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+
+    def record(self, value_ns: int):
+        """Records a latency in nanoseconds, e.g. a time.perf_counter_ns() difference"""
+        index = _bucket_index(value_ns)
+        self.counts[index if index < _BUCKETS else _BUCKETS - 1] += 1
+        if self.count == 0 or value_ns < self.min_ns:
+            self.min_ns = value_ns
+        if value_ns > self.max_ns:
+            self.max_ns = value_ns
+        self.count += 1
+        self.total_ns += value_ns
+
+    def record_seconds(self, seconds: float):
+        self.record(int(seconds * 1e9))
+
+    def percentile(self, p: float) -> float:
+        """The latency in seconds that p percent of the recorded latencies are under"""
+        if self.count == 0:
+            return 0.0
+        rank = max(1, int(p / 100 * self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_highest(index), self.max_ns) / 1e9
+        return self.max_ns / 1e9
+
+    def mean(self) -> float:
+        return self.total_ns / self.count / 1e9 if self.count > 0 else 0.0
+
+    def reset(self):
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+
+    def __str__(self):
+        return (f"count {self.count}, mean {self.mean() * 1e6:.1f} us, "
+                f"p50 {self.percentile(50) * 1e6:.1f} us, p99 {self.percentile(99) * 1e6:.1f} us, "
+                f"max {self.max_ns / 1e3:.1f} us")
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = None) -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra is not None:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+
+class Metrics:
+    """
+    A registry of named metrics with labels. The metric objects are meant to be looked up once
+    and kept, so the hot path does not pay for the lookup.
+    """
+
+    def __init__(self, **labels: str):
+        """
+        Args:
+            labels: Labels of all the metrics, e.g. train="..."
+        """
+        self.labels: Dict[str, str] = dict(labels)
+        self._histograms: Dict[Tuple[str, Labels], LatencyHistogram] = dict()
+        self._counters: Dict[Tuple[str, Labels], Counter] = dict()
+        self._gauges: Dict[Tuple[str, Labels], Callable[[], float]] = dict()
+
+    def histogram(self, name: str, **labels: str) -> LatencyHistogram:
+        key = (name, _labels(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = LatencyHistogram()
+        return histogram
+
+    def counter(self, name: str, **labels: str) -> Counter:
+        key = (name, _labels(labels))
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = Counter()
+        return counter
+
+    def gauge(self, name: str, read: Callable[[], float], **labels: str):
+        """Registers a value read when the metrics are reported, e.g. a queue depth"""
+        self._gauges[(name, _labels(labels))] = read
+
+    def _all_labels(self, labels: Labels) -> Labels:
+        return _labels(self.labels) + labels
+
+    def snapshot(self) -> Dict[str, dict]:
+        """The current values, by metric name and then by labels"""
+        result: Dict[str, dict] = dict()
+        for (name, labels), histogram in self._histograms.items():
+            result.setdefault(name, dict())[labels] = {
+                "count": histogram.count, "mean": histogram.mean(), "max": histogram.max_ns / 1e9,
+                **{f"p{q * 100:g}": histogram.percentile(q * 100) for q in _QUANTILES}}
+        for (name, labels), counter in self._counters.items():
+            result.setdefault(name, dict())[labels] = counter.value
+        for (name, labels), read in self._gauges.items():
+            result.setdefault(name, dict())[labels] = read()
+        return result
+
+    def report(self) -> str:
+        """A human readable report"""
+        lines = list()
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            lines.append(f"{name}{_format_labels(labels)}: {histogram}")
+        for (name, labels), counter in sorted(self._counters.items()):
+            lines.append(f"{name}{_format_labels(labels)}: {counter.value}")
+        for (name, labels), read in sorted(self._gauges.items(), key=lambda item: item[0]):
+            lines.append(f"{name}{_format_labels(labels)}: {read()}")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        return prometheus_text((self, ))
+
+    def write_prometheus(self, path: str):
+        write_prometheus((self, ), path)
+
+
+def prometheus_text(registries: Iterable[Metrics]) -> str:
+    """
+    The metrics of one or more registries (e.g. of all the drivers of a fleet) in the Prometheus
+    text exposition format. Histograms are written as summaries with quantiles.
+    """
+    summaries: Dict[str, List[str]] = dict()
+    counters: Dict[str, List[str]] = dict()
+    gauges: Dict[str, List[str]] = dict()
+    for registry in registries:
+        for (name, labels), histogram in registry._histograms.items():
+            labels = registry._all_labels(labels)
+            lines = summaries.setdefault(name, list())
+            for q in _QUANTILES:
+                quantile = 'quantile="%g"' % q
+                lines.append(f"{name}{_format_labels(labels, quantile)} {histogram.percentile(q * 100):.9f}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.total_ns / 1e9:.9f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for (name, labels), counter in registry._counters.items():
+            counters.setdefault(name, list()).append(
+                f"{name}{_format_labels(registry._all_labels(labels))} {counter.value}")
+        for (name, labels), read in registry._gauges.items():
+            gauges.setdefault(name, list()).append(
+                f"{name}{_format_labels(registry._all_labels(labels))} {read()}")
+
+    out = list()
+    for kind, families in (("summary", summaries), ("counter", counters), ("gauge", gauges)):
+        for name in sorted(families):
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(families[name])
+    return "\n".join(out) + "\n"
+
+
+def write_prometheus(registries: Iterable[Metrics], path: str):
+    """Writes the metrics to a file atomically, e.g. for the node exporter textfile collector"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(prometheus_text(registries))
+    os.replace(temp_path, path)
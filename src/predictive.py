@@ -0,0 +1,173 @@
+"""
+Predictive steering, to beat the BLE round trip.
+
+The train holds one steering decision, for the next split. After a split the driver sends the decision
+for the following one, which only works if the train does not get there before the command does.
+The predictor uses the learnt layout (the distance of every split from the last landmark), the measured
+velocity and the measured link latency to:
+
+  - preload the steering of the landmark ahead, when its split comes right after it
+  - slow the train down before a split, when the split after it is closer than the link latency
+    at the current speed, and speed up again after it
+"""
+import time
+from typing import Dict, Tuple
+
+from intelino.trainlib_async.enums import SteeringDecision
+from color_matcher import ColorSequenceMatcher, SnapMatch
+from enums import CommandId, Speed
+from layout import LayoutObserver, TrackEdge
+from util import ColorSequence
+
+# The command types the link latency is measured for
+SPEED = "speed"
+STEERING = "steering"
+SNAPS = "snaps"
+
+_STEERING_COMMANDS = {
+    CommandId.NEXT_LEFT: SteeringDecision.LEFT,
+    CommandId.NEXT_RIGHT: SteeringDecision.RIGHT,
+    CommandId.NEXT_STRAIGHT: SteeringDecision.STRAIGHT,
+    CommandId.KEEP_LEFT: SteeringDecision.LEFT,
+    CommandId.KEEP_RIGHT: SteeringDecision.RIGHT,
+    CommandId.KEEP_STRAIGHT: SteeringDecision.STRAIGHT,
+}
+
+
+class LatencyStats:
+    __slots__ = ("count", "average", "last", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.average = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def __str__(self):
+        return (f"{self.count} commands, average {self.average * 1000:.1f} ms, "
+                f"last {self.last * 1000:.1f} ms, max {self.max * 1000:.1f} ms")
+
+
+class LinkLatency:
+    """
+    The command to effect latency per command type. The train library calls block until the train
+    acknowledged the command, so the time spent in a call is the latency of the command.
+    The average is exponentially weighted, so it follows the radio conditions.
+    """
+
+    def __init__(self, smoothing: float = 0.2, initial: float = 0.1):
+        """
+        Args:
+            smoothing: The weight of the last measurement in the average
+            initial: The latency in seconds assumed before the first measurement
+        """
+        self._smoothing = smoothing
+        # Replaced by the calibrated latency of the train, see calibration.py
+        self.initial = initial
+        self._stats: Dict[str, LatencyStats] = dict()
+
+    def record(self, command_type: str, seconds: float):
+        stats = self._stats.get(command_type)
+        if stats is None:
+            stats = self._stats[command_type] = LatencyStats()
+            stats.average = seconds
+        else:
+            stats.average += (seconds - stats.average) * self._smoothing
+        stats.count += 1
+        stats.last = seconds
+        if seconds > stats.max:
+            stats.max = seconds
+
+    def measure(self, command_type: str, call, *args):
+        """Calls call(*args) and records how long it took"""
+        start = time.perf_counter()
+        result = call(*args)
+        self.record(command_type, time.perf_counter() - start)
+        return result
+
+    def estimate(self, command_type: str) -> float:
+        """The expected latency in seconds"""
+        stats = self._stats.get(command_type)
+        return stats.average if stats is not None else self.initial
+
+    def stats(self) -> Dict[str, LatencyStats]:
+        return dict(self._stats)
+
+    def __str__(self):
+        return "\n".join(f"{command_type}: {stats}" for command_type, stats in self._stats.items())
+
+
+class SteeringPredictor:
+    def __init__(self, latency: LinkLatency, margin_s: float = 0.15, level_speeds: Dict[Speed, float] = None):
+        """
+        Args:
+            latency: The measured link latency
+            margin_s: Seconds added to the latency, for the time between the split and the callback
+            level_speeds: The actual cm/s of the speed levels of the train. The nominal ones if None
+        """
+        self.latency = latency
+        self.margin_s = margin_s
+        self.level_speeds: Dict[Speed, float] = level_speeds if level_speeds is not None else \
+            {level: level.speed for level in Speed}
+
+    def lead_time(self, command_type: str = STEERING) -> float:
+        """How early a command must be sent, in seconds"""
+        return self.latency.estimate(command_type) + self.margin_s
+
+    @staticmethod
+    def next_split(observer: LayoutObserver, distance_cm: int) -> Tuple[TrackEdge, float]:
+        """
+        Where the train most likely is, from the layout.
+
+        Returns: The edge and the distance to its next split in cm, None if there is no split before the
+                 edge destination. (None, None) if the layout does not know the way.
+        """
+        if observer.last_landmark is None:
+            return None, None
+        decisions = observer.decisions()
+        edge = observer.layout.likely_edge(observer.last_landmark, decisions)
+        if edge is None:
+            return None, None
+        if len(decisions) < len(edge.decisions):
+            travelled = observer.distance_since_landmark(distance_cm)
+            return edge, max(0.0, edge.split_offsets[len(decisions)] - travelled)
+        return edge, None
+
+    def split_gap(self, observer: LayoutObserver, distance_cm: int) -> float:
+        """The distance in cm between the next split and the one after it, None if the layout does not know"""
+        edge, remaining = self.next_split(observer, distance_cm)
+        if edge is None or remaining is None:
+            return None
+        n = len(observer.decisions())
+        offsets = edge.split_offsets
+        if n + 1 < len(offsets):
+            return offsets[n + 1] - offsets[n]
+        after = observer.layout.likely_edge(ColorSequence.from_identity(edge.destination), ())
+        if after is None or len(after.split_offsets) == 0:
+            return None
+        return edge.distance_cm - offsets[n] + after.split_offsets[0]
+
+    @staticmethod
+    def preload_decision(edge: TrackEdge, matcher: ColorSequenceMatcher) -> SteeringDecision:
+        """The steering the program of the edge destination sets, None if it does not steer"""
+        payload = matcher.get(ColorSequence.from_identity(edge.destination))
+        if payload is None or payload[0] != SnapMatch.PROGRAM:
+            return None
+        return _STEERING_COMMANDS.get(payload[1].command.cmd_id)
+
+    def safe_speed(self, remaining_cm: float, speed_cmps: float) -> Speed:
+        """
+        Args:
+            remaining_cm: The distance the steering command has to beat
+            speed_cmps: The current velocity
+
+        Returns: The fastest speed level that gets there after the steering command, None if the speed is fine
+        """
+        lead = self.lead_time(STEERING)
+        if speed_cmps <= 0 or remaining_cm >= speed_cmps * lead:
+            return None
+        needed_cmps = remaining_cm / lead
+        for level in (Speed.FIVE, Speed.FOUR, Speed.THREE, Speed.TWO):
+            if self.level_speeds[level] <= needed_cmps:
+                return level
+        return Speed.MIN
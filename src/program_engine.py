@@ -0,0 +1,182 @@
+"""
+Multi-step programs: a snap sequence (or a typed command) runs a few steps, with waits and conditions.
+
+    program speed 2; wait 30 cm; speed 4 when red,green
+    program if speed >= 4; every 2; next left; wait 3 s; speed 5 when yellow
+
+The steps are compiled once, when the program is added, into a tuple of (opcode, operand), where the
+operand is the command, the wait or a closure for the condition, so running a step is a dispatch.
+The runs go on the shared timer wheel, never on the train callback thread: a trigger only schedules
+the run. A wait in cm or splits goes on the distance or split wheel of the driver, see scheduler.py.
+
+A program that triggers again while it still runs restarts, its previous run is cancelled.
+"""
+import operator
+import threading
+from typing import Callable, Dict
+
+from intelino.trainlib.enums import MovementDirection
+from enums import CommandId
+from scheduler import TimerWheel, Timer
+from util import Script
+
+# The opcodes
+_EXECUTE = 0
+_WAIT_S = 1
+_WAIT_CM = 2
+_WAIT_SPLITS = 3
+_GUARD = 4
+
+_WAITS = {"s": _WAIT_S, "cm": _WAIT_CM, "splits": _WAIT_SPLITS}
+
+_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+class ScriptRun:
+    __slots__ = ("key", "ops", "count", "pc", "timer", "cancelled")
+
+    def __init__(self, key, ops: tuple, count: int):
+        """
+        Args:
+            key: The program (its sequence identity) or None for a command
+            ops: The compiled steps
+            count: How many times the program ran, this run included
+        """
+        self.key = key
+        self.ops = ops
+        self.count = count
+        # The next step
+        self.pc = 0
+        self.timer: Timer = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+def _subject(name: str) -> Callable:
+    """Returns: value(driver, run) of a condition subject"""
+    if name == "speed":
+        return lambda driver, run: driver.state.speed_level.value
+    if name == "direction":
+        return lambda driver, run: driver.state.direction
+    if name == "junctions":
+        return lambda driver, run: driver.junctions_passed
+    if name == "runs":
+        return lambda driver, run: run.count
+    raise ValueError(f"Unknown condition subject {name}")
+
+
+def _condition(subject: str, op: str, value) -> Callable:
+    """Returns: holds(driver, run)"""
+    get = _subject(subject)
+    compare = _OPERATORS[op]
+    if subject == "direction":
+        value = MovementDirection[value.upper()]
+    return lambda driver, run: compare(get(driver, run), value)
+
+
+def _every(n: int) -> Callable:
+    return lambda driver, run: run.count % n == 0
+
+
+def compile_script(script: Script) -> tuple:
+    """Compiles the steps of a script, once. Returns: The compiled steps, also kept in script.compiled"""
+    if script.compiled is not None:
+        return script.compiled
+    ops = list()
+    for step in script.steps:
+        if step.cmd_id == CommandId.WAIT:
+            amount, unit = step.args
+            ops.append((_WAITS[unit], amount))
+        elif step.cmd_id == CommandId.IF:
+            ops.append((_GUARD, _condition(*step.args)))
+        elif step.cmd_id == CommandId.EVERY:
+            ops.append((_GUARD, _every(step.args[0])))
+        else:
+            ops.append((_EXECUTE, step))
+    script.compiled = tuple(ops)
+    return script.compiled
+
+
+class ProgramEngine:
+    """Runs the multi-step programs of a driver on a timer wheel"""
+
+    def __init__(self, driver, wheel: TimerWheel):
+        """
+        Args:
+            driver: The TrainDriver the steps are executed on
+            wheel: The timer wheel the runs go on, shared by the drivers
+        """
+        self._driver = driver
+        self._wheel = wheel
+        self._lock = threading.Lock()
+        self._runs: Dict[object, ScriptRun] = dict()
+        self._counts: Dict[object, int] = dict()
+
+    def trigger(self, key, script: Script):
+        """
+        Starts a run of a script, from any thread. It returns at once, the steps run on the wheel
+
+        Args:
+            key: The program, e.g. its sequence identity. A run of the same key is cancelled
+            script: The script
+        """
+        ops = compile_script(script)
+        with self._lock:
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+            previous = self._runs.get(key)
+            if previous is not None:
+                previous.cancel()
+            run = self._runs[key] = ScriptRun(key, ops, count)
+            run.timer = self._wheel.schedule(0, self._resume, run)
+
+    def running(self) -> int:
+        return len(self._runs)
+
+    def cancel_all(self):
+        with self._lock:
+            for run in self._runs.values():
+                run.cancel()
+            self._runs.clear()
+
+    def _resume(self, run: ScriptRun):
+        """Runs the steps up to the next wait or the end, on the wheel thread"""
+        driver = self._driver
+        ops = run.ops
+        try:
+            while run.pc < len(ops) and not run.cancelled:
+                opcode, operand = ops[run.pc]
+                run.pc += 1
+                if opcode == _EXECUTE:
+                    driver.execute(operand)
+                elif opcode == _GUARD:
+                    if not operand(driver, run):
+                        break
+                elif opcode == _WAIT_S:
+                    run.timer = self._wheel.schedule(operand, self._resume, run)
+                    return
+                elif opcode == _WAIT_CM:
+                    run.timer = driver.after_distance(operand, self._resume, run)
+                    return
+                elif opcode == _WAIT_SPLITS:
+                    run.timer = driver.after_splits(operand, self._resume, run)
+                    return
+        except Exception as error:
+            driver.log(f"Program step {run.pc} of {run.key} failed: {error}")
+        self._finish(run)
+
+    def _finish(self, run: ScriptRun):
+        with self._lock:
+            if self._runs.get(run.key) is run:
+                del self._runs[run.key]
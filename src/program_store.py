@@ -0,0 +1,182 @@
+"""
+Persistent snap programs, in an SQLite file.
+
+The programs are kept per layout name, keyed by the identity of their color sequence, so switching
+layouts is one indexed query. Every change of a layout bumps its version, and every program keeps
+the version it was written at.
+
+    store = ProgramStore("programs.db")
+    driver = TrainDriver(program_store=store, layout_name="kitchen")
+"""
+import sqlite3
+import threading
+from typing import List
+
+from command_parser import CommandParser
+from enums import CommandId
+from util import ColorSequence, Command, CommandFormatException, Program, Script
+
+# The identities are text, a long sequence does not fit in an SQLite integer. The argument has no affinity,
+# so it comes back as it was saved, e.g. a name like "007" stays text
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS layouts (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS programs (
+    layout TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    cmd_id INTEGER NOT NULL,
+    arg BLOB, -- an int, or text for the words, the colours and the multi-step commands
+    target TEXT,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (layout, identity)
+) WITHOUT ROWID;
+"""
+# PRAGMA user_version. 0 had integer identities and arguments
+_SCHEMA_VERSION = 1
+
+
+def _arg(command: Command):
+    """
+    The argument of a command as an int, or as text for the words, the colours and the multi-step commands.
+    All the commands take at most one
+
+    Raises: CommandFormatException if the argument cannot be saved, e.g. the callbacks of connect
+    """
+    if len(command.args) == 0 or command.args[0] is None:
+        return None
+    arg = command.args[0]
+    if isinstance(arg, ColorSequence):
+        return str(arg.identity())
+    if isinstance(arg, Script):
+        return arg.source
+    if isinstance(arg, (str, int)):
+        return arg
+    raise CommandFormatException(f"Cannot save {command.cmd_id.name} in a program, its argument is not "
+                                 f"a number, a name, colours or steps")
+
+
+def _command(cmd_id: int, arg, target: str) -> Command:
+    cmd_id = CommandId(cmd_id)
+    if arg is None:
+        return Command(cmd_id, target=target)
+    if cmd_id == CommandId.ROUTE:
+        return Command(cmd_id, ColorSequence.from_identity(int(arg)), target=target)
+    if cmd_id == CommandId.SCRIPT:
+        # The source is parsed again, the parser is the only one that makes scripts
+        command = CommandParser().parse_command(arg)
+        command.target = target
+        return command
+    return Command(cmd_id, arg, target=target)
+
+
+class ProgramStore:
+    """
+    An SQLite index of the programs. It can be shared by many drivers (e.g. a fleet) and threads.
+    Every write is its own small transaction.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: The database file, created if it does not exist. ":memory:" for a temporary store
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._create()
+
+    def load(self, layout: str) -> List[Program]:
+        """All the programs of a layout, in one query"""
+        with self._lock:
+            rows = self._db.execute("SELECT identity, cmd_id, arg, target FROM programs WHERE layout = ?",
+                                    (layout, )).fetchall()
+        return [Program(ColorSequence.from_identity(int(identity)), _command(cmd_id, arg, target))
+                for identity, cmd_id, arg, target in rows]
+
+    def save(self, layout: str, program: Program) -> bool:
+        """
+        Adds or replaces a program of a layout
+
+        Returns: True if the layout changed, False if the same program was already there
+        Raises: CommandFormatException if the command cannot be saved
+        """
+        command = program.command
+        arg = _arg(command)
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            version = self._next_version(layout)
+            cursor = self._db.execute(
+                "INSERT INTO programs (layout, identity, cmd_id, arg, target, version) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (layout, identity) DO UPDATE SET "
+                "cmd_id = excluded.cmd_id, arg = excluded.arg, target = excluded.target, version = excluded.version "
+                "WHERE cmd_id != excluded.cmd_id OR arg IS NOT excluded.arg OR target IS NOT excluded.target",
+                (layout, str(program.seq.identity()), int(command.cmd_id), arg, command.target, version))
+            if cursor.rowcount == 0:
+                self._db.execute("ROLLBACK")
+                return False
+            self._db.execute("INSERT INTO layouts (name, version) VALUES (?, ?) "
+                             "ON CONFLICT (name) DO UPDATE SET version = excluded.version", (layout, version))
+            return True
+
+    def remove(self, layout: str, seq: ColorSequence) -> bool:
+        """Returns: True if there was such a program"""
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            cursor = self._db.execute("DELETE FROM programs WHERE layout = ? AND identity = ?",
+                                      (layout, str(seq.identity())))
+            if cursor.rowcount == 0:
+                self._db.execute("ROLLBACK")
+                return False
+            self._db.execute("INSERT INTO layouts (name, version) VALUES (?, ?) "
+                             "ON CONFLICT (name) DO UPDATE SET version = excluded.version",
+                             (layout, self._next_version(layout)))
+            return True
+
+    def version(self, layout: str) -> int:
+        """The version of a layout, 0 if it has never been written"""
+        with self._lock:
+            row = self._db.execute("SELECT version FROM layouts WHERE name = ?", (layout, )).fetchone()
+        return row[0] if row is not None else 0
+
+    def layouts(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT name FROM layouts ORDER BY name")]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _create(self):
+        """Creates the tables of a new file, or rebuilds the programs table of an older one"""
+        if self._db.execute("PRAGMA user_version").fetchone()[0] >= _SCHEMA_VERSION:
+            return
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            old = self._db.execute("SELECT 1 FROM sqlite_master "
+                                   "WHERE type = 'table' AND name = 'programs'").fetchone()
+            if old is not None:
+                self._db.execute("ALTER TABLE programs RENAME TO programs_old")
+            # Not executescript, it would commit the transaction
+            for statement in _SCHEMA.split(";"):
+                if statement.strip() != "":
+                    self._db.execute(statement)
+            if old is not None:
+                self._db.execute("INSERT INTO programs SELECT layout, CAST(identity AS TEXT), cmd_id, "
+                                 "CASE WHEN cmd_id = ? THEN CAST(arg AS TEXT) ELSE arg END, target, version "
+                                 "FROM programs_old", (int(CommandId.ROUTE), ))
+                self._db.execute("DROP TABLE programs_old")
+            self._db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _next_version(self, layout: str) -> int:
+        row = self._db.execute("SELECT version FROM layouts WHERE name = ?", (layout, )).fetchone()
+        return (row[0] if row is not None else 0) + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,168 @@
+"""
+Speed ramping: the speed changes in steps over time, instead of jumping from level to level.
+
+A profile is a precomputed table of the speeds a ramp goes through and the time between them.
+Ramping from one speed to another is a slice of the table, so a ramp is a handful of drive_at_speed
+writes, each one scheduled on the shared timer wheel. The steps are as coarse as the profile allows,
+so a ramp costs few BLE writes and leaves the link to the steering.
+
+Changing direction while moving ramps down to a stop, flips the direction and ramps back up.
+"""
+import math
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Tuple
+
+from intelino.trainlib.enums import MovementDirection
+from enums import Speed
+from scheduler import TimerWheel, Timer
+
+# drive(speed_cmps, direction, priority)
+DriveFunction = Callable[[float, MovementDirection, bool], None]
+
+
+def _s_curve(fraction: float) -> float:
+    """Half the acceleration when starting and near the top speed, full acceleration in the middle"""
+    return 0.5 + 0.5 * math.sin(math.pi * fraction)
+
+
+class RampProfile:
+    """
+    speeds[i] are the speeds of the steps. up[i] and down[i] are the seconds between speeds[i]
+    and speeds[i + 1], when accelerating and when decelerating.
+    """
+
+    def __init__(self, name: str, acceleration_cmps2: float, deceleration_cmps2: float, step_cmps: float,
+                 easing: Callable[[float], float] = None, max_cmps: float = Speed.MAX.speed):
+        """
+        Args:
+            name: The profile name
+            acceleration_cmps2: cm/s per second. 0 for no ramping
+            deceleration_cmps2: cm/s per second. 0 for no ramping
+            step_cmps: The speed difference between two writes. Larger is fewer writes
+            easing: The fraction of the acceleration by the fraction of the top speed. Constant if None
+        """
+        self.name = name
+        count = max(1, math.ceil(max_cmps / step_cmps))
+        self.speeds: List[float] = [min(max_cmps, i * step_cmps) for i in range(count + 1)]
+        self.up: List[float] = list()
+        self.down: List[float] = list()
+        for i in range(count):
+            delta = self.speeds[i + 1] - self.speeds[i]
+            factor = easing((self.speeds[i] + delta / 2) / max_cmps) if easing is not None else 1.0
+            self.up.append(delta / (acceleration_cmps2 * factor) if acceleration_cmps2 > 0 else 0.0)
+            self.down.append(delta / (deceleration_cmps2 * factor) if deceleration_cmps2 > 0 else 0.0)
+
+    def _index(self, speed_cmps: float) -> int:
+        """The index of the table speed closest to a speed"""
+        step = self.speeds[1] - self.speeds[0]
+        return min(len(self.speeds) - 1, max(0, int(speed_cmps / step + 0.5)))
+
+    def steps(self, from_cmps: float, to_cmps: float) -> List[Tuple[float, float]]:
+        """
+        Returns: (seconds since the previous write, speed) of every write from one speed to the other.
+                 The first write is immediate and the last one is the target speed.
+        """
+        if self.up[0] == 0 and to_cmps > from_cmps or self.down[0] == 0 and to_cmps < from_cmps:
+            return [(0.0, to_cmps)]
+        i = self._index(from_cmps)
+        j = self._index(to_cmps)
+        result = list()
+        wait = 0.0
+        if j > i:
+            for k in range(i, j):
+                result.append((wait, self.speeds[k + 1]))
+                wait = self.up[k]
+        else:
+            for k in range(i - 1, j - 1, -1):
+                result.append((wait, self.speeds[k]))
+                wait = self.down[k]
+        if len(result) == 0 or result[-1][1] != to_cmps:
+            result.append((wait, to_cmps))
+        return result
+
+
+PROFILES: Dict[str, RampProfile] = {
+    "instant": RampProfile("instant", 0, 0, Speed.MAX.speed),
+    "gentle": RampProfile("gentle", 20, 25, 7.5, _s_curve),
+    "normal": RampProfile("normal", 40, 50, 7.5),
+    "sport": RampProfile("sport", 80, 100, 15),
+}
+
+
+class SpeedRamp:
+    """Ramps the speed of one train, on a shared timer wheel"""
+
+    def __init__(self, drive: DriveFunction, wheel: TimerWheel, profile: RampProfile = PROFILES["normal"]):
+        self.profile = profile
+        # The last speed and direction written
+        self.speed_cmps: float = 0.0
+        self.direction: MovementDirection = MovementDirection.FORWARD
+        self._drive = drive
+        self._wheel = wheel
+        self._lock = threading.Lock()
+        # (seconds since the previous write, speed, direction)
+        self._steps: deque = deque()
+        self._timer: Timer = None
+        # Bumped on every cancel, so a timer that fired just before the cancel is ignored
+        self._generation: int = 0
+
+    def is_ramping(self) -> bool:
+        return len(self._steps) > 0
+
+    def set(self, speed_cmps: float, direction: MovementDirection, priority: bool = False):
+        """Writes the speed now, ending a ramp"""
+        with self._lock:
+            self._cancel()
+            self._write(speed_cmps, direction, priority)
+
+    def ramp_to(self, speed_cmps: float, direction: MovementDirection):
+        with self._lock:
+            self._cancel()
+            if direction != self.direction and self.speed_cmps > 0:
+                self._steps.extend((wait, speed, self.direction)
+                                   for wait, speed in self.profile.steps(self.speed_cmps, 0))
+                up = self.profile.steps(0, speed_cmps)
+                # Stand still for a step before moving the other way, so the stop is not coalesced away
+                up[0] = (self.profile.down[0], up[0][1])
+                self._steps.extend((wait, speed, direction) for wait, speed in up)
+            elif speed_cmps != self.speed_cmps:
+                self._steps.extend((wait, speed, direction)
+                                   for wait, speed in self.profile.steps(self.speed_cmps, speed_cmps))
+            else:
+                self._steps.append((0.0, speed_cmps, direction))
+            self._next()
+
+    def cancel(self):
+        with self._lock:
+            self._cancel()
+
+    def _cancel(self):
+        self._generation += 1
+        self._steps.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _write(self, speed_cmps: float, direction: MovementDirection, priority: bool = False):
+        self.speed_cmps = speed_cmps
+        self.direction = direction
+        self._drive(speed_cmps, direction, priority)
+
+    def _next(self):
+        """Writes the steps that are due and schedules the next one, under the lock"""
+        self._timer = None
+        while len(self._steps) > 0:
+            wait, speed, direction = self._steps[0]
+            if wait > 0:
+                # Only the first step of the rest of the ramp waits
+                self._steps[0] = (0.0, speed, direction)
+                self._timer = self._wheel.schedule(wait, self._step, self._generation)
+                return
+            self._steps.popleft()
+            self._write(speed, direction)
+
+    def _step(self, generation: int):
+        with self._lock:
+            if generation == self._generation:
+                self._next()
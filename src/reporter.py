@@ -1,4 +1,22 @@
 from abc import ABC, abstractmethod
+from typing import List
+
+
+class LogRecord:
+    __slots__ = ("timestamp", "message", "newline", "repeat")
+
+    def __init__(self, timestamp: float, message: str, newline: bool = True):
+        self.timestamp = timestamp
+        self.message = message
+        self.newline = newline
+        # How many more times the same message was logged and coalesced into this record
+        self.repeat = 0
+
+    def text(self) -> str:
+        message = str(self.message)
+        if self.repeat > 0:
+            message = f"{message} (repeated {self.repeat} more times)"
+        return f"{message}\n" if self.newline else message
 
 
 class Reporter(ABC):
@@ -10,6 +28,14 @@ class Reporter(ABC):
     def log(self, message: str):
         pass
 
+    def report(self, records: List[LogRecord]):
+        """Reports a batch of records. Override it when a batch can be written at once."""
+        for record in records:
+            if record.repeat > 0 or not record.newline:
+                self.logn(record.text())
+            else:
+                self.log(record.message)
+
 
 class ConsoleReporter(Reporter):
     def logn(self, message: str):
@@ -17,3 +43,6 @@ class ConsoleReporter(Reporter):
 
     def log(self, message: str):
         print(message)
+
+    def report(self, records: List[LogRecord]):
+        print(''.join(map(LogRecord.text, records)), end='', flush=True)
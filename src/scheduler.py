@@ -0,0 +1,390 @@
+"""
+Hierarchical timer wheels: one thread runs the timers of all the trains, by time, distance or splits.
+
+A wheel keys its timers on an integer that only goes up: a time tick, the odometer in cm or the splits passed.
+Level 0 has a slot per key for the next 64 keys, level 1 a slot per 64 keys for the next 64 * 64, and so on,
+so scheduling and cancelling are O(1) and moving on a key only looks at one slot, plus a higher level slot
+every 64 keys, whose timers cascade down a level.
+
+The TimerWheel runs on its own thread, which sleeps until the next timer (or while there are none).
+A CountWheel is advanced by the train events, e.g. the splits, and a DistanceWheel also checks the odometer
+on the TimerWheel at the time the train should get to its next timer. All the callbacks run on the TimerWheel
+thread and must be short, e.g. queue a train command.
+
+    wheel = shared_wheel()
+    timer = wheel.schedule(0.5, print, "half a second later")
+    timer.cancel()
+    distance = DistanceWheel(wheel, lambda: train.distance_cm, lambda: train.speed_cmps)
+    distance.schedule(30, driver.stop)
+"""
+import threading
+import time
+import traceback
+from threading import Thread
+from typing import Callable, List
+
+# The slots of a level are 2 ** _BITS
+_BITS = 6
+_SLOTS = 1 << _BITS
+_MASK = _SLOTS - 1
+
+
+class Timer:
+    __slots__ = ("key", "callback", "args", "cancelled")
+
+    def __init__(self, key: int, callback: Callable, args: tuple):
+        """
+        Args:
+            key: The tick, cm or count the timer fires at
+        """
+        self.key = key
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancelled timers are dropped when their slot comes up"""
+        self.cancelled = True
+
+
+def _fire(timers: List[Timer]):
+    for timer in timers:
+        if not timer.cancelled:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                # A failing timer must not stop the timers of the other trains
+                traceback.print_exc()
+
+
+def _key(timer: Timer) -> int:
+    return timer.key
+
+
+class HierarchicalWheel:
+    """The timers by key, in levels of 64 slots. Not thread safe, the wheels below lock around it"""
+
+    def __init__(self, levels: int = 4, key: int = 0):
+        """
+        Args:
+            levels: The levels, the wheel spans 64 ** levels keys. Timers further away wait in the last level
+            key: The key it starts at
+        """
+        self.key = key
+        self._levels: List[List[List[Timer]]] = [[list() for _ in range(_SLOTS)] for _ in range(levels)]
+        self._span = 1 << (_BITS * levels)
+        self._count = 0
+
+    def __len__(self):
+        """The timers, including the cancelled ones not dropped yet"""
+        return self._count
+
+    def add(self, timer: Timer):
+        """Adds a timer, one due at or before the current key comes up on the next advance"""
+        self._count += 1
+        self._place(timer)
+
+    def _place(self, timer: Timer):
+        key = max(timer.key, self.key + 1)
+        delta = min(key - self.key, self._span - 1)
+        level = 0
+        while delta >= _SLOTS:
+            delta >>= _BITS
+            level += 1
+        if level > 0:
+            # Clamped to the last level, the timer comes down again at the end of the span
+            key = min(key, self.key + self._span - 1)
+        self._levels[level][(key >> (_BITS * level)) & _MASK].append(timer)
+
+    def advance(self, key: int) -> List[Timer]:
+        """Moves on to the key. Returns: The timers that are due, in key order"""
+        due = list()
+        if key - self.key > self._span:
+            # A long jump visits every slot, cascading everything down first
+            self._cascade_all(due, key)
+        while self.key < key:
+            self.key += 1
+            self._tick(due, key)
+        if len(due) > 1:
+            # A cascade puts the timers due already in the current slot, after the ones due later.
+            # Stable, the timers of the same key keep their order
+            due.sort(key=_key)
+        return due
+
+    def _tick(self, due: List[Timer], key: int):
+        k = self.key
+        if k & _MASK == 0:
+            # The higher levels first, their timers may cascade to the slot of this key
+            top = 1
+            while top < len(self._levels) - 1 and (k >> (_BITS * top)) & _MASK == 0:
+                top += 1
+            for level in range(top, 0, -1):
+                slot = self._levels[level]
+                index = (k >> (_BITS * level)) & _MASK
+                timers = slot[index]
+                if len(timers) > 0:
+                    slot[index] = list()
+                    for timer in timers:
+                        self._place_or_drop(timer)
+        slot = self._levels[0]
+        timers = slot[k & _MASK]
+        if len(timers) > 0:
+            slot[k & _MASK] = list()
+            for timer in timers:
+                if timer.cancelled:
+                    self._count -= 1
+                elif timer.key <= key:
+                    due.append(timer)
+                    self._count -= 1
+                else:
+                    self._place(timer)
+
+    def _place_or_drop(self, timer: Timer):
+        if timer.cancelled:
+            self._count -= 1
+        elif timer.key <= self.key:
+            self._levels[0][self.key & _MASK].append(timer)
+        else:
+            self._place(timer)
+
+    def _cascade_all(self, due: List[Timer], key: int):
+        timers = [timer for level in self._levels for slot in level for timer in slot]
+        self._levels = [[list() for _ in range(_SLOTS)] for _ in range(len(self._levels))]
+        self._count = 0
+        self.key = key - _SLOTS
+        for timer in sorted(timers, key=lambda t: t.key):
+            if timer.cancelled:
+                continue
+            if timer.key <= self.key:
+                due.append(timer)
+            else:
+                self.add(timer)
+
+    def next_key(self) -> int:
+        """
+        The key to look again at: the next one with level 0 timers, or the next cascade.
+        Only the level 0 slots up to the next cascade are looked at
+        """
+        slot = self._levels[0]
+        key = self.key + 1
+        while True:
+            if len(slot[key & _MASK]) > 0 or key & _MASK == 0:
+                return key
+            key += 1
+
+    def clear(self, key: int = None):
+        """Drops all the timers. Args: key: The key it goes on from, the same if None"""
+        self._levels = [[list() for _ in range(_SLOTS)] for _ in range(len(self._levels))]
+        self._count = 0
+        if key is not None:
+            self.key = key
+
+
+class TimerWheel:
+    def __init__(self, tick_s: float = 0.01, levels: int = 4, name: str = "timer-wheel"):
+        """
+        Args:
+            tick_s: The resolution in seconds. Timers fire on the first tick at or after their deadline
+            levels: The levels of the wheel, it spans 64 ** levels ticks, 46 hours at 10 ms
+        """
+        self.tick_s = tick_s
+        self._timers = HierarchicalWheel(levels)
+        # The timers without a delay, run before the next tick
+        self._ready: List[Timer] = list()
+        self._cond = threading.Condition()
+        self._start = time.monotonic()
+        self._running = True
+        self._thread = Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def now_tick(self) -> int:
+        return int((time.monotonic() - self._start) / self.tick_s)
+
+    def schedule(self, delay_s: float, callback: Callable, *args) -> Timer:
+        """Calls callback(*args) on the wheel thread after delay_s seconds, as soon as possible if 0"""
+        with self._cond:
+            if delay_s <= 0:
+                timer = Timer(self._timers.key, callback, args)
+                self._ready.append(timer)
+            else:
+                if len(self._timers) == 0:
+                    # The wheel did not move while it was empty
+                    self._timers.key = max(self._timers.key, self.now_tick())
+                # The first tick at or after the deadline
+                tick = -int(-(time.monotonic() - self._start + delay_s) // self.tick_s)
+                timer = Timer(tick, callback, args)
+                self._timers.add(timer)
+            self._cond.notify()
+            return timer
+
+    def call_soon(self, callback: Callable, *args):
+        """Calls callback(*args) on the wheel thread as soon as possible, e.g. from a train callback"""
+        self.schedule(0, callback, *args)
+
+    def __len__(self):
+        """The timers scheduled, including the cancelled ones not dropped yet"""
+        return len(self._timers) + len(self._ready)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and len(self) == 0:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                due = self._ready
+                self._ready = list()
+                due.extend(self._timers.advance(self.now_tick()))
+                if len(due) == 0:
+                    next_time = self._start + self._timers.next_key() * self.tick_s
+                    self._cond.wait(max(0.0, next_time - time.monotonic()))
+                    continue
+            _fire(due)
+
+
+class CountWheel:
+    """
+    Timers keyed on a count of a train that only goes up, e.g. the splits passed.
+    The count is advanced from any thread, the callbacks run on the TimerWheel thread
+    """
+
+    def __init__(self, wheel: TimerWheel, count: int = 0, levels: int = 3):
+        """
+        Args:
+            wheel: The timer wheel the callbacks run on
+            count: The count now
+        """
+        self._wheel = wheel
+        self._lock = threading.Lock()
+        self._timers = HierarchicalWheel(levels, count)
+
+    @property
+    def count(self) -> int:
+        return self._timers.key
+
+    def __len__(self):
+        return len(self._timers)
+
+    def schedule(self, after: float, callback: Callable, *args) -> Timer:
+        """Calls callback(*args) on the wheel thread when the count went up by after, rounded up"""
+        with self._lock:
+            timer = Timer(self._timers.key + max(1, -int(-after // 1)), callback, args)
+            self._timers.add(timer)
+        self._scheduled(timer)
+        return timer
+
+    def schedule_at(self, count: float, callback: Callable, *args) -> Timer:
+        """Calls callback(*args) on the wheel thread when the count gets to count, on the next advance if it did"""
+        with self._lock:
+            timer = Timer(-int(-count // 1), callback, args)
+            self._timers.add(timer)
+        self._scheduled(timer)
+        return timer
+
+    def _scheduled(self, timer: Timer):
+        pass
+
+    def advance(self, count: int):
+        """Moves on to the count, from the train callbacks. The timers due fire on the wheel thread"""
+        with self._lock:
+            if count <= self._timers.key:
+                return
+            if len(self._timers) == 0:
+                self._timers.key = count
+                return
+            due = self._timers.advance(count)
+        if len(due) > 0:
+            self._wheel.call_soon(_fire, due)
+
+    def reset(self, count: int = 0):
+        """Drops the timers, e.g. when the train disconnects, and goes on from the count"""
+        with self._lock:
+            self._timers.clear(count)
+
+
+class DistanceWheel(CountWheel):
+    """
+    Timers keyed on the odometer of a train, in cm. The train callbacks advance it with the distance
+    they report, and while there are timers it checks the odometer on the TimerWheel at the time
+    the train should get to the next one at its speed, so a timer fires even with no event around
+    """
+
+    # The longest time between two checks, the train may speed up meanwhile
+    MAX_CHECK_S = 0.5
+    # While the train stands still
+    IDLE_CHECK_S = 0.1
+
+    def __init__(self, wheel: TimerWheel, odometer: Callable[[], int], speed: Callable[[], float],
+                 count: int = 0, levels: int = 3):
+        """
+        Args:
+            wheel: The timer wheel the callbacks and the checks run on
+            odometer: The train distance in cm
+            speed: The train speed in cm/s
+            count: The distance now
+        """
+        super().__init__(wheel, count, levels)
+        self._odometer = odometer
+        self._speed = speed
+        self._check: Timer = None
+        self._check_key: int = None
+
+    def schedule(self, after: float, callback: Callable, *args) -> Timer:
+        """Calls callback(*args) on the wheel thread when the train went after cm further"""
+        self.advance(self._odometer())
+        return super().schedule(after, callback, *args)
+
+    def schedule_at(self, count: float, callback: Callable, *args) -> Timer:
+        """Calls callback(*args) on the wheel thread when the odometer gets to count cm"""
+        self.advance(self._odometer())
+        return super().schedule_at(count, callback, *args)
+
+    def _scheduled(self, timer: Timer):
+        with self._lock:
+            if self._check is None or timer.key < self._check_key:
+                self._schedule_check(timer.key)
+
+    def _schedule_check(self, key: int):
+        """Under the lock"""
+        if self._check is not None:
+            self._check.cancel()
+        speed = abs(self._speed())
+        remaining = key - self._timers.key
+        delay = min(remaining / speed, self.MAX_CHECK_S) if speed > 0 else self.IDLE_CHECK_S
+        self._check_key = key
+        self._check = self._wheel.schedule(delay, self._on_check)
+
+    def _on_check(self):
+        with self._lock:
+            self._check = None
+        # On the wheel thread already, the due timers come next
+        self.advance(self._odometer())
+        with self._lock:
+            if self._check is None and len(self._timers) > 0:
+                self._schedule_check(self._timers.next_key())
+
+    def reset(self, count: int = 0):
+        with self._lock:
+            if self._check is not None:
+                self._check.cancel()
+                self._check = None
+        super().reset(count)
+
+
+_shared_wheel: TimerWheel = None
+_shared_lock = threading.Lock()
+
+
+def shared_wheel() -> TimerWheel:
+    """The timer wheel shared by all the drivers, started on first use"""
+    global _shared_wheel
+    with _shared_lock:
+        if _shared_wheel is None:
+            _shared_wheel = TimerWheel()
+        return _shared_wheel
@@ -0,0 +1,282 @@
+"""
+A simulated train and a replay engine, to run and benchmark the driver without a physical train.
+
+    train = SimulatedTrain()
+    driver = drive_simulated(train)
+    ReplayEngine(train).run(synthetic_events(laps=100))
+"""
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Union
+
+from intelino.trainlib.enums import (
+    MovementDirection,
+    SnapColorValue as C,
+    SteeringDecision,
+    ColorSensor
+)
+from intelino.trainlib.messages import (
+    EventId,
+    TrainMsgEventFrontColorChanged,
+    TrainMsgEventBackColorChanged,
+    TrainMsgEventMovementDirectionChanged,
+    TrainMsgEventSplitDecision
+)
+from color_matcher import TRACK_MARKS
+from telemetry import TelemetryEvent, TelemetryReader
+
+
+class SimulatedTrain:
+    """
+    Implements the part of the intelino Train the drivers use.
+
+    Listeners are called synchronously on the thread that emits the event, so runs are deterministic.
+    Every command sent to the train is counted in `writes`.
+    """
+
+    def __init__(self, train_id: str = "SIM-00:00:00:00:00:00", name: str = "Simulated", link_latency: float = 0.0):
+        """
+        Args:
+            train_id: The train id
+            name: The train name
+            link_latency: Seconds every command blocks for, like a BLE round trip
+        """
+        self.id = train_id
+        self.name = name
+        self.alias = ""
+        self.is_connected = True
+        self.link_latency = link_latency
+        self.distance_cm: int = 0
+        self.speed_cmps: float = 0
+        self.direction: MovementDirection = MovementDirection.STOP
+        self.next_split_decision: SteeringDecision = SteeringDecision.NONE
+        self.snap_command_execution: bool = True
+        self.writes: int = 0
+        self._listeners: Dict[EventId, List[Callable]] = defaultdict(list)
+
+    def _write(self):
+        self.writes += 1
+        if self.link_latency > 0:
+            time.sleep(self.link_latency)
+
+    def disconnect(self):
+        self.is_connected = False
+
+    def drive_at_speed(self, speed_cmps: Union[int, float],
+                       direction: MovementDirection = MovementDirection.FORWARD, play_feedback: bool = True):
+        self._write()
+        self.speed_cmps = speed_cmps
+        self.direction = direction
+
+    def stop_driving(self, *args, **kwargs):
+        self._write()
+        self.speed_cmps = 0
+
+    def set_next_split_steering_decision(self, next_decision: SteeringDecision):
+        self._write()
+        self.next_split_decision = next_decision
+
+    def set_snap_command_execution(self, on: bool):
+        self._write()
+        self.snap_command_execution = on
+
+    def add_split_decision_listener(self, listener):
+        self._listeners[EventId.SPLIT_DECISION].append(listener)
+
+    def remove_split_decision_listener(self, listener):
+        self._listeners[EventId.SPLIT_DECISION].remove(listener)
+
+    def add_front_color_change_listener(self, listener):
+        self._listeners[EventId.FRONT_COLOR_CHANGED].append(listener)
+
+    def remove_front_color_change_listener(self, listener):
+        self._listeners[EventId.FRONT_COLOR_CHANGED].remove(listener)
+
+    def add_back_color_change_listener(self, listener):
+        self._listeners[EventId.BACK_COLOR_CHANGED].append(listener)
+
+    def remove_back_color_change_listener(self, listener):
+        self._listeners[EventId.BACK_COLOR_CHANGED].remove(listener)
+
+    def add_movement_direction_change_listener(self, listener):
+        self._listeners[EventId.MOVEMENT_DIRECTION_CHANGED].append(listener)
+
+    def remove_movement_direction_change_listener(self, listener):
+        self._listeners[EventId.MOVEMENT_DIRECTION_CHANGED].remove(listener)
+
+    def emit(self, msg):
+        """Delivers an event message to the listeners, like the train does"""
+        for listener in self._listeners[msg.event_id]:
+            listener(self, msg)
+
+
+class SimulatedScanner:
+    """Yields the simulated train, like the TrainScanner yields a real one"""
+
+    def __init__(self, train: SimulatedTrain = None):
+        self.train = train if train is not None else SimulatedTrain()
+
+    def __enter__(self) -> SimulatedTrain:
+        self.train.is_connected = True
+        return self.train
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.train.disconnect()
+
+
+def drive_simulated(train: SimulatedTrain, reporter=None, **kwargs):
+    """
+    A TrainDriver connected to the simulated train, ready for the events
+
+    Args:
+        reporter: The driver reporter, the console if None
+        kwargs: More TrainDriver arguments
+
+    Raises: ConnectionError if the driver failed to connect
+    """
+    from train_driver import TrainDriver
+
+    connected = threading.Event()
+    # The latest connect callback arguments, a failure may come after a success
+    result = list()
+
+    def on_connect(*args):
+        result[:] = args
+        connected.set()
+
+    if reporter is not None:
+        kwargs["reporter"] = reporter
+    driver = TrainDriver(scanner_factory=lambda: SimulatedScanner(train), **kwargs)
+    driver.connect(on_connect)
+    connected.wait()
+    # The listeners are added after the connect callback
+    while not driver.is_driving():
+        if not result[0]:
+            raise ConnectionError(f"The driver failed to connect to the simulated train: {result[1]}")
+        if not train.is_connected:
+            raise ConnectionError("The simulated train disconnected while the driver connected")
+        time.sleep(0.001)
+    return driver
+
+
+class ReplayEvent:
+    __slots__ = ("timestamp", "event", "distance_cm", "speed_cmps", "sensor", "value")
+
+    def __init__(self, timestamp: float, event: TelemetryEvent, distance_cm: int, speed_cmps: float,
+                 sensor: int = 0, value: int = 0):
+        """
+        Args:
+            timestamp: Seconds, only the differences matter
+            event: The event type. COMMAND events are not replayed
+            value: The color, the split decision or the direction, depending on the event
+        """
+        self.timestamp = timestamp
+        self.event = event
+        self.distance_cm = distance_cm
+        self.speed_cmps = speed_cmps
+        self.sensor = sensor
+        self.value = value
+
+
+def events_from_telemetry(reader: TelemetryReader, train_id: str = None) -> Iterator[ReplayEvent]:
+    """The recorded events of a train (or of the first train) as replay events"""
+    train = reader.train_ids.index(train_id) if train_id is not None else 0
+    records = reader.records[reader.records["train"] == train]
+    for r in records:
+        event = TelemetryEvent(int(r["event"]))
+        value = {TelemetryEvent.COLOR: r["color"], TelemetryEvent.SPLIT: r["decision"],
+                 TelemetryEvent.DIRECTION: r["decision"]}.get(event, 0)
+        yield ReplayEvent(float(r["timestamp"]), event, int(r["distance_cm"]), float(r["speed_cmps"]),
+                          int(r["sensor"]), int(value))
+
+
+def synthetic_events(laps: int = 10, speed_cmps: float = 30.0, snap_gap_cm: int = 4,
+                     sequences: Iterable[Iterable[C]] = ((C.RED, C.GREEN), (C.YELLOW, C.MAGENTA, C.BLUE)),
+                     lap_cm: int = 300) -> Iterator[ReplayEvent]:
+    """
+    Laps of a loop with the given command sequences and a junction (its mark, the split and a merge mark),
+    driven at a constant speed. Both sensors see the command sequences.
+    """
+    sequences = [tuple(seq) for seq in sequences]
+    junction_mark = TRACK_MARKS[0][0]
+    merge_mark = TRACK_MARKS[-1][0]
+    distance = 0
+
+    for _ in range(laps):
+        lap_start = distance
+        for seq in sequences + [junction_mark]:
+            for color in seq + (C.BLACK,):
+                distance += snap_gap_cm
+                yield ReplayEvent(distance / speed_cmps, TelemetryEvent.COLOR, distance, speed_cmps,
+                                  ColorSensor.FRONT, color)
+                yield ReplayEvent(distance / speed_cmps, TelemetryEvent.COLOR, distance, speed_cmps,
+                                  ColorSensor.BACK, color)
+        distance += snap_gap_cm * 2
+        yield ReplayEvent(distance / speed_cmps, TelemetryEvent.SPLIT, distance, speed_cmps,
+                          0, SteeringDecision.LEFT)
+        for color in merge_mark + (C.BLACK,):
+            distance += snap_gap_cm
+            yield ReplayEvent(distance / speed_cmps, TelemetryEvent.COLOR, distance, speed_cmps,
+                              ColorSensor.FRONT, color)
+        distance = lap_start + lap_cm
+
+
+class ReplayStats:
+    def __init__(self, events: int, seconds: float, latencies: List[float]):
+        self.events = events
+        self.seconds = seconds
+        self.latencies = sorted(latencies)
+
+    def events_per_second(self) -> float:
+        return self.events / self.seconds if self.seconds > 0 else 0.0
+
+    def percentile(self, p: float) -> float:
+        """Callback latency percentile in seconds"""
+        if len(self.latencies) == 0:
+            return 0.0
+        return self.latencies[min(len(self.latencies) - 1, int(p / 100 * len(self.latencies)))]
+
+    def __str__(self):
+        return (f"{self.events} events in {self.seconds:.3f} s ({self.events_per_second():.0f} events/s), "
+                f"callback latency p50 {self.percentile(50) * 1e6:.1f} us, "
+                f"p99 {self.percentile(99) * 1e6:.1f} us, max {self.percentile(100) * 1e6:.1f} us")
+
+
+class ReplayEngine:
+    """Feeds events to a simulated train, at the recorded pace or as fast as possible"""
+
+    def __init__(self, train: SimulatedTrain, realtime: bool = False):
+        self.train = train
+        self.realtime = realtime
+
+    @staticmethod
+    def to_message(event: ReplayEvent):
+        timestamp_ms = int(event.timestamp * 1000)
+        if event.event == TelemetryEvent.COLOR:
+            if event.sensor == ColorSensor.BACK:
+                return TrainMsgEventBackColorChanged(None, timestamp_ms, C(event.value))
+            return TrainMsgEventFrontColorChanged(None, timestamp_ms, C(event.value))
+        if event.event == TelemetryEvent.SPLIT:
+            return TrainMsgEventSplitDecision(None, timestamp_ms, SteeringDecision(event.value))
+        if event.event == TelemetryEvent.DIRECTION:
+            return TrainMsgEventMovementDirectionChanged(None, timestamp_ms, MovementDirection(event.value))
+        return None
+
+    def run(self, events: Iterable[ReplayEvent]) -> ReplayStats:
+        # Messages are built up front, so only the callbacks are measured
+        messages = [(e, m) for e, m in ((e, self.to_message(e)) for e in events) if m is not None]
+        latencies = list()
+        first_timestamp = messages[0][0].timestamp if len(messages) > 0 else 0.0
+        start = time.perf_counter()
+        for event, msg in messages:
+            if self.realtime:
+                delay = (event.timestamp - first_timestamp) - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.train.distance_cm = event.distance_cm
+            self.train.speed_cmps = event.speed_cmps
+            before = time.perf_counter()
+            self.train.emit(msg)
+            latencies.append(time.perf_counter() - before)
+        return ReplayStats(len(messages), time.perf_counter() - start, latencies)
@@ -0,0 +1,159 @@
+"""
+Telemetry recording in a fixed width binary format.
+
+A telemetry file is a 16 byte header followed by 24 byte little endian records:
+
+    timestamp (f8), distance_cm (i4), speed_cmps (f4), train (u2),
+    event (u1), sensor (u1), color (u1), decision (u1), level (u1), padding (1 byte)
+
+`train` is the line number in the "<file>.trains" side file that has the train ids.
+`decision` is the SteeringDecision for splits, the MovementDirection for direction changes
+and the CommandId for commands. `level` is the Speed level after a command.
+
+The reader needs NumPy, the recorder does not.
+"""
+import os
+import struct
+import threading
+import time
+from enum import IntEnum
+from typing import List
+
+_MAGIC = b"ITLM"
+_VERSION = 1
+_HEADER = struct.Struct("<4sII4x")
+_RECORD = struct.Struct("<difHBBBBBx")
+
+
+class TelemetryEvent(IntEnum):
+    COLOR = 0
+    SPLIT = 1
+    DIRECTION = 2
+    COMMAND = 3
+
+
+class TelemetryRecorder:
+    """
+    Appends telemetry records to a file. Records are packed into a buffer and written in bulk,
+    when the buffer is full, on flush() and on close(). It can be shared by many drivers.
+    """
+
+    def __init__(self, path: str, buffer_records: int = 1024):
+        """
+        Args:
+            path: The telemetry file. It is appended to if it exists
+            buffer_records: How many records are buffered before a write
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._buffer = bytearray(_RECORD.size * buffer_records)
+        self._capacity = buffer_records
+        self._count = 0
+        self._train_ids: List[str] = list()
+
+        trains_path = path + ".trains"
+        if os.path.exists(trains_path):
+            with open(trains_path) as f:
+                self._train_ids = [line.rstrip("\n") for line in f]
+
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "ab")
+        if new_file:
+            self._file.write(_HEADER.pack(_MAGIC, _VERSION, _RECORD.size))
+        self._trains_file = open(trains_path, "a")
+
+    def train_index(self, train_id: str) -> int:
+        """The index of a train in the records, the train is added if it is new"""
+        with self._lock:
+            if train_id in self._train_ids:
+                return self._train_ids.index(train_id)
+            self._train_ids.append(train_id)
+            self._trains_file.write(f"{train_id}\n")
+            self._trains_file.flush()
+            return len(self._train_ids) - 1
+
+    def record(self, train: int, event: TelemetryEvent, distance_cm: int, speed_cmps: float,
+               sensor: int = 0, color: int = 0, decision: int = 0, level: int = 0):
+        with self._lock:
+            _RECORD.pack_into(self._buffer, self._count * _RECORD.size, time.time(), distance_cm, speed_cmps,
+                              train, event, sensor, color, decision, level)
+            self._count += 1
+            if self._count == self._capacity:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._write()
+            self._file.close()
+            self._trains_file.close()
+
+    def _write(self):
+        if self._count > 0:
+            self._file.write(memoryview(self._buffer)[:self._count * _RECORD.size])
+            self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def telemetry_dtype():
+    import numpy as np
+    return np.dtype([
+        ("timestamp", "<f8"),
+        ("distance_cm", "<i4"),
+        ("speed_cmps", "<f4"),
+        ("train", "<u2"),
+        ("event", "u1"),
+        ("sensor", "u1"),
+        ("color", "u1"),
+        ("decision", "u1"),
+        ("level", "u1"),
+        ("padding", "u1"),
+    ])
+
+
+class TelemetryReader:
+    """
+    Memory maps a telemetry file as a NumPy structured array, so a multi hour session loads at once
+    and the columns are NumPy arrays, e.g. reader.records["speed_cmps"].
+    """
+
+    def __init__(self, path: str):
+        import numpy as np
+
+        with open(path, "rb") as f:
+            magic, version, record_size = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC or record_size != _RECORD.size:
+            raise ValueError(f"{path} is not a telemetry file (version {_VERSION})")
+
+        self.path = path
+        if os.path.getsize(path) > _HEADER.size:
+            self.records = np.memmap(path, dtype=telemetry_dtype(), mode="r", offset=_HEADER.size)
+        else:
+            self.records = np.zeros(0, dtype=telemetry_dtype())
+
+        self.train_ids: List[str] = list()
+        trains_path = path + ".trains"
+        if os.path.exists(trains_path):
+            with open(trains_path) as f:
+                self.train_ids = [line.rstrip("\n") for line in f]
+
+    def __len__(self):
+        return len(self.records)
+
+    def events(self, event: TelemetryEvent, train_id: str = None):
+        """The records of one event type, optionally of one train only"""
+        mask = self.records["event"] == event
+        if train_id is not None:
+            mask &= self.records["train"] == self.train_ids.index(train_id)
+        return self.records[mask]
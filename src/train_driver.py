@@ -1,7 +1,7 @@
 import threading
 import time
 from threading import Thread, Lock
-from typing import Union
+from typing import Dict, List, Union
 
 from intelino.trainlib_async.enums import SteeringDecision
 from intelino.trainlib import TrainScanner, Train
@@ -17,46 +17,126 @@ from intelino.trainlib.messages import (
     TrainMsgEventSplitDecision
 )
 from reporter import Reporter, ConsoleReporter
+from log_pipeline import LogPipeline
 from enums import CommandId, Speed, JunctionMark
-from util import ColorCommand, TestData, ColorSequence, Program, Command
+from color_matcher import ColorSequenceMatcher, SnapMatch, new_snap_matcher
+from telemetry import TelemetryRecorder, TelemetryEvent
+from dispatch import COMMAND_HANDLERS, CommandHandler
+from layout import TrackLayout, LayoutObserver
+from junctions import JunctionDetector, JunctionEvent
+from program_engine import ProgramEngine, compile_script
+from program_store import ProgramStore
+from predictive import LinkLatency, SteeringPredictor, SPEED, STEERING, SNAPS
+from metrics import Metrics, LatencyHistogram
+from command_queue import TrainCommandQueue
+from driver_state import DriverState
+from blocks import BlockManager
+from calibration import CalibrationTable, TrainCalibration
+from ramping import PROFILES, SpeedRamp
+from scheduler import CountWheel, DistanceWheel, Timer, shared_wheel
+from util import ColorCommand, ColorSequence, Program, Command, CommandFormatException, Script
 
 
 class TrainDriver:
     """The train driving class that has state and high level methods"""
 
-    def __init__(self, reporter: Reporter = ConsoleReporter()):
+    def __init__(self, reporter: Reporter = ConsoleReporter(), log_pipeline: LogPipeline = None,
+                 scanner_factory=TrainScanner, layout: TrackLayout = None,
+                 program_store: ProgramStore = None, layout_name: str = "default",
+                 calibration: CalibrationTable = None, blocks: BlockManager = None):
+        """
+        Args:
+            reporter: Where the driver reports to
+            log_pipeline: A pipeline shared with other drivers. Its reporters are used instead of the reporter.
+                          If None the driver has its own, that is one more consumer thread per driver
+            scanner_factory: Makes the scanner connect() uses by default. It is the train backend,
+                             e.g. lambda: SimulatedScanner(train) to drive a simulated train
+            layout: The track layout, shared by the trains on the same track. A new one if None
+            program_store: Where the programs are saved to and loaded from. If None they are not saved
+            layout_name: The name the programs are saved under in the program store
+            calibration: The calibration table. The one of the train is used when it connects
+            blocks: The block signalling of the trains on the same track, see blocks.py. None for no signalling
+        """
+        self._scanner_factory = scanner_factory
         self._driver_thread: Thread = None
         self._driving: bool = None
+        self._disconnect_event = threading.Event()
         self.train: Train = None
-        self._reporters: list(Reporter) = list()
-        self._reporters.append(reporter)
-
-        # Below is the state of the train
-        self._snap_following: bool = False
-        self._speed_level: Speed = Speed.ZERO
-        self._steering: SteeringDecision = SteeringDecision.STRAIGHT
-        self._direction: MovementDirection = MovementDirection.FORWARD
-        self._color_sequence: ColorSequence = ColorSequence()
-        self._last_color_command = None
-
-        # For overriding
-        # self._next_snap_following_: bool
-        # self._next_snap_following_count: int
-        self._next_steering: SteeringDecision = None
-        self._next_steering_count: int = 0
+        if log_pipeline is None:
+            log_pipeline = LogPipeline()
+            log_pipeline.add_reporter(reporter)
+        self._log_pipeline: LogPipeline = log_pipeline
+
+        # Below is the state of the train. It is only replaced, by _update, see driver_state.py
+        self._state: DriverState = DriverState()
+        # Serialises the writers: the commands and the train callbacks, which run on a thread per event
+        self._state_lock = threading.RLock()
+        # The colors seen since the last black, packed like the ColorSequence identity
+        self._color_identity: int = ColorSequence.EMPTY_IDENTITY
+        self._matcher: ColorSequenceMatcher = new_snap_matcher()
+        self._junctions = JunctionDetector()
+        self._blocks: BlockManager = blocks
+
+        self._layout_observer = LayoutObserver(layout if layout is not None else TrackLayout())
         self._programs: dict() = dict()
+        self._handlers: dict() = dict(COMMAND_HANDLERS)
+        self._program_store: ProgramStore = program_store
+        self._layout_name: str = layout_name
+
+        # Predictive steering, see set_predictive
+        self._link_latency = LinkLatency()
+        self._predictor: SteeringPredictor = None
+        self._calibration_table: CalibrationTable = calibration
+        self._calibration: TrainCalibration = None
+
+        self._telemetry: TelemetryRecorder = None
+        self._telemetry_train: int = 0
+
+        self._metrics = Metrics()
+        self._command_latency: Dict[CommandId, LatencyHistogram] = dict()
+        self._write_latency = {command_type: self._metrics.histogram("train_write_latency_seconds",
+                                                                     command=command_type)
+                               for command_type in (SPEED, STEERING, SNAPS)}
+        self._split_latency = self._metrics.histogram("callback_latency_seconds", callback="split")
+        self._color_latency = self._metrics.histogram("callback_latency_seconds", callback="color")
+        self._direction_latency = self._metrics.histogram("callback_latency_seconds", callback="direction")
+        self._events = {event: self._metrics.counter("events_total", event=event)
+                        for event in ("color", "split", "direction", "color_command", "program",
+                                      "junction_mark", "merge_mark", "junction_id")}
+        self._unhandled_commands = self._metrics.counter("unhandled_commands_total")
+        self._metrics.gauge("log_queue_depth", self._log_pipeline.depth)
+        self._metrics.gauge("log_dropped", lambda: self._log_pipeline.dropped)
+        self._metrics.gauge("steering_plan_depth", lambda: len(self._state.steering_plan))
+
+        # All the writes to the train go through the queue, see command_queue.py
+        self._commands = TrainCommandQueue(self._write, lambda error: self.log(f"Train command failed: {error}"))
+        self._metrics.gauge("train_write_queue_depth", self._commands.depth)
+        self._metrics.gauge("train_writes_coalesced", lambda: self._commands.coalesced)
+        # Speed changes ramp on the shared timer wheel, see ramping.py
+        self._wheel = shared_wheel()
+        self._ramp = SpeedRamp(self._write_speed, self._wheel, PROFILES["normal"])
+        # The timers by distance and by splits, advanced by the train events. They fire on the same wheel
+        self._distance_timers = DistanceWheel(self._wheel, lambda: self.train.distance_cm,
+                                              lambda: self.train.speed_cmps)
+        self._split_timers = CountWheel(self._wheel)
+        # Multi-step programs run on the same wheel, see program_engine.py
+        self._engine = ProgramEngine(self, self._wheel)
+        self._metrics.gauge("programs_running", self._engine.running)
+        self._metrics.gauge("timers_pending", lambda: len(self._distance_timers) + len(self._split_timers))
+
+        if program_store is not None:
+            self._load_programs()
 
         self._lock = threading.Lock()
 
-        # self._test_list_y: list(TestData) = list()
-        # self._test_list_m: list(TestData) = list()
-
-    def connect(self, connect_callback=None, disconnect_callback=None):
+    def connect(self, connect_callback=None, disconnect_callback=None, scanner=None):
         """
         Args:
             connect_callback: callback(success: bool = True, train_id: str, train_name: str)
                               callback(success: bool = False, error_message)
             disconnect_callback:  callback(success: bool, train_id: str, train_name: str)
+            scanner: A context manager that yields the connected train, like the TrainScanner.
+                     If None, the driver's scanner factory makes one.
         Returns:
             Immediately.
         """
@@ -67,32 +147,40 @@ class TrainDriver:
             else:
                 del self._driver_thread
 
-        self._driver_thread = Thread(target=self._do_drive, args=(connect_callback, disconnect_callback, ))
+        self._disconnect_event.clear()
+        self._driver_thread = Thread(target=self._do_drive, args=(connect_callback, disconnect_callback, scanner, ))
         self._driver_thread.start()
 
     def disconnect(self):
         self._driving = False
+        self._disconnect_event.set()
 
     def is_driving(self) -> bool:
         return self._driving
 
     def log(self, msg):
-        for r in self._reporters:
-            r.log(msg)
+        self._log_pipeline.submit(msg)
 
     def logn(self, msg):
-        for r in self._reporters:
-            r.logn(msg)
+        self._log_pipeline.submit(msg, False)
 
     def add_reporter(self, reporter: Reporter):
-        self._reporters.append(reporter)
+        self._log_pipeline.add_reporter(reporter)
 
-    def _do_drive(self, connect_callback, disconnect_callback):
+    def set_telemetry(self, recorder: TelemetryRecorder):
+        """Records the train events and the commands to the recorder. None to stop recording"""
+        if recorder is not None and self.train is not None:
+            self._telemetry_train = recorder.train_index(self.train.id)
+        self._telemetry = recorder
+
+    def _do_drive(self, connect_callback, disconnect_callback, scanner):
         if not self._lock.acquire(False):
             raise Exception("Driver awaiting to connect or already connected")
 
+        if scanner is None:
+            scanner = self._scanner_factory()
         try:
-            with TrainScanner() as self.train:
+            with scanner as self.train:
                 train_id = self.train.id
                 train_name = self.train.name
 
@@ -102,8 +190,7 @@ class TrainDriver:
 
                 self._init_train()
                 self._driving = True
-                while self._driving:
-                    time.sleep(0.01)
+                self._wait_for_disconnect()
                 self._cleanup_train()
 
                 self.log("Train Driver Disconnected")
@@ -114,149 +201,421 @@ class TrainDriver:
         finally:
             self._lock.release()
 
+    def _wait_for_disconnect(self):
+        """
+        Blocks the driver thread until disconnect() is called.
+        The wait is on an event, so an idle connected train costs no CPU
+        and the disconnect is picked up immediately.
+        """
+        self._disconnect_event.wait()
+
+    @property
+    def link_latency(self) -> LinkLatency:
+        """The measured command to effect latency per command type"""
+        return self._link_latency
+
+    def set_predictive(self, on: bool, margin_s: float = 0.15):
+        """
+        Predictive steering: uses the learnt layout, the velocity and the link latency to preload the steering
+        of the landmark ahead and to slow down for splits that are too close for the round trip.
+
+        Args:
+            on: True to turn it on
+            margin_s: Seconds sent early on top of the measured latency
+        """
+        self.log(f"Predictive steering {'on' if on else 'off'}")
+        level_speeds = self._calibration.level_speeds() if self._calibration is not None else None
+        self._predictor = SteeringPredictor(self._link_latency, margin_s, level_speeds) if on else None
+
+    @property
+    def calibration(self) -> TrainCalibration:
+        """The calibration of the connected train, None if it has none"""
+        return self._calibration
+
+    def _load_calibration(self):
+        self._calibration = self._calibration_table.get(self.train.id)
+        if self._calibration is None:
+            self.log(f"No calibration for {self.train.id}")
+            return
+        self.log(f"Calibration {self._calibration}")
+        if self._calibration.latency_s is not None:
+            self._link_latency.initial = self._calibration.latency_s
+        if self._calibration.snap_gap_p95_cm is not None:
+            self._junctions.max_gap_cm = JunctionDetector.mark_length_cm(self._calibration.snap_gap_p95_cm)
+        if self._predictor is not None:
+            self._predictor.level_speeds = self._calibration.level_speeds()
+
+    @property
+    def metrics(self) -> Metrics:
+        """The latency histograms, event counters and queue depths of the driver"""
+        return self._metrics
+
+    def command_latency(self, cmd_id: CommandId) -> LatencyHistogram:
+        """The execute() latency of a command"""
+        histogram = self._command_latency.get(cmd_id)
+        if histogram is None:
+            histogram = self._command_latency[cmd_id] = self._metrics.histogram("command_latency_seconds",
+                                                                                command=cmd_id.name)
+        return histogram
+
+    def log_metrics(self):
+        self.log(f"Metrics:\n{self._metrics.report()}\nLink latency:\n{self._link_latency}")
+
+    def _write(self, command_type: str, call, args: tuple):
+        """Sends a command to the train, measuring the link latency. Called by the command queue writer"""
+        start = time.perf_counter_ns()
+        call(*args)
+        elapsed = time.perf_counter_ns() - start
+        self._write_latency[command_type].record(elapsed)
+        self._link_latency.record(command_type, elapsed / 1e9)
+
+    @property
+    def state(self) -> DriverState:
+        """The latest state snapshot. Lock free, from any thread"""
+        return self._state
+
+    def states(self) -> Dict[str, DriverState]:
+        """The state by train id, the same as Fleet.states"""
+        return {self.train.id if self.train is not None else "": self._state}
+
+    def _update(self, **changes) -> DriverState:
+        """Publishes a new state with the changes. Returns: The new state"""
+        with self._state_lock:
+            self._state = self._state.replace(**changes)
+            return self._state
+
+    def _drive(self, priority: bool = False, ramp: bool = True):
+        """
+        Drives at the speed level and direction of the driver. Call it under the state lock,
+        with the state update it follows, so the last speed written is the one of the last state
+
+        Args:
+            priority: Write before anything else queued, without ramping
+            ramp: Ramp to the speed with the ramp profile, through a stop if the direction changes
+        """
+        state = self._state
+        if priority or not ramp:
+            self._ramp.set(state.speed_level.speed, state.direction, priority)
+        else:
+            self._ramp.ramp_to(state.speed_level.speed, state.direction)
+        train = self.train
+        if self._telemetry is not None and train is not None:
+            # Every speed change, not only the commands, e.g. a predictive slowdown or a block stop,
+            # so the level speed fit knows the level at all times, see calibration.py
+            self._telemetry.record(self._telemetry_train, TelemetryEvent.COMMAND, train.distance_cm,
+                                   train.speed_cmps, decision=CommandId.SPEED_FINE, level=state.speed_level.value)
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until the queued train commands are written, not the ramps in progress
+
+        Returns: False on timeout
+        """
+        return self._commands.flush(timeout)
+
+    def _write_speed(self, speed_cmps: float, direction: MovementDirection, priority: bool):
+        self._commands.put(SPEED, self.train.drive_at_speed, speed_cmps, direction, True, priority=priority)
+
+    def set_ramp_profile(self, name: str):
+        """The speed ramping profile, one of ramping.PROFILES: instant, gentle, normal or sport"""
+        profile = PROFILES.get(name)
+        if profile is None:
+            self.log(f"No ramp profile {name}. Use one of {', '.join(PROFILES)}")
+            return
+        self.log(f"Ramp profile {name}")
+        self._ramp.profile = profile
+
+    def _steer(self, steering: SteeringDecision):
+        self._commands.put(STEERING, self.train.set_next_split_steering_decision, steering)
+
     def _init_train(self):
+        if self._telemetry is not None:
+            self._telemetry_train = self._telemetry.train_index(self.train.id)
         self.train.stop_driving()
-        self.train.set_snap_command_execution(self._snap_following)
+        self._metrics.labels["train"] = self.train.id
+        if self._calibration_table is not None:
+            self._load_calibration()
+        self._write(SNAPS, self.train.set_snap_command_execution, (self._state.snap_following, ))
+        self._distance_timers.reset(self.train.distance_cm)
+        self._split_timers.reset()
+        if self._program_store is not None:
+            # Again, without the programs of the other trains
+            with self._state_lock:
+                self._load_programs()
+        self._commands.start()
         self.train.add_split_decision_listener(self.split_decision_callback)
         self.train.add_front_color_change_listener(self.handle_color_change)
         self.train.add_back_color_change_listener(self.handle_color_change)
+        self.train.add_movement_direction_change_listener(self.handle_direction_change)
 
     def _cleanup_train(self):
+        self._engine.cancel_all()
+        if self._blocks is not None:
+            self._blocks.remove(self)
+        self._distance_timers.reset()
+        self._split_timers.reset()
+        self._ramp.cancel()
+        self._commands.stop()
         self.train.stop_driving()
         self.train.set_snap_command_execution(True)
         self.train.remove_split_decision_listener(self.split_decision_callback)
         self.train.remove_front_color_change_listener(self.handle_color_change)
         self.train.remove_back_color_change_listener(self.handle_color_change)
+        self.train.remove_movement_direction_change_listener(self.handle_direction_change)
         # Don't call disconnect. It's done at the with/__exit
 
     def execute(self, command: Command):
-        if command.cmd_id == CommandId.CONNECT:
-            self.connect(command.args[0], command.args[1])
-        elif command.cmd_id == CommandId.DISCONNECT:
-            self.disconnect()
-        elif command.cmd_id == CommandId.START:
-            self.start()
-        elif command.cmd_id == CommandId.STOP:
-            self.stop()
-        elif command.cmd_id == CommandId.KEEP_LEFT:
-            self.set_state_steering(SteeringDecision.LEFT)
-        elif command.cmd_id == CommandId.KEEP_RIGHT:
-            self.set_state_steering(SteeringDecision.RIGHT)
-        elif command.cmd_id == CommandId.KEEP_STRAIGHT:
-            self.set_state_steering(SteeringDecision.STRAIGHT)
-        elif command.cmd_id == CommandId.NEXT_LEFT:
-            self.next_steering(SteeringDecision.LEFT, command.args[0])
-        elif command.cmd_id == CommandId.NEXT_RIGHT:
-            self.next_steering(SteeringDecision.RIGHT, command.args[0])
-        elif command.cmd_id == CommandId.NEXT_STRAIGHT:
-            self.next_steering(SteeringDecision.STRAIGHT, command.args[0])
-        elif command.cmd_id == CommandId.SNAPS_FOLLOW:
-            self.next_steering(SteeringDecision.STRAIGHT)
-        elif command.cmd_id == CommandId.SNAPS_IGNORE:
-            self.next_steering(SteeringDecision.STRAIGHT)
-        elif command.cmd_id == CommandId.SPEED_FAST:
-            self.set_speed(Speed.FOUR)
-        elif command.cmd_id == CommandId.SPEED_MEDIUM:
-            self.set_speed(Speed.THREE)
-        elif command.cmd_id == CommandId.SPEED_SLOW:
-            self.set_speed(Speed.TWO)
-        elif command.cmd_id == CommandId.SPEED_FINE:
-            if Speed.MIN.value <= command.args[0] <= Speed.MAX.value:
-                self.set_speed(Speed(command.args[0]))
-            else:
-                self.log(f"Invalid speed file value {command.args[0]}. Must be between {Speed.MIN} and {Speed.MAX}")
-        elif command.cmd_id == CommandId.REVERSE:
-            self.reverse()
-        elif command.cmd_id == CommandId.FORWARD:
-            self.forward()
-        elif command.cmd_id == CommandId.BACKWARD:
-            self.backward()
+        start = time.perf_counter_ns()
+        handler = self._handlers.get(command.cmd_id)
+        if handler is None:
+            self._unhandled_commands.inc()
+            self.log(f"Command not handled: {command}")
+            return
+        handler(self, command)
+        train = self.train
+        # Nothing to record before the train connects, e.g. for CONNECT
+        if self._telemetry is not None and train is not None:
+            self._telemetry.record(self._telemetry_train, TelemetryEvent.COMMAND, train.distance_cm,
+                                   train.speed_cmps, decision=command.cmd_id, level=self._state.speed_level.value)
+        self.command_latency(command.cmd_id).record(time.perf_counter_ns() - start)
+
+    def register_handler(self, cmd_id: CommandId, handler: CommandHandler):
+        """Adds or replaces the handler of a command for this driver only"""
+        self._handlers[cmd_id] = handler
 
     def start(self):
         self.logn("Starting")
-        self._speed_level = Speed.TWO
-        self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+        with self._state_lock:
+            self._update(speed_level=Speed.TWO)
+            self._drive()
 
     def stop(self):
         self.log("Stopping")
-        self._speed_level = Speed.ZERO
-        self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+        with self._state_lock:
+            self._update(speed_level=Speed.ZERO)
+            # Right away, before anything else queued
+            self._drive(priority=True)
 
-    def reverse(self):
-        self.log("Reversing")
-        if self.train.direction == MovementDirection.FORWARD:
-            self._direction = MovementDirection.BACKWARD
-        else:
-            self._direction = MovementDirection.FORWARD
-        self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+    def reverse(self, gently: bool = True):
+        """
+        Args:
+            gently: Slow down to a stop, change direction and speed up again with the ramp profile.
+                    Otherwise the direction changes at once
+        """
+        self.log("Reversing" if gently else "Reversing now")
+        with self._state_lock:
+            # The train direction is stale while a speed write is queued or ramping
+            if self._commands.is_pending(SPEED) or self._ramp.is_ramping():
+                direction = self._state.direction
+            else:
+                direction = self.train.direction
+            if direction == MovementDirection.FORWARD:
+                self._update(direction=MovementDirection.BACKWARD)
+            else:
+                self._update(direction=MovementDirection.FORWARD)
+            self._drive(ramp=gently)
 
     def forward(self):
         self.log("Forward")
-        self._direction = MovementDirection.FORWARD
-        self._speed_level = Speed.TWO
-        self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+        with self._state_lock:
+            self._update(direction=MovementDirection.FORWARD, speed_level=Speed.TWO)
+            self._drive()
 
     def backward(self):
         self.log("Backwards")
-        self._direction = MovementDirection.BACKWARD
-        self._speed_level = Speed.TWO
-        self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+        with self._state_lock:
+            self._update(direction=MovementDirection.BACKWARD, speed_level=Speed.TWO)
+            self._drive()
 
     def set_state_steering(self, steering: SteeringDecision):
         self.log(f"Set base steering {steering.name}")
-        self._steering = steering
-        self.train.set_next_split_steering_decision(self._steering)
+        with self._state_lock:
+            self._update(steering=steering)
+            self._steer(steering)
 
     def set_snap_following(self, follow: bool):
         self.log(f"Setting snap following to {follow}")
-        self._snap_following = follow
-        self.train.set_snap_command_execution(follow)
+        with self._state_lock:
+            self._update(snap_following=follow)
+            self._commands.put(SNAPS, self.train.set_snap_command_execution, follow)
 
     def next_steering(self, steering: SteeringDecision, count: int = 1):
         if count is None:
             count = 1
         self.log(f"Next steering: {steering.name}, count: {count}")
-        self._next_steering_count = count - 1
-        self._next_steering = steering
-        self.train.set_next_split_steering_decision(steering)
+        with self._state_lock:
+            if len(self._state.steering_plan) > 0:
+                self.log("Route cancelled")
+            self._update(next_steering=steering, next_steering_count=count - 1, steering_plan=())
+            self._steer(steering)
 
     def set_speed(self, speed_level: Speed):
         self.log(f"Setting speed to {speed_level.name}")
-        self._speed_level = speed_level
-        self.train.drive_at_speed(self._speed_level.speed, self._direction, True)
+        with self._state_lock:
+            self._update(speed_level=speed_level)
+            self._drive()
+
+    def set_speed_if(self, expected: Speed, speed_level: Speed) -> bool:
+        """
+        Sets the speed level only if it is still the expected one, under the state lock,
+        so a speed set meanwhile (e.g. by the user) is not overridden
+
+        Returns: True if the speed was set
+        """
+        with self._state_lock:
+            if self._state.speed_level != expected:
+                return False
+            self.set_speed(speed_level)
+            return True
+
+    def after_distance(self, distance_cm: float, callback, *args) -> Timer:
+        """Calls callback(*args) on the timer wheel when the train went distance_cm further. Returns: The timer"""
+        return self._distance_timers.schedule(distance_cm, callback, *args)
+
+    def at_distance(self, distance_cm: float, callback, *args) -> Timer:
+        """Calls callback(*args) on the timer wheel when the train odometer gets to distance_cm"""
+        return self._distance_timers.schedule_at(distance_cm, callback, *args)
+
+    def after_splits(self, splits: int, callback, *args) -> Timer:
+        """Calls callback(*args) on the timer wheel right after the train passed that many splits"""
+        return self._split_timers.schedule(splits, callback, *args)
+
+    def stop_in(self, distance_cm: float) -> Timer:
+        """Stops when the train went distance_cm further. Returns: The timer, to cancel the stop"""
+        self.log(f"Stopping in {distance_cm} cm")
+        return self.after_distance(distance_cm, self.stop)
+
+    def slow_for(self, speed_level: Speed, seconds: float) -> Timer:
+        """Drives at the speed level for a while, then back at the speed before, unless it was changed meanwhile"""
+        with self._state_lock:
+            previous = self._state.speed_level
+            self.set_speed(speed_level)
+        return self._wheel.schedule(seconds, self._resume_speed, speed_level, previous)
+
+    def _resume_speed(self, slowed: Speed, previous: Speed):
+        self.set_speed_if(slowed, previous)
+
+    def steer_at_split(self, steering: SteeringDecision, split: int = 1) -> Timer:
+        """
+        Steers a single split further ahead, e.g. split 2 is the one after the next
+
+        Returns: The timer, None for the next split, which is steered at once
+        """
+        if split <= 1:
+            self.next_steering(steering)
+            return None
+        self.log(f"Steering {steering.name} at split {split} from now")
+        return self.after_splits(split - 1, self.next_steering, steering)
 
     def split_decision_callback(self, train: Train, msg: TrainMsgEventSplitDecision):
-        if self._next_steering_count > 0:
-            steering = self._next_steering
-            self._next_steering_count -= 1
-        else:
-            steering = self._steering
-        self.log(f"Split. Last: {msg.decision.name}, Next: {msg.decision.name}, Next: {steering.name} ({self._next_steering_count > 0}), Default: {self.train.next_split_decision.name}")
-        self.train.set_next_split_steering_decision(steering)
+        start = time.perf_counter_ns()
+        self._events["split"].inc()
+        if self._telemetry is not None:
+            self._telemetry.record(self._telemetry_train, TelemetryEvent.SPLIT, train.distance_cm,
+                                   train.speed_cmps, decision=msg.decision)
+        self._distance_timers.advance(train.distance_cm)
+        with self._state_lock:
+            self._layout_observer.split(msg.decision, train.distance_cm)
+            if self._blocks is not None:
+                self._blocks.split(self, msg.decision)
+            state = self._state
+            if len(state.steering_plan) > 0:
+                steering = state.steering_plan[0]
+                state = self._update(steering_plan=state.steering_plan[1:])
+            elif state.next_steering_count > 0:
+                steering = state.next_steering
+                state = self._update(next_steering_count=state.next_steering_count - 1)
+            else:
+                steering = state.steering
+            self.log(f"Split. Last: {msg.decision.name}, Next: {msg.decision.name}, Next: {steering.name} ({state.next_steering_count > 0}), Default: {self.train.next_split_decision.name}")
+            self._steer(steering)
+            if self._predictor is not None:
+                if state.restore_after_splits > 0:
+                    self._update(restore_after_splits=state.restore_after_splits - 1)
+                self._predict(train)
+            # After the steering of the next split, so a timer can override it
+            self._split_timers.advance(self._split_timers.count + 1)
+        self._split_latency.record(time.perf_counter_ns() - start)
+
+    def _predict(self, train: Train):
+        """Looks ahead on the layout, after a split or a landmark, see set_predictive. Under the state lock"""
+        state = self._state
+        if state.restore_speed is not None and state.restore_after_splits <= 0:
+            # Only if nothing else changed the speed meanwhile
+            if state.speed_level == state.slowed_speed:
+                self.log(f"Predictive: back to speed {state.restore_speed.name}")
+                state = self._update(speed_level=state.restore_speed, restore_speed=None)
+                self._drive()
+            else:
+                state = self._update(restore_speed=None)
+
+        edge, remaining = self._predictor.next_split(self._layout_observer, train.distance_cm)
+        if edge is None:
+            return
+        if remaining is None:
+            # The next split comes after the next landmark, whose program may be too late to steer it
+            if len(state.steering_plan) == 0 and state.next_steering_count <= 0:
+                decision = self._predictor.preload_decision(edge, self._matcher)
+                if decision is not None and decision != train.next_split_decision:
+                    self.log(f"Predictive: preloading {decision.name} for "
+                             f"{ColorSequence.from_identity(edge.destination)}")
+                    self._steer(decision)
+            return
+
+        gap = self._predictor.split_gap(self._layout_observer, train.distance_cm)
+        if gap is None or state.restore_speed is not None:
+            return
+        level = self._predictor.safe_speed(gap, train.speed_cmps)
+        if level is not None and level.value < state.speed_level.value:
+            self.log(f"Predictive: splits {gap:.0f} cm apart ahead, slowing down to {level.name}")
+            # Back to speed after the next split and the one after it
+            self._update(speed_level=level, restore_speed=state.speed_level, slowed_speed=level,
+                         restore_after_splits=2)
+            self._drive(ramp=False)
 
     def handle_color_change(self, train: Train, msg: TrainMsgEventSensorColorChanged):
+        start = time.perf_counter_ns()
+        self._events["color"].inc()
+        if self._telemetry is not None:
+            self._telemetry.record(self._telemetry_train, TelemetryEvent.COLOR, train.distance_cm,
+                                   train.speed_cmps, sensor=msg.sensor, color=msg.color)
+        self._distance_timers.advance(train.distance_cm)
         if msg.sensor == ColorSensor.FRONT:
             # self.log(f"Sensor color change {train.distance_cm} -> {msg.sensor.name}: {msg.color}")
-            # Sequence detection:
-            if msg.color == C.BLACK:
-                seq = ColorSequence(self._color_sequence)
-                self._color_sequence.clear()
-                # Determine if it is a junction mark or a command sequence
-                junction_mark = False
-                if len(seq) == 2 and seq[0] == C.CYAN and seq[1] == C.RED:
-                    self.handle_junction_mark(JunctionMark.LEFT, train.distance_cm)
-                elif len(seq) == 2 and seq[0] == C.CYAN and seq[1] == C.BLUE:
-                    self.handle_junction_mark(JunctionMark.RIGHT, train.distance_cm)
-                elif len(seq) == 2 and seq[1] == C.CYAN and seq[0] == C.RED:
-                    self.handle_merge_mark(JunctionMark.RIGHT, train.distance_cm)
-                elif len(seq) == 2 and seq[1] == C.CYAN and seq[0] == C.BLUE:
-                    self.handle_merge_mark(JunctionMark.LEFT, train.distance_cm)
+            # Sequence detection: the matcher is advanced on every color, so the black only reads the result
+            with self._state_lock:
+                if msg.color == C.BLACK:
+                    seq = ColorSequence.from_identity(self._color_identity)
+                    self._color_identity = ColorSequence.EMPTY_IDENTITY
+                    match = self._matcher.match()
+                    if match is None:
+                        self.handle_color_command(seq, train.distance_cm)
+                    elif match[0] == SnapMatch.JUNCTION_MARK:
+                        self.handle_junction_mark(match[1], train.distance_cm)
+                    elif match[0] == SnapMatch.MERGE_MARK:
+                        self.handle_merge_mark(match[1], train.distance_cm)
+                    else:
+                        self.handle_color_command(seq, train.distance_cm, match[1])
                 else:
-                    self.handle_color_command(seq, train.distance_cm)
-            else:
-                self._color_sequence.append(msg.color)
-
-    def handle_color_command(self, seq: ColorSequence, distance: int):
+                    self._color_identity = (self._color_identity << ColorSequence.BITS) | int(msg.color)
+                    self._matcher.advance(msg.color)
+        self._color_latency.record(time.perf_counter_ns() - start)
+
+    def handle_direction_change(self, train: Train, msg: TrainMsgEventMovementDirectionChanged):
+        start = time.perf_counter_ns()
+        self._events["direction"].inc()
+        if self._telemetry is not None:
+            self._telemetry.record(self._telemetry_train, TelemetryEvent.DIRECTION, train.distance_cm,
+                                   train.speed_cmps, decision=msg.direction)
+        # The landmarks come in reverse order now, the next edge would be wrong
+        with self._state_lock:
+            self._layout_observer.reset()
+            self._junctions.reset()
+            if self._blocks is not None:
+                self._blocks.direction_change(self)
+        self._direction_latency.record(time.perf_counter_ns() - start)
+
+    def handle_color_command(self, seq: ColorSequence, distance: int, program: Program = None):
         """
         Handles a color sequence followed by a "black".
         This is fired up for every sequence, except of the junction marks.
@@ -265,19 +624,30 @@ class TrainDriver:
         Args:
             seq: The color sequence or otherwise command id
             distance: The distance in cm that this was found
+            program: The program matched to the sequence, if any
 
         Returns: Nothing
 
         """
+        self._events["color_command"].inc()
         command = ColorCommand(seq, distance, time.perf_counter())
-        # self._last_color_command = command
+        self._junctions.color_command(command)
         self.log(f"Color command: {command}")
-        program = self._programs.get(command.seq.identity())
-        if program is not None:
+        if len(seq) > 0:
+            self._layout_observer.landmark(seq, distance)
+        if program is not None and not self._is_target(program.command.target):
+            self.log(f"The program is for {program.command.target}")
+        elif program is not None:
+            self._events["program"].inc()
             self.log(f"Executing program: {program}")
-            self.execute(program.command)
+            if program.command.cmd_id == CommandId.SCRIPT:
+                self._engine.trigger(program.seq.identity(), program.command.args[0])
+            else:
+                self.execute(program.command)
         else:
             self.log("No program found")
+        if self._predictor is not None and len(seq) > 0:
+            self._predict(self.train)
 
     def handle_junction_mark(self, towards: JunctionMark, distance: int):
         """
@@ -291,23 +661,12 @@ class TrainDriver:
         Returns: Nothing
 
         """
+        self._events["junction_mark"].inc()
         self.log(f"Junction Mark: {towards.name} at {distance}")
-
-        # The roundtrip from the color sensor to this code and back to the train
-        # is very slow for this to work, so no point really.
-        if self._last_color_command is not None:
-            velocity = self.train.speed_cmps
-            delta_time = time.perf_counter() - self._last_color_command.timestamp
-            delta_dist = velocity * delta_time
-
-            # self.log(f"Test: {self._last_color_command.seq} -- Gap: {dd}")
-            # if self._last_color_command.seq[0] == C.YELLOW:
-            #     self._test_list_y.append(TestData(s, t, d, dd))
-            # elif self._last_color_command.seq[0] == C.MAGENTA:
-            #     self._test_list_m.append(TestData(s, t, d, dd))
-            if delta_dist < 9.0:
-                junction_id = self._last_color_command.seq
-                self.handle_junction_id(junction_id, self.train.distance_cm)
+        self._layout_observer.junction_mark(towards)
+        event = self._junctions.junction_mark(towards, distance)
+        if event is not None:
+            self.handle_junction_id(event)
 
     def handle_merge_mark(self, coming: JunctionMark, distance: int):
         """
@@ -320,14 +679,148 @@ class TrainDriver:
         Returns: Nothing
 
         """
+        self._events["merge_mark"].inc()
         self.log(f"Merging Mark: {coming.name} at {distance}")
+        self._layout_observer.merge_mark(coming)
+        event = self._junctions.merge_mark(coming, distance)
+        if event is not None:
+            self.handle_junction_id(event)
+
+    def handle_junction_id(self, event: JunctionEvent):
+        """
+        Fired up when a junction or merge mark comes right after a colour sequence, which is its ID.
+        The split is too close for steering it over BLE, but the train knows which junction it is at
 
-    def handle_junction_id(self, junction_id: list(C), distance: int):
+        Args:
+            event: The ID, the mark and the distance
+        """
+        self._events["junction_id"].inc()
+        self.log(f"Junction ID: {event}")
+        if self._blocks is not None:
+            self._blocks.boundary(self, event)
+
+    @property
+    def layout(self) -> TrackLayout:
+        return self._layout_observer.layout
+
+    def route_to(self, destination: ColorSequence):
+        """
+        Plans the shortest known route from the last landmark to the destination landmark
+        and queues the steering decisions for all the splits on the way.
+        The splits passed since the last landmark are left out, the plan starts at the next split.
+        """
+        with self._state_lock:
+            source = self._layout_observer.last_landmark
+            if source is None:
+                self.log("Cannot plan a route, no landmark seen yet")
+                return
+            passed = self._layout_observer.decisions()
+            plan = self._plan_from_next_split(source, passed, destination)
+            if plan is None:
+                self.log(f"No known route from {source} to {destination}")
+                return
+            self.log(f"Route from {source} to {destination}: {', '.join(d.name for d in plan)}"
+                     + (f", {len(passed)} split(s) already passed" if len(passed) > 0 else ""))
+            self._update(steering_plan=plan[1:], next_steering_count=0)
+            if len(plan) > 0:
+                self._steer(plan[0])
+
+    def _plan_from_next_split(self, source: ColorSequence, passed: tuple,
+                              destination: ColorSequence) -> List[SteeringDecision]:
         """
-        The loop from the train and back is way too slow for this trick to work
+        The steering plan for the splits ahead, when the train passed some splits since the source landmark
+
+        Returns: The decisions or None if there is no known route
+        """
+        plan = self.layout.steering_plan(source, destination)
+        if len(passed) == 0:
+            return plan
+        if plan is not None and tuple(plan[:len(passed)]) == passed:
+            return plan[len(passed):]
+        # Off the first edge of the route: the rest of the edge the train is on, then the route from its end
+        edge = self.layout.likely_edge(source, passed)
+        if edge is None:
+            return None
+        rest = self.layout.steering_plan(ColorSequence.from_identity(edge.destination), destination)
+        if rest is None:
+            return None
+        return list(edge.decisions[len(passed):]) + rest
+
+    def run_script(self, script: Script):
         """
-        self.log(f"Junction ID {junction_id} @ {distance}")
+        Runs the steps of a multi-step command on the timer wheel. It returns at once.
+        The commands typed share one run: a script cancels the one typed before it, if it still runs,
+        as two of them would set the speed and the steering of the train in turn. Programs run on their own
+        """
+        if not isinstance(script, Script):
+            self.log(f"Not a script: {script}")
+            return
+        self.log(f"Running: {script}")
+        self._engine.trigger(None, script)
+
+    @property
+    def junctions_passed(self) -> int:
+        """The junction marks passed since the driver started"""
+        return self._events["junction_mark"].value
 
     def program_command(self, program: Program):
-        self._programs[program.seq.identity()] = program
+        if program.command.cmd_id == CommandId.SCRIPT:
+            # Compiled now, so a trigger is only a dispatch
+            compile_script(program.command.args[0])
+        existing = self._matcher.get(program.seq)
+        if existing is not None and existing[0] != SnapMatch.PROGRAM:
+            self.log(f"Cannot program {program.seq}, it is a track mark")
+            return
+        if self._program_store is not None:
+            try:
+                self._program_store.save(self._layout_name, program)
+            except CommandFormatException as error:
+                self.log(f"Cannot program {program.seq}: {error}")
+                return
+        with self._state_lock:
+            self._programs[program.seq.identity()] = program
+            self._matcher.add(program.seq, (SnapMatch.PROGRAM, program))
         self.log(f"Program added: {program}")
+
+    def _is_target(self, target: str) -> bool:
+        """If a command for the target is for this train: no target, or its id or name, case insensitive"""
+        if target is None:
+            return True
+        train = self.train
+        if train is None:
+            return False
+        target = target.lower()
+        return target == train.id.lower() or target == train.name.lower()
+
+    @property
+    def layout_name(self) -> str:
+        return self._layout_name
+
+    def switch_layout(self, name: str):
+        """Replaces the programs with the ones saved for another layout in the program store"""
+        if self._program_store is None:
+            self.log("Cannot switch layout, there is no program store")
+            return
+        with self._state_lock:
+            self._layout_name = name
+            self._layout_observer.reset()
+            self._load_programs()
+
+    def _load_programs(self):
+        """
+        Bulk loads the programs of the layout into a new matcher, then swaps it in.
+        Once the train is known, the ones for other trains are left out
+        """
+        matcher = new_snap_matcher()
+        programs = dict()
+        for program in self._program_store.load(self._layout_name):
+            if matcher.get(program.seq) is not None:
+                continue
+            if self.train is not None and not self._is_target(program.command.target):
+                continue
+            programs[program.seq.identity()] = program
+            matcher.add(program.seq, (SnapMatch.PROGRAM, program))
+        self._programs = programs
+        self._matcher = matcher
+        self._color_identity = ColorSequence.EMPTY_IDENTITY
+        self.log(f"Loaded {len(programs)} program(s) of layout {self._layout_name}")
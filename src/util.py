@@ -1,15 +1,32 @@
-from typing import Union
+from typing import Iterable, List
 from intelino.trainlib.enums import SnapColorValue
-from intelino.trainlib.enums import SnapColorValue as C
 from enums import CommandId
 
 
-class ColorSequence(list):
-    def __init__(self, seq: list = ()):
-        super().__init__(seq)
+class ColorSequence:
+    """
+    An immutable sequence of snap colors, packed 4 bits per color in a single int.
+    The int has a leading 1 bit as a sentinel, so it is also the (hashable) identity of the sequence.
+    """
+    __slots__ = ("_identity",)
 
-    def identity(self) -> str:
-        return str.join('-', map(lambda c: c.name, self))
+    BITS = 4
+    EMPTY_IDENTITY = 1
+
+    def __init__(self, seq: Iterable[SnapColorValue] = ()):
+        identity = ColorSequence.EMPTY_IDENTITY
+        for color in seq:
+            identity = (identity << ColorSequence.BITS) | int(color)
+        self._identity: int = identity
+
+    @staticmethod
+    def from_identity(identity: int) -> "ColorSequence":
+        seq = ColorSequence()
+        seq._identity = identity
+        return seq
+
+    def identity(self) -> int:
+        return self._identity
 
     color_map = {
             "red": SnapColorValue.RED,
@@ -22,33 +39,71 @@ class ColorSequence(list):
             "white": SnapColorValue.WHITE
         }
 
-    def from_string_csv(self, csv: str):
+    @classmethod
+    def from_string_csv(cls, csv: str) -> "ColorSequence":
         parts = csv.split(',')
-        return self.from_strings(map(lambda i: i.strip().lower(), parts))
+        return cls.from_strings(map(lambda i: i.strip().lower(), parts))
 
-    def from_strings(self, strings: list()):
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> "ColorSequence":
+        colors = []
         for s in strings:
-            s2 = self.color_map[s]
+            s2 = cls.color_map.get(s)
             if s2 is None:
-                raise Exception(f"There is no such color in the map {s}")
-            self.append(s2)
-        return self
+                raise CommandFormatException(f"There is no such color in the map {s}")
+            colors.append(s2)
+        return cls(colors)
+
+    def __len__(self):
+        return (self._identity.bit_length() - 1) // ColorSequence.BITS
+
+    def __getitem__(self, index: int) -> SnapColorValue:
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("ColorSequence index out of range")
+        return SnapColorValue((self._identity >> ((length - 1 - index) * ColorSequence.BITS)) & 0xF)
+
+    def __iter__(self):
+        for code in self.codes():
+            yield SnapColorValue(code)
+
+    def codes(self) -> list:
+        """The colors as plain ints, cheaper than iterating"""
+        identity = self._identity
+        return [(identity >> shift) & 0xF for shift in range((len(self) - 1) * ColorSequence.BITS, -1,
+                                                             -ColorSequence.BITS)]
+
+    def __eq__(self, other):
+        return isinstance(other, ColorSequence) and self._identity == other._identity
+
+    def __hash__(self):
+        return hash(self._identity)
 
     def __str__(self):
-        return self.identity()
+        return str.join('-', map(lambda c: c.name, self))
 
 
 class Command:
-    def __init__(self, cmd_id: CommandId, *args):
+    __slots__ = ("cmd_id", "args", "target")
+
+    def __init__(self, cmd_id: CommandId, *args, target: str = None):
         self.cmd_id = cmd_id
         self.args = args
+        # The train id or name this command is for. None is for all trains
+        self.target = target
 
     def __str__(self):
         args_str = str.join(', ', map(lambda a: str(a), self.args))
+        if self.target is not None:
+            return f"@{self.target} {self.cmd_id}({args_str})"
         return f"{self.cmd_id}({args_str})"
 
 
 class Program:
+    __slots__ = ("seq", "command")
+
     def __init__(self, seq: ColorSequence, command: Command):
         self.seq = seq
         self.command = command
@@ -57,9 +112,27 @@ class Program:
         return f"{self.seq} -> {self.command}"
 
 
+class Script:
+    """
+    The steps of a multi-step command. The steps are commands, including WAIT, IF and EVERY.
+    compiled is filled by program_engine.compile_script
+    """
+    __slots__ = ("steps", "source", "compiled")
+
+    def __init__(self, steps: List[Command], source: str):
+        self.steps = steps
+        self.source = source
+        self.compiled: tuple = None
+
+    def __str__(self):
+        return self.source
+
+
 class ColorCommand:
+    __slots__ = ("seq", "distance", "timestamp")
+
     def __init__(self, seq: ColorSequence, distance: int, timestamp: float):
-        self.seq: ColorSequence = ColorSequence(seq)
+        self.seq: ColorSequence = seq
         self.distance: int = distance
         self.timestamp: float = timestamp
 
@@ -67,16 +140,5 @@ class ColorCommand:
         return f"{self.seq} at {self.distance} cm / {self.timestamp} sec"
 
 
-class TestData:
-    def __init__(self, s: float, t: float, d: int, dd: float):
-        self.d = d
-        self.t = t
-        self.s = s
-        self.dd = dd
-
-    def __str__(self):
-        return f"{self.s}, {self.t}, {self.d}, {self.dd}"
-
-
 class CommandFormatException(Exception):
     pass
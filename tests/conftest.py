@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other flat, the way the apps run from src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
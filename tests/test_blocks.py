@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+
+import pytest
+
+from blocks import BlockManager
+from enums import JunctionMark, Speed
+from junctions import JunctionEvent
+from scheduler import Timer
+from util import ColorSequence
+
+A = ColorSequence.from_string_csv("red,green")
+B = ColorSequence.from_string_csv("blue,yellow")
+
+
+class _Wheel:
+    def call_soon(self, callback, *args):
+        callback(*args)
+
+
+class _Driver:
+    """The part of a TrainDriver the block manager uses. The distance timers fire when the test says so"""
+
+    def __init__(self, train_id: str, speed: Speed = Speed.THREE):
+        self.train = SimpleNamespace(id=train_id, distance_cm=0)
+        self.state = SimpleNamespace(speed_level=speed)
+        self.timers = list()
+        self.logs = list()
+
+    def log(self, msg):
+        self.logs.append(msg)
+
+    def stop(self):
+        self.state.speed_level = Speed.ZERO
+
+    def set_speed_if(self, expected: Speed, speed_level: Speed) -> bool:
+        if self.state.speed_level != expected:
+            return False
+        self.state.speed_level = speed_level
+        return True
+
+    def at_distance(self, distance_cm, callback, *args) -> Timer:
+        timer = Timer(distance_cm, callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def pass_junction(self, blocks: BlockManager, junction_id: ColorSequence, distance_cm: int):
+        self.train.distance_cm = distance_cm
+        blocks.boundary(self, JunctionEvent(junction_id, JunctionMark.LEFT, False, distance_cm, 3))
+
+    def drive_to(self, distance_cm: int):
+        """Fires the timers due on the way"""
+        self.train.distance_cm = distance_cm
+        due = [timer for timer in self.timers if timer.key <= distance_cm]
+        self.timers = [timer for timer in self.timers if timer.key > distance_cm]
+        for timer in due:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+
+@pytest.fixture
+def blocks():
+    return BlockManager(stop_margin_cm=15, wheel=_Wheel())
+
+
+def _learn_loop(blocks: BlockManager, driver: _Driver):
+    """A loop of two 100 cm blocks, A then B. The driver ends up in A at 200 cm, knowing B comes next"""
+    driver.pass_junction(blocks, A, 0)
+    driver.pass_junction(blocks, B, 100)
+    driver.pass_junction(blocks, A, 200)
+
+
+def test_learns_and_occupies(blocks):
+    first = _Driver("t1")
+    _learn_loop(blocks, first)
+    assert blocks.block_of("t1") == A
+    assert blocks.block_of("t2") is None
+    assert blocks.occupancy() == {str(A): "t1"}
+    # The check of the next block, at the stop margin before the end of this one
+    assert [timer.key for timer in first.timers if not timer.cancelled] == [285]
+
+
+def test_holds_and_frees(blocks):
+    first = _Driver("t1")
+    _learn_loop(blocks, first)
+    second = _Driver("t2")
+    second.pass_junction(blocks, B, 0)
+    assert blocks.occupancy() == {str(A): "t1", str(B): "t2"}
+
+    first.drive_to(285)
+    assert first.state.speed_level == Speed.ZERO
+    assert blocks.holds == 1
+
+    # The second train leaves B for A, the first one gets B and drives on
+    blocks.remove(second)
+    assert first.state.speed_level == Speed.THREE
+    assert blocks.occupancy() == {str(A): "t1", str(B): "t1"}
+    first.pass_junction(blocks, B, 300)
+    assert blocks.occupancy() == {str(B): "t1"}
+
+
+def test_free_block_does_not_override_the_user(blocks):
+    first = _Driver("t1")
+    _learn_loop(blocks, first)
+    second = _Driver("t2")
+    second.pass_junction(blocks, B, 0)
+    first.drive_to(285)
+    assert first.state.speed_level == Speed.ZERO
+
+    # Set meanwhile, it stays
+    first.state.speed_level = Speed.ONE
+    blocks.remove(second)
+    assert first.state.speed_level == Speed.ONE
+
+
+def test_entering_an_occupied_block(blocks):
+    first = _Driver("t1")
+    _learn_loop(blocks, first)
+    # Passed into A with the first train still in it, e.g. it did not stop in time
+    second = _Driver("t2", Speed.TWO)
+    second.pass_junction(blocks, A, 0)
+    assert blocks.conflicts == 1
+    assert second.state.speed_level == Speed.ZERO
+    assert blocks.occupancy() == {str(A): "t1"}
+
+    first.pass_junction(blocks, B, 300)
+    assert second.state.speed_level == Speed.TWO
+    assert blocks.occupancy() == {str(A): "t2", str(B): "t1"}
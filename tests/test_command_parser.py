@@ -0,0 +1,101 @@
+import pytest
+
+from command_parser import CommandParser
+from enums import CommandId
+from util import CommandFormatException, Program
+
+
+@pytest.fixture
+def parser():
+    return CommandParser()
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "@",
+    "@t1",
+    "fly",
+    "speed",
+    "speed x",
+    "speed 2 3",
+    "layout",
+    "layout a b",
+    "route",
+])
+def test_malformed_commands(parser, text):
+    with pytest.raises(CommandFormatException):
+        parser.parse(text)
+
+
+@pytest.mark.parametrize("text", [
+    # Numeric, but not decimal digits int() can read
+    "speed ²",
+    "next left ½",
+    "wait ½ s; stop",
+    "every ²; stop",
+    "if speed < ²; stop",
+])
+def test_non_decimal_numbers(parser, text):
+    with pytest.raises(CommandFormatException):
+        parser.parse(text)
+
+
+@pytest.mark.parametrize("text", [
+    "wait 0 splits; stop",
+    "wait 1.5 splits; stop",
+    "wait 2 hours; stop",
+    "every 0; stop",
+    "if speed < x; stop",
+    "if direction sideways; stop",
+    "wait 1 s; program stop when red",
+])
+def test_malformed_steps(parser, text):
+    with pytest.raises(CommandFormatException):
+        parser.parse(text)
+
+
+@pytest.mark.parametrize("text", [
+    "program stop",
+    "program when red",
+    "program stop when",
+    "program stop when purple",
+    "program stop when red,black,green",
+    "program connect when red",
+    "program disconnect when red",
+    "program speed 2; disconnect when red",
+])
+def test_malformed_programs(parser, text):
+    with pytest.raises(CommandFormatException):
+        parser.parse(text)
+
+
+def test_parse_command_rejects_programs(parser):
+    with pytest.raises(CommandFormatException):
+        parser.parse_command("program stop when red,green")
+
+
+def test_parse_lines_reports_the_line(parser):
+    with pytest.raises(CommandFormatException, match="Line 3"):
+        list(parser.parse_lines(["stop", "# a comment", "fly"]))
+
+
+def test_underscores(parser):
+    assert parser.parse("keep_left").cmd_id == CommandId.KEEP_LEFT
+    layout = parser.parse("layout my_layout")
+    assert layout.cmd_id == CommandId.LAYOUT
+    assert layout.args == ("my_layout", )
+    program = parser.parse("program layout my_layout when red,green")
+    assert isinstance(program, Program)
+    assert program.command.args == ("my_layout", )
+
+
+def test_target(parser):
+    command = parser.parse("@T1 speed 3")
+    assert command.target == "t1"
+    assert command.cmd_id == CommandId.SPEED_FINE
+    assert command.args == (3, )
+
+
+def test_single_step_is_a_command(parser):
+    assert parser.parse("speed 2;").cmd_id == CommandId.SPEED_FINE
+    assert parser.parse("speed 2; wait 1 s; stop").cmd_id == CommandId.SCRIPT
@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from command_queue import TrainCommandQueue
+
+
+class _Writes:
+    """Records the writes, the first one blocks until released so the others queue up behind it"""
+
+    def __init__(self):
+        self.written = list()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, command_type, call, args):
+        if not self.started.is_set():
+            self.started.set()
+            self.release.wait(5)
+        self.written.append((command_type, ) + args)
+
+
+@pytest.fixture
+def writes():
+    return _Writes()
+
+
+@pytest.fixture
+def queue(writes):
+    queue = TrainCommandQueue(writes.write)
+    queue.start()
+    yield queue
+    writes.release.set()
+    queue.stop()
+
+
+def _block(queue, writes):
+    queue.put("block", None)
+    assert writes.started.wait(5)
+
+
+def test_coalesces_the_same_type(queue, writes):
+    _block(queue, writes)
+    for speed in range(5):
+        queue.put("speed", None, speed)
+    queue.put("steering", None, "left")
+    assert queue.depth() == 2
+    assert queue.coalesced == 4
+    writes.release.set()
+    assert queue.flush(5)
+    assert writes.written == [("block", ), ("speed", 4), ("steering", "left")]
+
+
+def test_priority_goes_first(queue, writes):
+    _block(queue, writes)
+    queue.put("steering", None, "left")
+    queue.put("speed", None, 3)
+    queue.put("speed", None, 0, priority=True)
+    writes.release.set()
+    assert queue.flush(5)
+    assert writes.written == [("block", ), ("speed", 0), ("steering", "left")]
+
+
+def test_drops_writes_while_stopped(writes):
+    writes.release.set()
+    queue = TrainCommandQueue(writes.write)
+    queue.put("speed", None, 1)
+    queue.start()
+    queue.put("speed", None, 2)
+    queue.stop()
+    queue.put("speed", None, 3)
+    assert queue.depth() == 0
+    queue.start()
+    queue.put("speed", None, 4)
+    queue.stop()
+    assert writes.written == [("speed", 2), ("speed", 4)]
+
+
+def test_a_failed_write_does_not_stop_the_writer():
+    errors = list()
+    written = list()
+
+    def write(command_type, call, args):
+        if command_type == "speed":
+            raise IOError("link lost")
+        written.append(command_type)
+
+    queue = TrainCommandQueue(write, errors.append)
+    queue.start()
+    queue.put("speed", None)
+    assert queue.flush(5)
+    queue.put("steering", None)
+    assert queue.flush(5)
+    queue.stop()
+    assert [str(error) for error in errors] == ["link lost"]
+    assert written == ["steering"]
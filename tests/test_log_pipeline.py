@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+from log_pipeline import LogPipeline, OverloadPolicy
+
+
+class _Slow:
+    def __init__(self):
+        self.messages = list()
+        self.records = 0
+
+    def report(self, batch):
+        time.sleep(0.005)
+        for record in batch:
+            self.messages.extend([record.message] * (1 + record.repeat))
+        self.records += len(batch)
+
+
+@pytest.fixture
+def reporter():
+    return _Slow()
+
+
+def test_flush_waits_for_the_popped_records(reporter):
+    for _ in range(20):
+        pipeline = LogPipeline(batch_size=4)
+        pipeline.add_reporter(reporter)
+        reporter.messages.clear()
+        for number in range(10):
+            pipeline.submit(str(number))
+        assert pipeline.flush(5)
+        assert reporter.messages == [str(number) for number in range(10)]
+        pipeline.close()
+
+
+def test_coalesce_keeps_every_message(reporter):
+    pipeline = LogPipeline(capacity=8, batch_size=4, policy=OverloadPolicy.COALESCE)
+    pipeline.add_reporter(reporter)
+
+    def submit():
+        for _ in range(5000):
+            pipeline.submit("same")
+
+    threads = [threading.Thread(target=submit) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pipeline.flush(10)
+    pipeline.close()
+    assert len(reporter.messages) == 20000
+    assert pipeline.dropped == 20000 - reporter.records
+
+
+def test_drop_newest():
+    pipeline = LogPipeline(capacity=4, policy=OverloadPolicy.DROP_NEWEST)
+    # Closed, nothing drains the buffer
+    pipeline.close()
+    for number in range(6):
+        pipeline.submit(str(number))
+    assert pipeline.depth() == 4
+    assert pipeline.dropped == 2
@@ -0,0 +1,92 @@
+import sqlite3
+
+import pytest
+
+from command_parser import CommandParser
+from enums import CommandId
+from program_store import ProgramStore
+from util import ColorSequence, Command, CommandFormatException, Program
+
+_PROGRAMS = [
+    "program speed 2 when red,green",
+    "program layout 007 when green,blue",
+    "program route red,green,blue when blue,red",
+    "program speed 2; wait 1 s; stop when yellow,magenta",
+    "@t1 program stop when red,blue",
+    # Longer than an SQLite integer holds as an identity
+    "program stop when " + ",".join(["red", "green", "blue", "yellow", "magenta"] * 6),
+]
+
+
+@pytest.fixture
+def store():
+    with ProgramStore(":memory:") as store:
+        yield store
+
+
+def _programs(programs):
+    return sorted(str(program) for program in programs)
+
+
+def test_round_trip(store):
+    parser = CommandParser()
+    programs = [parser.parse(text) for text in _PROGRAMS]
+    for program in programs:
+        assert store.save("kitchen", program)
+    loaded = store.load("kitchen")
+    assert _programs(loaded) == _programs(programs)
+    by_seq = {program.seq.identity(): program for program in loaded}
+    assert by_seq[programs[1].seq.identity()].command.args == ("007", )
+    assert by_seq[programs[2].seq.identity()].command.args[0].identity() == programs[2].command.args[0].identity()
+    assert by_seq[programs[3].seq.identity()].command.cmd_id == CommandId.SCRIPT
+    assert by_seq[programs[4].seq.identity()].command.target == "t1"
+    assert store.load("garden") == []
+
+
+def test_versions(store):
+    parser = CommandParser()
+    program = parser.parse("program speed 2 when red,green")
+    assert store.version("kitchen") == 0
+    assert store.save("kitchen", program)
+    assert not store.save("kitchen", program)
+    assert store.version("kitchen") == 1
+    assert store.save("kitchen", parser.parse("program speed 3 when red,green"))
+    assert store.version("kitchen") == 2
+    assert store.layouts() == ["kitchen"]
+    assert store.remove("kitchen", program.seq)
+    assert not store.remove("kitchen", program.seq)
+    assert store.version("kitchen") == 3
+    assert store.load("kitchen") == []
+
+
+def test_rejects_arguments_it_cannot_save(store):
+    program = Program(ColorSequence.from_string_csv("red,green"), Command(CommandId.CONNECT, print, print))
+    with pytest.raises(CommandFormatException):
+        store.save("kitchen", program)
+    assert store.version("kitchen") == 0
+
+
+def test_migrates_integer_identities(tmp_path):
+    path = str(tmp_path / "programs.db")
+    parser = CommandParser()
+    speed = parser.parse("program speed 2 when red,green")
+    route = parser.parse("program route red,green when blue,red")
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE layouts (name TEXT PRIMARY KEY, version INTEGER NOT NULL);
+        CREATE TABLE programs (layout TEXT NOT NULL, identity INTEGER NOT NULL, cmd_id INTEGER NOT NULL,
+                               arg INTEGER, target TEXT, version INTEGER NOT NULL,
+                               PRIMARY KEY (layout, identity)) WITHOUT ROWID;
+    """)
+    db.execute("INSERT INTO programs VALUES ('kitchen', ?, ?, 2, NULL, 1)",
+               (speed.seq.identity(), int(CommandId.SPEED_FINE)))
+    db.execute("INSERT INTO programs VALUES ('kitchen', ?, ?, ?, NULL, 1)",
+               (route.seq.identity(), int(CommandId.ROUTE), route.command.args[0].identity()))
+    db.commit()
+    db.close()
+
+    with ProgramStore(path) as store:
+        assert _programs(store.load("kitchen")) == _programs([speed, route])
+        assert store.remove("kitchen", speed.seq)
+    with ProgramStore(path) as store:
+        assert _programs(store.load("kitchen")) == _programs([route])
@@ -0,0 +1,153 @@
+import random
+import threading
+import time
+
+import pytest
+
+from scheduler import CountWheel, DistanceWheel, HierarchicalWheel, Timer, TimerWheel
+
+
+class _Wheel:
+    """A TimerWheel that runs call_soon at once and keeps the delayed callbacks for the test to run"""
+
+    def __init__(self):
+        self.delayed = list()
+
+    def schedule(self, delay_s, callback, *args):
+        timer = Timer(0, callback, args)
+        if delay_s <= 0:
+            callback(*args)
+        else:
+            self.delayed.append(timer)
+        return timer
+
+    def call_soon(self, callback, *args):
+        callback(*args)
+
+    def run_delayed(self):
+        delayed = self.delayed
+        self.delayed = list()
+        for timer in delayed:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+
+def _keys(timers):
+    return [timer.key for timer in timers]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_hierarchical_wheel_due_sets(seed):
+    rng = random.Random(seed)
+    wheel = HierarchicalWheel(levels=3)
+    timers = [Timer(rng.randrange(1, 100_000), None, ()) for _ in range(2000)]
+    for timer in timers:
+        wheel.add(timer)
+    cancelled = set(rng.sample(range(len(timers)), 200))
+    for index in cancelled:
+        timers[index].cancel()
+    expected = sorted((t for i, t in enumerate(timers) if i not in cancelled), key=lambda t: t.key)
+
+    due = list()
+    key = 0
+    while key < 110_000:
+        previous = key
+        # Small steps and jumps over several rotations of the lower levels
+        key += rng.choice((1, 7, 63, 64, 65, 4096, 30_000))
+        batch = wheel.advance(key)
+        assert all(previous < timer.key <= key for timer in batch)
+        assert _keys(batch) == sorted(_keys(batch))
+        due.extend(batch)
+    assert due == expected
+    assert len(wheel) == 0
+
+
+def test_hierarchical_wheel_past_timers_on_next_advance():
+    wheel = HierarchicalWheel(key=100)
+    late = Timer(50, None, ())
+    wheel.add(late)
+    assert wheel.advance(100) == []
+    assert wheel.advance(101) == [late]
+
+
+def test_hierarchical_wheel_due_in_key_order():
+    wheel = HierarchicalWheel()
+    later = Timer(10, None, ())
+    wheel.add(later)
+    assert wheel.advance(9) == []
+    # Passed already, it goes to the next slot, after the timer already there
+    passed = Timer(5, None, ())
+    wheel.add(passed)
+    assert wheel.advance(10) == [passed, later]
+
+
+def test_hierarchical_wheel_jump_past_the_span():
+    wheel = HierarchicalWheel(levels=2)
+    timers = [Timer(key, None, ()) for key in (5000, 3, 70, 4095, 10)]
+    for timer in timers:
+        wheel.add(timer)
+    assert _keys(wheel.advance(100_000)) == [3, 10, 70, 4095, 5000]
+
+
+def test_count_wheel():
+    fired = list()
+    counts = CountWheel(_Wheel())
+    counts.schedule(2, fired.append, "second")
+    counts.schedule(0.5, fired.append, "first")
+    counts.schedule(3, fired.append, "cancelled").cancel()
+    counts.advance(1)
+    assert fired == ["first"]
+    counts.advance(3)
+    assert fired == ["first", "second"]
+    counts.schedule_at(5, fired.append, "at five")
+    counts.reset(3)
+    counts.advance(10)
+    assert fired == ["first", "second"]
+
+
+def test_distance_wheel():
+    fired = list()
+    odometer = [0]
+    wheel = _Wheel()
+    distance = DistanceWheel(wheel, lambda: odometer[0], lambda: 20.0)
+    distance.schedule(30, fired.append, "after 30")
+    distance.schedule_at(50, fired.append, "at 50")
+    distance.advance(29)
+    assert fired == []
+    distance.advance(30)
+    assert fired == ["after 30"]
+
+    # No train event gets there, the odometer check does
+    odometer[0] = 55
+    wheel.run_delayed()
+    assert fired == ["after 30", "at 50"]
+    assert len(distance) == 0
+
+    distance.schedule(10, fired.append, "dropped")
+    distance.reset(0)
+    odometer[0] = 100
+    wheel.run_delayed()
+    distance.advance(100)
+    assert fired == ["after 30", "at 50"]
+
+
+def test_timer_wheel_fires_at_or_after_the_deadline():
+    wheel = TimerWheel(tick_s=0.01)
+    try:
+        fired = dict()
+        done = threading.Event()
+        start = time.monotonic()
+
+        def record(name):
+            fired[name] = time.monotonic() - start
+            if len(fired) == 2:
+                done.set()
+
+        wheel.schedule(0.05, record, "later")
+        wheel.call_soon(record, "soon")
+        wheel.schedule(0.03, record, "cancelled").cancel()
+        assert done.wait(5)
+        assert fired["later"] >= 0.05
+        assert "cancelled" not in fired
+    finally:
+        wheel.stop()